@@ -33,6 +33,79 @@ def convertCamelCase2Underscore(name):
   return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
+class ExecutionDigest(object):
+  """ Collects the FILL publications of the trade engine and groups them by
+  account, so every account receives a single e-mail per interval instead of one
+  e-mail per execution.
+
+  When a filename is given, every FILL is also appended to it, so the pending
+  executions survive a restart of the mailer. """
+  def __init__(self, interval, filename=None):
+    self.interval       = interval
+    self.request_id     = 0
+    self.accounts       = {}  # (account_id, broker_id) -> list of executions
+    self.next_digest    = time.time() + interval
+    self.filename       = filename
+    self.file           = None
+
+    if self.filename:
+      if os.path.exists(self.filename):
+        with open(self.filename) as f:
+          for line in f:
+            try:
+              self._add(json.loads(line))
+            except ValueError:
+              pass  # the last line was only partially written
+      self.file = open(self.filename, 'a')
+
+  def add_execution(self, account_id, broker_id, order_id, side, fill):
+    self.accounts.setdefault( (account_id, broker_id), [] ).append({
+      'TradeID'   : fill['TradeID'],
+      'OrderID'   : order_id,
+      'Side'      : side,
+      'Symbol'    : fill['Symbol'],
+      'Price'     : fill['Price'],
+      'Size'      : fill['Size'],
+      'Created'   : fill['Created']
+    })
+
+  def add(self, fill):
+    if self.file:
+      self.file.write(json.dumps(fill) + '\n')
+      self.file.flush()
+    self._add(fill)
+
+  def _add(self, fill):
+    counter_side = '2' if fill['Side'] == '1' else '1'
+    self.add_execution(fill['AccountID'], fill['BrokerID'], fill['OrderID'], fill['Side'], fill)
+    self.add_execution(fill['CounterAccountID'], fill['CounterBrokerID'], fill['CounterOrderID'], counter_side, fill)
+
+  def is_due(self):
+    return time.time() >= self.next_digest
+
+  def time_to_next_digest(self):
+    return max(self.next_digest - time.time(), 0)
+
+  def build_request(self):
+    """ Returns the ExecutionDigestRequest of the executions collected so far """
+    self.next_digest = time.time() + self.interval
+    if not self.accounts:
+      return None
+
+    self.request_id += 1
+    return {
+      'MsgType': 'U50',
+      'ExecutionDigestReqID': self.request_id,
+      'Accounts': [ { 'AccountID': account_id, 'BrokerID': broker_id, 'Executions': executions }
+                    for (account_id, broker_id), executions in self.accounts.iteritems() ]
+    }
+
+  def clear(self):
+    self.accounts = {}
+    if self.file:
+      self.file.truncate(0)
+
+
 def run_application(options, instance_name):
   input_log_file_handler = logging.handlers.TimedRotatingFileHandler(options.mailer_log, when='MIDNIGHT')
   input_log_file_handler.setFormatter(logging.Formatter(u"%(asctime)s - %(message)s"))
@@ -59,12 +132,15 @@ def run_application(options, instance_name):
   log('PARAM', 'mailchimp_apikey',              options.mailchimp_apikey)
   log('PARAM', 'mandrill_apikey',               options.mandrill_apikey)
   log('PARAM', 'mailchimp_newsletter_list_id',  options.mailchimp_newsletter_list_id)
+  log('PARAM', 'execution_digest_interval',     options.execution_digest_interval)
+  log('PARAM', 'execution_digest_file',         options.execution_digest_file)
   log('PARAM', 'END')
 
   context = zmq.Context()
   socket = context.socket(zmq.SUB)
   socket.connect(options.trade_pub)
   socket.setsockopt(zmq.SUBSCRIBE, "EMAIL")
+  socket.setsockopt(zmq.SUBSCRIBE, "FILL")
 
   trade_in_socket = context.socket(zmq.REQ)
   trade_in_socket.connect(options.trade_in)
@@ -115,9 +191,28 @@ def run_application(options, instance_name):
   except mandrill.Error:
     raise RuntimeError("Invalid Mandrill API key")
 
+  execution_digest = ExecutionDigest( float(options.execution_digest_interval or 60), options.execution_digest_file )
+
   while True:
     try:
-      raw_email_message = socket.recv()
+      if execution_digest.is_due():
+        digest_request = execution_digest.build_request()
+        if digest_request:
+          log('OUT', 'TRADE_IN_REQ', json.dumps(digest_request))
+          try:
+            log('IN', 'TRADE_IN_REP', application_trade_client.sendJSON(digest_request).raw_message)
+            execution_digest.clear()
+          except TradeClientException, e:
+            log('ERROR', 'EXCEPTION', str(e))
+
+      if not socket.poll( execution_digest.time_to_next_digest() * 1000 ):
+        continue
+
+      topic, raw_email_message = socket.recv_multipart()
+      if topic == 'FILL':
+        execution_digest.add(json.loads(raw_email_message))
+        continue
+
       log('IN', 'TRADE_IN_PUB', raw_email_message)
 
       msg = JsonMessage(raw_email_message)
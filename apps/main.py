@@ -25,6 +25,10 @@ def trade_instance(instance_name, project_options):
   app.run()
 
 
+def trade_router_instance(instance_name, project_options):
+  from trade.router import run_application
+  run_application(project_options, instance_name)
+
 def ws_gateway_instance( instance_name , project_options):
   from ws_gateway.main import run_application
   run_application(project_options, instance_name)
@@ -54,7 +58,9 @@ def main():
   processes = []
   for section_name in config.sections():
     project_options = ProjectOptions(config, section_name)
-    if section_name[:5] == 'trade':
+    if section_name[:12] == 'trade_router':
+      p = multiprocessing.Process(name=section_name, target=partial(trade_router_instance,section_name, project_options )  )
+    elif section_name[:5] == 'trade':
       p = multiprocessing.Process(name=section_name, target=partial(trade_instance,section_name, project_options )  )
     elif section_name[:10] == 'ws_gateway':
       p = multiprocessing.Process(name=section_name, target=partial(ws_gateway_instance,section_name, project_options )  )
@@ -64,15 +70,21 @@ def main():
       raise RuntimeError("Invalid section name")
     processes.append(p)
 
-  # start all sub processes
+  # start all sub processes. The gateways fork the workers that render the deposit
+  # slips, which a daemonic process can't do, so they are terminated explicitly
   for p in  processes:
-    p.daemon  = True
+    p.daemon  = p.name[:10] != 'ws_gateway'
     p.start()
 
   # wait for them to finish
-  for p in processes:
-    logging.debug('waiting %s', p.name )
-    p.join()
+  try:
+    for p in processes:
+      logging.debug('waiting %s', p.name )
+      p.join()
+  finally:
+    for p in processes:
+      if p.is_alive():
+        p.terminate()
 
 
 if __name__ == '__main__':
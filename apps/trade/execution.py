@@ -2,23 +2,49 @@
 
 __author__ = 'rodrigo'
 
-import bisect
-
 import json
 import datetime
-from models import Trade, UserEmail
+from models import Trade, Balance
 
 from trade_application import TradeApplication
 
 from market_data_publisher import MarketDataPublisher
 
+from order_book import OrderBookSide
+
 matcher_dict  = {}
 
+def publish_fill(trade, order, counter_order):
+  """ Publishes the compact trade event used by the execution e-mail digests.
+  order is the aggressor order, counter_order the one that was on the book """
+  TradeApplication.instance().publish('FILL', {
+    'TradeID'           : trade.id,
+    'Symbol'            : trade.symbol,
+    'Side'              : order.side,
+    'Price'             : trade.price,
+    'Size'              : trade.size,
+    'Created'           : trade.created,
+    'OrderID'           : order.id,
+    'AccountID'         : order.account_id,
+    'BrokerID'          : order.broker_id,
+    'CounterOrderID'    : counter_order.id,
+    'CounterAccountID'  : counter_order.account_id,
+    'CounterBrokerID'   : counter_order.broker_id
+  })
+
+# every field of an execution report is a string or a number
+report_encoder = json.JSONEncoder()
+
 class ExecutionReport(object):
+  __slots__ = ('execution_id', 'order_id', 'client_order_id', 'execution_type', 'order_type', 'time_in_force',
+               'order_status', 'symbol', 'side', 'last_price', 'last_shares', 'leaves_qty', 'cum_qty', 'cxl_qty',
+               'average_price', 'order_qty', 'price', 'execution_side', 'raw_json')
+
   execution_id_generator = 0
   def __init__(self, order, execution_side):
     ExecutionReport.execution_id_generator += 1
     self.execution_id = ExecutionReport.execution_id_generator
+    self.raw_json = None
 
     self.order_id = order.id
     self.client_order_id = order.client_order_id
@@ -70,6 +96,13 @@ class ExecutionReport(object):
     }
     return  resp
 
+  def serialize(self):
+    """ The report encoded as JSON. It is encoded only once, so the publications
+    to the user and to the account share the same string """
+    if self.raw_json is None:
+      self.raw_json = report_encoder.encode(self.toJson())
+    return self.raw_json
+
   def __str__(self):
     return str(self.toJson())
 
@@ -78,14 +111,14 @@ class ExecutionReport(object):
 class OrderMatcher(object):
   def __init__(self, symbol ):
     self.symbol     = symbol
-    self.buy_side   = []
-    self.sell_side  = []
+    self.buy_side   = OrderBookSide(is_buy=True)
+    self.sell_side  = OrderBookSide(is_buy=False)
     self.bid        = 0
     self.ask        = 0
 
   def __str__(self):
     res = ""
-    for order in reversed(self.sell_side):
+    for order in reversed(list(self.sell_side)):
       res += str(order) + '\n'
     res += '-' + '\n'
     for order in self.buy_side:
@@ -94,8 +127,8 @@ class OrderMatcher(object):
 
 
   def match(self, session, order):
-    other_side = []
-    self_side = []
+    other_side = None
+    self_side = None
     if order.is_buy:
       self_side = self.buy_side
       other_side = self.sell_side
@@ -106,25 +139,42 @@ class OrderMatcher(object):
 
     execution_reports = []
     trades_to_publish = []
+    filled_orders = []
 
     execution_side = '1' if order.is_buy else '2'
 
     rpt_order  = ExecutionReport( order, execution_side )
-    execution_reports.append( ( order.user_id, rpt_order.toJson() )  )
+    execution_reports.append( ( order.user_id, rpt_order.serialize() )  )
     if order.user_id != order.account_id:
-      execution_reports.append( ( order.account_id, rpt_order.toJson() )  )
+      execution_reports.append( ( order.account_id, rpt_order.serialize() )  )
+
+    if order.has_funds_held:
+      # hold the funds before matching, so the counter orders are known to be funded
+      currency, amount = order.funds_to_hold
+      available_balance = Balance.get_available_balance(session, order.account_id, order.broker_id, currency)
+      if amount > available_balance:
+        available_qty = 0
+        if available_balance > 0:
+          if order.is_buy:
+            available_qty = int(available_balance) * 100000000 // int(order.price)
+          else:
+            available_qty = available_balance
+        order.cancel_qty( order.leaves_qty - available_qty )
 
-    is_last_match_a_partial_execution_on_counter_order = False
-    execution_counter = 0
-    number_of_filled_counter_market_orders = 0
-    for execution_counter in xrange(0, len(other_side) + 1):
-      if execution_counter == len(other_side):
-        break # workaround to make the execution_counter be counted until the last order.
+        cancel_rpt_order  = ExecutionReport( order, execution_side )
+        execution_reports.append( ( order.user_id, cancel_rpt_order.serialize() )  )
+        if order.user_id != order.account_id:
+          execution_reports.append( ( order.account_id, cancel_rpt_order.serialize() )  )
 
-      counter_order = other_side[execution_counter]
+      Balance.store.hold_order(order)
 
-      if not order.has_match(counter_order):
+    counter_orders = []
+    is_last_match_a_partial_execution_on_counter_order = False
+    execution_counter = 0
+    for execution_counter, counter_order in enumerate(other_side):
+      if not order.has_leaves_qty or not order.has_match(counter_order):
         break
+      counter_orders.append(counter_order)
 
       # check for self execution
       if order.account_id == counter_order.account_id:
@@ -133,9 +183,9 @@ class OrderMatcher(object):
 
         # generate a cancel report
         cancel_rpt_counter_order  = ExecutionReport( counter_order, execution_side )
-        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order.toJson() )  )
+        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order.serialize() )  )
         if counter_order.user_id != counter_order.account_id:
-          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order.toJson() )  )
+          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order.serialize() )  )
 
         # go to the next order
         is_last_match_a_partial_execution_on_counter_order = False
@@ -146,15 +196,16 @@ class OrderMatcher(object):
 
       if counter_order.type == '1': # Market Order
         executed_price = order.price
-        number_of_filled_counter_market_orders += 1
       else:
         executed_price = counter_order.price
 
       # let's get the available qty to execute on the order side
-      available_qty_on_order_side = order.get_available_qty_to_execute(session,
-                                                                       '1' if order.is_buy else '2',
-                                                                       executed_qty,
-                                                                       executed_price )
+      available_qty_on_order_side = executed_qty
+      if not order.has_funds_held:
+        available_qty_on_order_side = order.get_available_qty_to_execute(session,
+                                                                         '1' if order.is_buy else '2',
+                                                                         executed_qty,
+                                                                         executed_price )
 
       qty_to_cancel_from_order = 0
       if available_qty_on_order_side <  executed_qty:
@@ -169,17 +220,19 @@ class OrderMatcher(object):
       if not executed_qty:
         order.cancel_qty( qty_to_cancel_from_order )
         cancel_rpt_order  = ExecutionReport( order, execution_side )
-        execution_reports.append( ( order.user_id, cancel_rpt_order.toJson() )  )
+        execution_reports.append( ( order.user_id, cancel_rpt_order.serialize() )  )
         if order.user_id != order.account_id:
-          execution_reports.append( ( order.account_id, cancel_rpt_order.toJson() )  )
+          execution_reports.append( ( order.account_id, cancel_rpt_order.serialize() )  )
         break
 
 
       # let's get the available qty to execute on the counter side
-      available_qty_on_counter_side = counter_order.get_available_qty_to_execute(session,
-                                                                                 '1' if counter_order.is_buy else '2',
-                                                                                 executed_qty,
-                                                                                 executed_price )
+      available_qty_on_counter_side = executed_qty
+      if not counter_order.has_funds_held:
+        available_qty_on_counter_side = counter_order.get_available_qty_to_execute(session,
+                                                                                   '1' if counter_order.is_buy else '2',
+                                                                                   executed_qty,
+                                                                                   executed_price )
 
       qty_to_cancel_from_counter_order = 0
       if available_qty_on_counter_side <  executed_qty:
@@ -200,9 +253,9 @@ class OrderMatcher(object):
 
         # generate a cancel report
         cancel_rpt_counter_order  = ExecutionReport( counter_order, execution_side )
-        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order.toJson() )  )
+        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order.serialize() )  )
         if counter_order.user_id != counter_order.account_id:
-          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order.toJson() )  )
+          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order.serialize() )  )
 
         # go to the next order
         is_last_match_a_partial_execution_on_counter_order = False
@@ -215,60 +268,17 @@ class OrderMatcher(object):
 
         trade = Trade.create(session, order, counter_order, self.symbol, executed_qty, executed_price )
         trades_to_publish.append(trade)
+        filled_orders.append( (trade, order, counter_order) )
 
         rpt_order         = ExecutionReport( order, execution_side )
-        execution_reports.append( ( order.user_id, rpt_order.toJson() )  )
+        execution_reports.append( ( order.user_id, rpt_order.serialize() )  )
         if order.user_id != order.account_id:
-          execution_reports.append( ( order.account_id, rpt_order.toJson() )  )
+          execution_reports.append( ( order.account_id, rpt_order.serialize() )  )
 
         rpt_counter_order = ExecutionReport( counter_order, execution_side )
-        execution_reports.append( ( counter_order.user_id, rpt_counter_order.toJson() )  )
+        execution_reports.append( ( counter_order.user_id, rpt_counter_order.serialize() )  )
         if counter_order.user_id != counter_order.account_id:
-          execution_reports.append( ( counter_order.account_id, rpt_counter_order.toJson() )  )
-
-        def generate_email_subject_and_body( session, order, trade ):
-          from json import  dumps
-          from pyblinktrade.json_encoder import  JsonEncoder
-          from models import Currency
-
-          qty_currency = order.symbol[:3]
-          formatted_qty = Currency.format_number( session, qty_currency, order.order_qty / 1.e8 )
-
-          price_currency = order.symbol[3:]
-          formatted_price = Currency.format_number( session, price_currency, order.price / 1.e8 )
-
-          formatted_total_price = Currency.format_number( session, price_currency, order.order_qty/1.e8 * order.price / 1.e8 )
-
-          email_subject =  'E'
-          email_template = "order-execution"
-          email_params = {
-            'username': order.user.username,
-            'order_id': order.id,
-            'trade_id': trade.id,
-            'executed_when': trade.created,
-            'qty': formatted_qty,
-            'price': formatted_price,
-            'total': formatted_total_price
-          }
-          return  email_subject, email_template, dumps(email_params, cls=JsonEncoder)
-
-        email_data = generate_email_subject_and_body(session, order, trade)
-        UserEmail.create( session = session,
-                          user_id = order.account_id,
-                          broker_id = order.broker_id,
-                          subject = email_data[0],
-                          template= email_data[1],
-                          language= order.email_lang,
-                          params  = email_data[2])
-
-        email_data = generate_email_subject_and_body(session, counter_order, trade)
-        UserEmail.create( session = session,
-                          user_id = counter_order.account_id,
-                          broker_id = counter_order.broker_id,
-                          subject = email_data[0],
-                          template= email_data[1],
-                          language= counter_order.email_lang,
-                          params  = email_data[2])
+          execution_reports.append( ( counter_order.account_id, rpt_counter_order.serialize() )  )
 
 
       #
@@ -281,10 +291,10 @@ class OrderMatcher(object):
 
         # generate a cancel report
         cancel_rpt_order  = ExecutionReport( order, execution_side )
-        execution_reports.append( ( order.user_id, cancel_rpt_order.toJson() )  )
+        execution_reports.append( ( order.user_id, cancel_rpt_order.serialize() )  )
 
         if order.user_id != order.account_id:
-          execution_reports.append( ( order.account_id, cancel_rpt_order.toJson() )  )
+          execution_reports.append( ( order.account_id, cancel_rpt_order.serialize() )  )
 
 
       if qty_to_cancel_from_counter_order:
@@ -292,12 +302,20 @@ class OrderMatcher(object):
 
         # generate a cancel report
         cancel_rpt_counter_order  = ExecutionReport( counter_order, execution_side )
-        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order.toJson() )  )
+        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order.serialize() )  )
         if counter_order.user_id != counter_order.account_id:
-          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order.toJson() )  )
+          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order.serialize() )  )
 
       if counter_order.has_leaves_qty:
         is_last_match_a_partial_execution_on_counter_order = True
+    else:
+      execution_counter = len(other_side) # all orders on the other side were matched
+
+    # release the funds that are no longer needed
+    if Balance.store is not None:
+      Balance.store.hold_order(order)
+      for counter_order in counter_orders:
+        Balance.store.hold_order(counter_order)
 
 
     md_entry_type = '0' if order.is_buy else '1'
@@ -305,8 +323,7 @@ class OrderMatcher(object):
 
     # let's include the order in the book if the order is not fully executed.
     if order.has_leaves_qty:
-      insert_pos = bisect.bisect_right(self_side, order)
-      self_side.insert( insert_pos, order )
+      insert_pos = self_side.insert( order )
 
       if order.type == '2': # Limited orders go to the book.
         MarketDataPublisher.publish_new_order( self.symbol, md_entry_type , insert_pos, order)
@@ -322,19 +339,22 @@ class OrderMatcher(object):
     # Publish Market Data for the counter order
     if execution_counter:
       if is_last_match_a_partial_execution_on_counter_order:
-        del other_side[0: execution_counter-1]
+        removed_from_book = other_side.pop_front( execution_counter - 1 )
         MarketDataPublisher.publish_executions( self.symbol,
                                                  counter_md_entry_type,
-                                                 execution_counter - 1 - number_of_filled_counter_market_orders,
-                                                 other_side[0] )
+                                                 removed_from_book,
+                                                 other_side.front() )
       else:
-        del other_side[0: execution_counter]
+        removed_from_book = other_side.pop_front( execution_counter )
         MarketDataPublisher.publish_executions( self.symbol,
                                                  counter_md_entry_type,
-                                                 execution_counter - number_of_filled_counter_market_orders )
+                                                 removed_from_book )
 
     if trades_to_publish:
+      session.flush()  # assign the trade ids
       MarketDataPublisher.publish_trades(self.symbol, trades_to_publish)
+      for trade, filled_order, filled_counter_order in filled_orders:
+        publish_fill(trade, filled_order, filled_counter_order)
     return ""
 
 
@@ -343,54 +363,84 @@ class OrderMatcher(object):
       # Generate an Order Cancel Reject - Order not found
       return
 
-    # let's find the  order position
-    self_side = []
+    self_side = None
     if order.is_buy:
       self_side = self.buy_side
     elif order.is_sell:
       self_side = self.sell_side
 
-    order_found = False
-    order_pos = bisect.bisect_left(self_side, order)
-    for x in xrange( order_pos, len(self_side)):
-      tmp_order = self_side[x]
-
-      if tmp_order.id == order.id:
-        order_found = True
-        break
-
-      if tmp_order.price != order.price:
-        break
-
-      order_pos += 1
-
-
-    if not order_found:
+    if self_side is None or order.id not in self_side:
       # Generate an Order Cancel Reject - Order not found
       return
 
     # update the order
     order.cancel_qty( order.leaves_qty )
-    session.commit()
+    if Balance.store is not None:
+      Balance.store.hold_order(order)
+    TradeApplication.instance().commit()
 
     # remove the order from the book
-    self_side.pop( order_pos )
+    order_pos = self_side.remove( order.id )
 
 
     # Generate a cancel report
     cancel_rpt = ExecutionReport( order, '1' if order.is_buy else '2' )
-    TradeApplication.instance().publish(order.user_id, cancel_rpt.toJson() )
+    TradeApplication.instance().publish(order.user_id, cancel_rpt.serialize() )
 
     if order.user_id != order.account_id:
-      TradeApplication.instance().publish(order.account_id, cancel_rpt.toJson() )
+      TradeApplication.instance().publish(order.account_id, cancel_rpt.serialize() )
 
 
     # market data
-    md_entry_type = '0' if order.is_buy else '1'
-    MarketDataPublisher.publish_cancel_order( self.symbol, md_entry_type, order_pos+1 )
+    if order_pos is not None: # market orders are not published on the book
+      md_entry_type = '0' if order.is_buy else '1'
+      MarketDataPublisher.publish_cancel_order( self.symbol, md_entry_type, order_pos+1 )
 
     return ""
 
+  def snapshot(self):
+    """ Returns the book as [order_id, price, leaves_qty, sequence] lists, in priority order """
+    return {
+      'buy':  [ [order.id, order.price, order.leaves_qty, sequence] for order, sequence in self.buy_side.entries() ],
+      'sell': [ [order.id, order.price, order.leaves_qty, sequence] for order, sequence in self.sell_side.entries() ]
+    }
+
+  def restore(self, book, orders, new_orders=()):
+    """ Loads a book returned by snapshot() without matching it again. orders is
+    a dictionary order_id -> Order with the open orders of the database.
+    new_orders, opened after the snapshot, rest behind the orders of the book """
+    for order_id, price, leaves_qty, sequence in book['buy']:
+      self.buy_side.insert(orders[order_id], sequence)
+    for order_id, price, leaves_qty, sequence in book['sell']:
+      self.sell_side.insert(orders[order_id], sequence)
+    for order in new_orders:
+      if order.is_buy:
+        self.buy_side.insert(order)
+      else:
+        self.sell_side.insert(order)
+
+    if Balance.store is not None:
+      # the orders come from the database, but check that the balances still cover them
+      held = set()
+      for side in (self.buy_side, self.sell_side):
+        for order, sequence in side.entries():
+          Balance.store.hold_order(order)
+          held.add( (order.account_id, order.broker_id, order.funds_to_hold[0]) )
+
+      for account_id, broker_id, currency in held:
+        hold = Balance.store.get_hold(account_id, broker_id, currency)
+        balance = Balance.store.get_balance(account_id, broker_id, currency)
+        if hold > balance:
+          TradeApplication.instance().log('SNAPSHOT', 'HOLD_EXCEEDS_BALANCE',
+                                          '%s,%s,%s,%s,%s' % (account_id, broker_id, currency, hold, balance))
+
+  def is_crossed(self):
+    """ True when the best bid reaches the best offer, which a matched book never does """
+    buy, sell = self.buy_side.front(), self.sell_side.front()
+    if buy is None or sell is None:
+      return False
+    return buy.type == '1' or sell.type == '1' or buy.price >= sell.price
+
   @staticmethod
   def get(symbol):
     global matcher_dict
@@ -0,0 +1,122 @@
+__author__ = 'rodrigo'
+
+import os
+import mmap
+import struct
+import time
+import zlib
+
+JOURNAL_START         = 1  # the trade engine started. payload: instance name
+JOURNAL_REQUEST       = 2  # raw message received on trade_in
+JOURNAL_SESSION_USER  = 3  # a session was authenticated. payload: session_id,user_id
+
+# payload length, record type, sequence, timestamp, crc32 of the rest of the record
+RECORD_HEADER = struct.Struct('<IBQdI')
+RECORD_FIELDS = struct.Struct('<BQd')
+
+
+def _record_crc(record_type, sequence, timestamp, payload):
+  return zlib.crc32(payload, zlib.crc32(RECORD_FIELDS.pack(record_type, sequence, timestamp))) & 0xffffffff
+
+
+def _read_records(f, size):
+  """ Yields (end offset, sequence, timestamp, record type, payload) for every
+  complete record of the file. Stops on a torn write, a record which checksum
+  doesn't match or on the zeroed tail of a memory mapped journal """
+  offset = 0
+  while offset + RECORD_HEADER.size <= size:
+    length, record_type, sequence, timestamp, crc = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+    if not length or offset + RECORD_HEADER.size + length > size:
+      return
+    payload = f.read(length)
+    if _record_crc(record_type, sequence, timestamp, payload) != crc:
+      return
+    offset += RECORD_HEADER.size + length
+    yield offset, sequence, timestamp, record_type, payload
+
+
+def read_journal(filename, from_sequence=0):
+  """ Yields (sequence, timestamp, record type, payload) for every record with a
+  sequence greater than from_sequence """
+  with open(filename, 'rb') as f:
+    for offset, sequence, timestamp, record_type, payload in _read_records(f, os.path.getsize(filename)):
+      if sequence > from_sequence:
+        yield sequence, timestamp, record_type, payload
+
+
+class JournalWriter(object):
+  """ Append only binary journal of the messages received by the trade engine.
+
+  Every record is a fixed size header (payload length, record type, sequence
+  number, timestamp and a CRC32 of the record) followed by the raw payload. Records are written to a
+  buffered file, or straight into a memory mapped file that grows by
+  mmap_chunk_size bytes at a time. Reopening an existing journal continues the
+  sequence and discards an incomplete trailing record.
+  """
+
+  def __init__(self, filename, buffer_size=65536, use_mmap=False, mmap_chunk_size=16*1024*1024):
+    self.filename         = filename
+    self.mmap_chunk_size  = mmap_chunk_size
+    self.sequence         = 0
+    self.offset           = 0
+    self.map              = None
+
+    if not os.path.exists(filename):
+      open(filename, 'wb').close()
+
+    with open(filename, 'rb') as f:
+      for self.offset, self.sequence, timestamp, record_type, payload in _read_records(f, os.path.getsize(filename)):
+        pass
+
+    self.file = open(filename, 'r+b', buffer_size)
+    self.file.truncate(self.offset)
+    self.file.seek(self.offset)
+
+    if use_mmap:
+      self._remap(0)
+
+  def _remap(self, record_size):
+    if self.map is not None:
+      self.map.close()
+    size = self.offset + max(record_size, self.mmap_chunk_size)
+    self.file.truncate(size)
+    self.map = mmap.mmap(self.file.fileno(), size)
+
+  def append(self, record_type, payload):
+    if isinstance(payload, unicode):
+      payload = payload.encode('utf-8')
+    if not payload:
+      raise ValueError('empty journal record')
+
+    self.sequence += 1
+    timestamp = time.time()
+    crc = _record_crc(record_type, self.sequence, timestamp, payload)
+    record = RECORD_HEADER.pack(len(payload), record_type, self.sequence, timestamp, crc) + payload
+
+    if self.map is None:
+      self.file.write(record)
+    else:
+      end = self.offset + len(record)
+      if end > len(self.map):
+        self._remap(len(record))
+        end = self.offset + len(record)
+      self.map[self.offset:end] = record
+    self.offset += len(record)
+    return self.sequence
+
+  def flush(self):
+    """ Writes the records down to the disk, so they survive a crash of the
+    machine as well as the database commit that follows """
+    if self.map is None:
+      self.file.flush()
+      os.fsync(self.file.fileno())
+    else:
+      self.map.flush()
+
+  def close(self):
+    if self.map is not None:
+      self.map.flush()
+      self.map.close()
+      self.map = None
+      self.file.truncate(self.offset)
+    self.file.close()
@@ -108,8 +108,11 @@ class MarketDataPublisher(object):
     TradeApplication.instance().publish( 'MD_TRADE_' + symbol , md )
 
   @staticmethod
-  def generate_trade_history( session, page_size = None, offset = None, sort_column = None, sort_order='ASC' ):
-    trades = Trade.get_last_trades(session, page_size, offset, sort_column, sort_order)
+  def generate_trade_history( session, page_size = None, offset = None, sort_column = None, sort_order='ASC', since_trade_id = None ):
+    if since_trade_id is not None:
+      trades = Trade.get_trades_since(session, since_trade_id, page_size)
+    else:
+      trades = Trade.get_last_trades(session, page_size, offset, sort_column, sort_order)
     trade_list = []
     for trade in  trades:
         trade_list.append([
@@ -7,13 +7,16 @@ import logging
 import hmac, base64, struct, hashlib, time, uuid
 
 import datetime
+import unicodedata
 from pyblinktrade.utils import smart_str
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, event, bindparam, select
 from sqlalchemy import desc, func
 from sqlalchemy.sql.expression import and_, or_, exists
-from sqlalchemy import Column, Integer, Unicode, String, DateTime, Boolean, Numeric, Text, Date, UniqueConstraint, UnicodeText
+from sqlalchemy import Column, Integer, Unicode, String, DateTime, Boolean, Numeric, Text, Date, UniqueConstraint, UnicodeText, Index
 from sqlalchemy.orm import  relationship, backref
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 import json
 
@@ -72,6 +75,46 @@ class UserAlreadyExistsException(Exception):
 class BrokerDoesNotExistsException(Exception):
   pass
 
+def encode_list_cursor(record):
+  """ opaque Cursor of the position right after record in a list ordered by (created, id) """
+  return base64.urlsafe_b64encode(json.dumps([ record.created.strftime('%Y-%m-%d %H:%M:%S.%f'), record.id ]))
+
+def decode_list_cursor(cursor):
+  """ (created, id) of a Cursor made by encode_list_cursor. Raises ValueError when it is not one """
+  try:
+    created, record_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    return datetime.datetime.strptime(created, '%Y-%m-%d %H:%M:%S.%f'), record_id
+  except (TypeError, ValueError, UnicodeEncodeError):
+    raise ValueError('Invalid cursor')
+
+def get_keyset_page(query, created_column, id_column, page_size, offset, cursor=None, descending=True):
+  """ Orders the query by (created, id) and returns one page of it.
+
+  With a cursor, the page starts right after the record the cursor was made
+  from, so the database seeks it on the (..., created, id) indexes instead of
+  reading and skipping offset rows.
+  """
+  if cursor:
+    created, record_id = cursor
+    if descending:
+      query = query.filter( or_( created_column < created,
+                                 and_( created_column == created, id_column < record_id ) ) )
+    else:
+      query = query.filter( or_( created_column > created,
+                                 and_( created_column == created, id_column > record_id ) ) )
+
+  if descending:
+    query = query.order_by(created_column.desc(), id_column.desc())
+  else:
+    query = query.order_by(created_column, id_column)
+
+  if page_size:
+    query = query.limit(page_size)
+  if offset and not cursor:
+    query = query.offset(offset)
+
+  return query
+
 class Currency(Base):
   __tablename__   = 'currencies'
   code            = Column(String(4), primary_key=True)
@@ -161,6 +204,8 @@ class User(Base):
 
   email_lang       = Column(String, nullable=False)
 
+  __table_args__ = (Index('ix_users_broker_created', 'broker_id', 'created', 'id'), )
+
   def __repr__(self):
     return u"<User(id=%r, username=%r, email=%r,  broker_id=%r, broker_username=%r, "\
            u" password_algo=%r, password_salt=%r, password=%r,"\
@@ -221,7 +266,7 @@ class User(Base):
     return None
 
   @staticmethod
-  def get_list(session, broker_id, status_list, country = None, state=None, client_id=None,  page_size = None, offset = None, sort_column = None, sort_order='ASC'):
+  def get_list(session, broker_id, status_list, country = None, state=None, client_id=None,  page_size = None, offset = None, sort_column = None, sort_order='ASC', cursor=None):
     query = session.query(User).filter( User.verified.in_( status_list ) ).filter(User.broker_id==broker_id)
 
     if country:
@@ -230,18 +275,21 @@ class User(Base):
       query = query.filter(User.state == state)
 
     if client_id:
-      query = query.filter( or_( User.username.like(client_id), User.email.like('%' + client_id + '%'), User.verification_data.like( '%'  + client_id + '%') ) )
+      query = query.filter( or_( User.username.like(client_id),
+                                 SearchTerm.match(User.email, 'users.email', client_id),
+                                 SearchTerm.match(User.verification_data, 'users.verification_data', client_id) ) )
 
+    if not sort_column:
+      return get_keyset_page(query, User.created, User.id, page_size, offset, cursor, descending=False)
 
     if page_size:
       query = query.limit(page_size)
     if offset:
       query = query.offset(offset)
-    if sort_column:
-      if sort_order == 'ASC':
-        query = query.order(sort_column)
-      else:
-        query = query.order(sort_column).desc()
+    if sort_order == 'ASC':
+      query = query.order(sort_column)
+    else:
+      query = query.order(sort_column).desc()
     return query
 
   @staticmethod
@@ -265,7 +313,7 @@ class User(Base):
               email_lang          = broker.lang)
 
     session.add(u)
-    session.commit()
+    TradeApplication.instance().commit()
 
     UserEmail.create( session = session,
                       user_id = u.id,
@@ -515,6 +563,9 @@ class PositionLedger(Base):
   created               = Column(DateTime,      default=datetime.datetime.now, nullable=False)
   description           = Column(String(255))
 
+  __table_args__ = (Index('ix_position_ledger_broker_account_created', 'broker_id', 'account_id', 'created', 'id'),
+                    Index('ix_position_ledger_broker_created', 'broker_id', 'created', 'id'), )
+
   def __repr__(self):
     return u"<PositionLedger(id=%r, currency=%r, account_id=%r, broker_id=%r, payee_id=%r, payee_broker_id=%r,"\
            u"operation=%r,amount=%r,position=%r,reference=%r, created=%r,description=%r,"\
@@ -525,7 +576,7 @@ class PositionLedger(Base):
 
 
   @staticmethod
-  def get_list(session, broker_id, account_id, operation_list, page_size, offset, currency=None, filter_array=[]):
+  def get_list(session, broker_id, account_id, operation_list, page_size, offset, currency=None, filter_array=[], cursor=None):
     query = session.query(PositionLedger).filter( PositionLedger.operation.in_( operation_list ) ).filter(PositionLedger.broker_id==broker_id)
 
     if currency:
@@ -547,14 +598,7 @@ class PositionLedger(Base):
                                      PositionLedger.reference == filter
           ))
 
-    query = query.order_by(desc(PositionLedger.created))
-
-    if page_size:
-      query = query.limit(page_size)
-    if offset:
-      query = query.offset(offset)
-
-    return query
+    return get_keyset_page(query, PositionLedger.created, PositionLedger.id, page_size, offset, cursor)
 
   @staticmethod
   def transfer(session, from_account_id, from_account_name, from_broker_id, from_broker_name, to_account_id, to_account_name, to_broker_id, to_broker_name, currency, amount, reference=None, description=None):
@@ -605,6 +649,12 @@ class Balance(Base):
 
   __table_args__ = (UniqueConstraint('account_id', 'broker_id', 'currency', name='_balance_uc'), )
 
+  store = None  # BalanceStore, when the trade engine owns the balances
+  # several trade engines share the balances (sharded deployment). The rows are
+  # locked while a fill updates them, but nothing is reserved for the open orders:
+  # orders on two shards can both count on the same balance until they execute
+  lock_rows = False
+
   def __repr__(self):
     return u"<Balance(id=%r, account_id=%r, account_name=%r, broker_id=%r, broker_name=%r, currency=%r, balance=%r, last_update=%r)>" % (
       self.id, self.account_id, self.account_name,  self.broker_id, self.broker_name, self.currency, self.balance, self.last_update )
@@ -631,34 +681,57 @@ class Balance(Base):
   @staticmethod
   def get_balance(session, account_id, broker_id, currency ):
     currency  = currency.strip().upper()
-    balance_obj = session.query(Balance).filter_by(account_id = account_id ).filter_by(broker_id = broker_id ).filter_by(currency = currency).first()
+    if Balance.store is not None:
+      return Balance.store.get_balance(account_id, broker_id, currency)
+
+    query = session.query(Balance).filter_by(account_id = account_id ).filter_by(broker_id = broker_id ).filter_by(currency = currency)
+    if Balance.lock_rows:
+      query = query.with_for_update()
+    balance_obj = query.first()
     if not balance_obj:
       return 0
     return balance_obj.balance
 
+  @staticmethod
+  def get_available_balance(session, account_id, broker_id, currency ):
+    """ The balance minus the funds held by the open orders """
+    balance = Balance.get_balance(session, account_id, broker_id, currency)
+    if Balance.store is not None:
+      balance -= Balance.store.get_hold(account_id, broker_id, currency.strip().upper())
+    return balance
+
   @staticmethod
   def update_balance(session,operation, account_id, account_name, broker_id, broker_name, currency, value ):
     currency  = currency.strip().upper()
-    balance_obj = session.query(Balance).filter_by(account_id = account_id ).filter_by(broker_id = broker_id ).filter_by(currency = currency).first()
-    if not balance_obj:
-      balance_obj = Balance(account_id  = account_id,
-                            account_name = account_name,
-                            currency    = currency,
-                            broker_id   = broker_id,
-                            broker_name = broker_name,
-                            balance     = 0)
 
+    delta = 0
     if operation == 'CREDIT':
-      balance_obj.balance = balance_obj.balance + value
+      delta = value
     elif operation == 'DEBIT':
-      balance_obj.balance = balance_obj.balance - value
+      delta = -value
 
-    session.add(balance_obj)
+    if Balance.store is not None:
+      new_balance = Balance.store.update_balance(account_id, account_name, broker_id, broker_name, currency, delta)
+    else:
+      query = session.query(Balance).filter_by(account_id = account_id ).filter_by(broker_id = broker_id ).filter_by(currency = currency)
+      if Balance.lock_rows:
+        query = query.with_for_update()
+      balance_obj = query.first()
+      if not balance_obj:
+        balance_obj = Balance(account_id  = account_id,
+                              account_name = account_name,
+                              currency    = currency,
+                              broker_id   = broker_id,
+                              broker_name = broker_name,
+                              balance     = 0)
+      balance_obj.balance = balance_obj.balance + delta
+      session.add(balance_obj)
+      new_balance = balance_obj.balance
 
     balance_update_msg = dict()
     balance_update_msg['MsgType'] = 'U3'
     balance_update_msg['ClientID'] = account_id
-    balance_update_msg[broker_id] = { currency: balance_obj.balance }
+    balance_update_msg[broker_id] = { currency: new_balance }
     TradeApplication.instance().publish( account_id,  balance_update_msg  )
 
     try:
@@ -669,7 +742,174 @@ class Balance(Base):
           break
     except :
       pass
-    return balance_obj.balance
+    return new_balance
+
+
+class BalanceStore(object):
+  """ Authoritative in-process copy of the balances table for the trade engine.
+
+  Reads and updates happen in memory. Changed balances and the ledger records
+  are written back in batch when the session commits, and are reverted when
+  the session (or a savepoint) rolls back.
+
+  It also keeps the funds held by the open orders, which only live in memory and
+  are rebuilt from the books when the engine starts.
+  """
+
+  def __init__(self):
+    self.balances         = {}     # (account_id, broker_id, currency) -> balance
+    self.persisted        = set()  # keys that already have a row on the balances table
+    self.pending_balances = {}     # key -> (account_name, broker_name)
+    self.pending_ledgers  = []
+    self.holds            = {}     # (account_id, broker_id, currency) -> amount held by open orders
+    self.order_holds      = {}     # order_id -> amount held by the order
+    self.undo_log         = []     # (dictionary, key, value before the update)
+    self.savepoints       = {}     # nested transaction -> undo mark
+
+  def load(self, session):
+    self.balances = {}
+    self.persisted = set()
+    for balance_obj in session.query(Balance):
+      key = (balance_obj.account_id, balance_obj.broker_id, balance_obj.currency)
+      self.balances[key] = balance_obj.balance
+      self.persisted.add(key)
+
+  def get_balance(self, account_id, broker_id, currency):
+    return self.balances.get((account_id, broker_id, currency), 0)
+
+  def _set(self, dictionary, key, value):
+    self.undo_log.append( (dictionary, key, dictionary.get(key)) )
+    if value is None:
+      dictionary.pop(key, None)
+    else:
+      dictionary[key] = value
+
+  def update_balance(self, account_id, account_name, broker_id, broker_name, currency, delta):
+    key = (account_id, broker_id, currency)
+    self.pending_balances[key] = (account_name, broker_name)
+
+    new_balance = self.balances.get(key, 0) + delta
+    self._set(self.balances, key, new_balance)
+    return new_balance
+
+  def get_hold(self, account_id, broker_id, currency):
+    return self.holds.get((account_id, broker_id, currency), 0)
+
+  def clear_holds(self):
+    self.holds = {}
+    self.order_holds = {}
+
+  def hold_order(self, order):
+    """ Holds the funds needed by the open qty of the order, releasing what it no longer needs """
+    currency, amount = order.funds_to_hold
+    previous_amount = self.order_holds.get(order.id, 0)
+    if amount == previous_amount:
+      return
+
+    key = (order.account_id, order.broker_id, currency)
+    self._set(self.holds, key, (self.holds.get(key, 0) + amount - previous_amount) or None)
+    self._set(self.order_holds, order.id, amount or None)
+
+  def add_ledger(self, ledger):
+    self.pending_ledgers.append(ledger)
+
+  def flush(self, session):
+    if self.pending_balances:
+      now = datetime.datetime.now()
+      updates = []
+      inserts = []
+      for key, (account_name, broker_name) in self.pending_balances.iteritems():
+        if key not in self.balances:
+          continue # created and rolled back on a savepoint
+
+        account_id, broker_id, currency = key
+        if key in self.persisted:
+          updates.append({ 'b_account_id'   : account_id,
+                           'b_broker_id'    : broker_id,
+                           'b_currency'     : currency,
+                           'b_balance'      : self.balances[key],
+                           'b_last_update'  : now })
+        else:
+          inserts.append({ 'account_id'     : account_id,
+                           'account_name'   : account_name,
+                           'broker_id'      : broker_id,
+                           'broker_name'    : broker_name,
+                           'currency'       : currency,
+                           'balance'        : self.balances[key],
+                           'last_update'    : now })
+
+      balances_table = Balance.__table__
+      if updates:
+        session.execute(balances_table.update().
+                        where(balances_table.c.account_id == bindparam('b_account_id')).
+                        where(balances_table.c.broker_id == bindparam('b_broker_id')).
+                        where(balances_table.c.currency == bindparam('b_currency')).
+                        values(balance=bindparam('b_balance'), last_update=bindparam('b_last_update')),
+                        updates)
+      if inserts:
+        session.execute(balances_table.insert(), inserts)
+
+    if self.pending_ledgers:
+      columns = [ column.key for column in Ledger.__table__.columns if column.key != 'id' ]
+      session.execute(Ledger.__table__.insert(),
+                      [ dict((column, getattr(ledger, column)) for column in columns) for ledger in self.pending_ledgers ])
+      SearchTerm.add(session, 'ledger.description', [ ledger.description for ledger in self.pending_ledgers ])
+
+  def commit(self):
+    for key in self.pending_balances:
+      if key in self.balances:
+        self.persisted.add(key)
+    self.pending_balances = {}
+    self.pending_ledgers = []
+    self.undo_log = []
+    self.savepoints = {}
+
+  def rollback(self):
+    self.rollback_to( (0, 0) )
+    self.pending_balances = {}
+    self.savepoints = {}
+
+  def savepoint(self):
+    return len(self.undo_log), len(self.pending_ledgers)
+
+  def rollback_to(self, mark):
+    undo_log_size, ledgers_size = mark
+    while len(self.undo_log) > undo_log_size:
+      dictionary, key, value = self.undo_log.pop()
+      if value is None:
+        dictionary.pop(key, None)
+      else:
+        dictionary[key] = value
+    del self.pending_ledgers[ledgers_size:]
+
+  def bind(self, session_factory):
+    """ Follows the transactions of the sessions created by session_factory.
+    Savepoints (session.begin_nested) only write when the outer transaction commits """
+
+    def on_transaction_create(session, transaction):
+      if transaction.nested:
+        self.savepoints[transaction] = self.savepoint()
+
+    def on_before_commit(session):
+      if not session.transaction.nested:
+        self.flush(session)
+
+    def on_after_commit(session):
+      if session.transaction.nested:
+        self.savepoints.pop(session.transaction, None)
+      else:
+        self.commit()
+
+    def on_rollback(session, previous_transaction):
+      if not previous_transaction.nested:
+        self.rollback()
+      elif previous_transaction in self.savepoints:
+        self.rollback_to( self.savepoints.pop(previous_transaction) )
+
+    event.listen(session_factory, 'after_transaction_create', on_transaction_create)
+    event.listen(session_factory, 'before_commit', on_before_commit)
+    event.listen(session_factory, 'after_commit', on_after_commit)
+    event.listen(session_factory, 'after_soft_rollback', on_rollback)
 
 class Ledger(Base):
   __tablename__         = 'ledger'
@@ -690,6 +930,9 @@ class Ledger(Base):
   created               = Column(DateTime,      default=datetime.datetime.now, nullable=False)
   description           = Column(String(255),   index=True)
 
+  __table_args__ = (Index('ix_ledger_broker_account_created', 'broker_id', 'account_id', 'created', 'id'),
+                    Index('ix_ledger_broker_created', 'broker_id', 'created', 'id'), )
+
   def __repr__(self):
     return u"<Ledger(id=%r, currency=%r, account_id=%r, broker_id=%r, payee_id=%r, payee_broker_id=%r," \
                     u"operation=%r,amount=%r,balance=%r,reference=%r, created=%r,description=%r," \
@@ -700,7 +943,7 @@ class Ledger(Base):
 
 
   @staticmethod
-  def get_list(session, broker_id, account_id, operation_list, page_size, offset, currency=None, filter_array=[]):
+  def get_list(session, broker_id, account_id, operation_list, page_size, offset, currency=None, filter_array=[], cursor=None):
     query = session.query(Ledger).filter( Ledger.operation.in_( operation_list ) ).filter(Ledger.broker_id==broker_id)
 
     if currency:
@@ -712,7 +955,7 @@ class Ledger(Base):
     for filter in filter_array:
       if filter:
         if filter.isdigit():
-          query = query.filter( or_( Ledger.description.like('%' + filter + '%' ),
+          query = query.filter( or_( SearchTerm.match(Ledger.description, 'ledger.description', filter),
                                      Ledger.payee_name == filter,
                                      Ledger.account_name == filter,
                                      Ledger.broker_name == filter,
@@ -721,21 +964,24 @@ class Ledger(Base):
                                      Ledger.balance == int(filter)
                                      ))
         else:
-          query = query.filter( or_( Ledger.description.like('%' + filter + '%' ),
+          query = query.filter( or_( SearchTerm.match(Ledger.description, 'ledger.description', filter),
                                      Ledger.payee_name == filter,
                                      Ledger.account_name == filter,
                                      Ledger.broker_name == filter,
                                      Ledger.reference == filter
                                      ))
 
-    query = query.order_by(desc(Ledger.created))
+    return get_keyset_page(query, Ledger.created, Ledger.id, page_size, offset, cursor)
 
-    if page_size:
-      query = query.limit(page_size)
-    if offset:
-      query = query.offset(offset)
+  @staticmethod
+  def add(session, ledger):
+    if Balance.store is None:
+      session.add(ledger)
+      return
 
-    return query
+    if ledger.created is None:
+      ledger.created = datetime.datetime.now()
+    Balance.store.add_ledger(ledger)
 
   @staticmethod
   def transfer(session, from_account_id, from_account_name, from_broker_id, from_broker_name, to_account_id, to_account_name, to_broker_id, to_broker_name, currency, amount, reference=None, description=None):
@@ -754,7 +1000,7 @@ class Ledger(Base):
                     balance           = balance,
                     reference         = reference,
                     description       = description)
-    session.add(ledger)
+    Ledger.add(session, ledger)
 
     balance = Balance.update_balance(session, 'CREDIT', to_account_id, to_account_name, to_broker_id, to_broker_name, currency, amount)
     ledger = Ledger( currency         = currency,
@@ -771,7 +1017,7 @@ class Ledger(Base):
                      balance          = balance,
                      reference        = reference,
                      description      = description )
-    session.add(ledger)
+    Ledger.add(session, ledger)
 
 
   @staticmethod
@@ -791,7 +1037,7 @@ class Ledger(Base):
                      balance          = balance,
                      reference        = reference,
                      description      = description )
-    session.add(ledger)
+    Ledger.add(session, ledger)
 
 
   @staticmethod
@@ -811,7 +1057,7 @@ class Ledger(Base):
                      balance          = balance,
                      reference        = reference,
                      description      = description )
-    session.add(ledger)
+    Ledger.add(session, ledger)
 
 
   @staticmethod
@@ -837,7 +1083,7 @@ class Ledger(Base):
                                  balance          = balance,
                                  reference        = trade_id,
                                  description      = 'T')
-    session.add(order_record_debit)
+    Ledger.add(session, order_record_debit)
 
 
     balance = Balance.update_balance(session, 'CREDIT' if order.is_buy else 'DEBIT', counter_order.account_id, counter_order.account_username, counter_order.broker_id, counter_order.broker_username, from_symbol, total_value )
@@ -855,7 +1101,7 @@ class Ledger(Base):
                                          balance      = balance,
                                          reference    = trade_id,
                                          description  = 'T')
-    session.add(counter_order_record_credit)
+    Ledger.add(session, counter_order_record_credit)
 
 
     balance = Balance.update_balance(session, 'CREDIT' if order.is_buy else 'DEBIT', order.account_id, order.account_username, order.broker_id, order.broker_username, to_symbol, qty )
@@ -873,7 +1119,7 @@ class Ledger(Base):
                                  balance      = balance,
                                  reference    = trade_id,
                                  description  = 'T')
-    session.add(order_record_credit)
+    Ledger.add(session, order_record_credit)
 
     balance = Balance.update_balance(session, 'DEBIT' if order.is_buy else 'CREDIT', counter_order.account_id, counter_order.account_username, counter_order.broker_id, counter_order.broker_username, to_symbol, qty )
     counter_order_record_debit = Ledger(currency     = to_symbol,
@@ -890,7 +1136,7 @@ class Ledger(Base):
                                         balance      = balance,
                                         reference    = trade_id,
                                         description  = 'T')
-    session.add(counter_order_record_debit)
+    Ledger.add(session, counter_order_record_debit)
 
     def process_execution_fee(session,trade_id, order, currency, amount ):
       Ledger.transfer(session,
@@ -1295,6 +1541,9 @@ class Withdraw(Base):
   fixed_fee       = Column(Integer,    nullable=False, default=0)
   paid_amount     = Column(Integer,    nullable=False, default=0, index=True)
 
+  __table_args__ = (Index('ix_withdraws_broker_account_created', 'broker_id', 'account_id', 'created', 'id'),
+                    Index('ix_withdraws_broker_created', 'broker_id', 'created', 'id'), )
+
   def as_dict(self):
     import json
     obj = { c.name: getattr(self, c.name) for c in self.__table__.columns }
@@ -1326,7 +1575,7 @@ class Withdraw(Base):
     self.paid_amount = self.amount + total_fees
 
 
-    current_balance = Balance.get_balance(session, self.account_id, self.broker_id, self.currency)
+    current_balance = Balance.get_available_balance(session, self.account_id, self.broker_id, self.currency)
     if self.paid_amount > current_balance:
       self.cancel(session, -1 ) # Insufficient funds
       return True
@@ -1457,7 +1706,7 @@ class Withdraw(Base):
 
 
   @staticmethod
-  def get_list(session, broker_id, account_id, status_list, page_size, offset, filter_array) :
+  def get_list(session, broker_id, account_id, status_list, page_size, offset, filter_array, cursor=None) :
     query = session.query(Withdraw).filter( Withdraw.status.in_( status_list ) ).filter(Withdraw.broker_id==broker_id)
 
     if account_id:
@@ -1466,22 +1715,15 @@ class Withdraw(Base):
     for filter in filter_array:
       if filter:
         if filter.isdigit():
-          query = query.filter( or_( Withdraw.data.like('%' + filter + '%' ),
+          query = query.filter( or_( SearchTerm.match(Withdraw.data, 'withdraws.data', filter),
                                      Withdraw.currency == filter,
                                      Withdraw.amount == int(filter) * 1e8,
                                      ))
         else:
-          query = query.filter( or_( Withdraw.data.like('%' + filter + '%'),
+          query = query.filter( or_( SearchTerm.match(Withdraw.data, 'withdraws.data', filter),
                                      Withdraw.currency == filter ) )
 
-    query = query.order_by(Withdraw.created.desc())
-
-    if page_size:
-      query = query.limit(page_size)
-    if offset:
-      query = query.offset(offset)
-
-    return query
+    return get_keyset_page(query, Withdraw.created, Withdraw.id, page_size, offset, cursor)
 
   @staticmethod
   def create(session, user, broker,  currency, amount, method, data, client_order_id, email_lang):
@@ -1701,8 +1943,8 @@ class Order(Base):
 
   def get_available_qty_to_execute(self, session, side, qty, price):
     """This function returns qty that are available for execution"""
-    balance_price =  Balance.get_balance(session, self.account_id, self.broker_id, self.symbol[3:])
-    balance_qty   =  Balance.get_balance(session, self.account_id, self.broker_id, self.symbol[:3])
+    balance_price =  Balance.get_available_balance(session, self.account_id, self.broker_id, self.symbol[3:])
+    balance_qty   =  Balance.get_available_balance(session, self.account_id, self.broker_id, self.symbol[:3])
 
     if side == '1' : # buy
       qty_to_buy = min( qty, int((float(balance_price)/float(price)) * 1e8))
@@ -1740,6 +1982,22 @@ class Order(Base):
     self.last_qty = qty
     self._adjust_status()
 
+  @property
+  def funds_to_hold(self):
+    """ (currency, amount) the open qty of the order needs. The fees are charged on
+    the currency each side receives (see Ledger.execute_order), so they are not held.
+    Market buy orders have no price, so they hold nothing and have their funds
+    checked on execution """
+    if self.is_buy:
+      if self.type == '1':
+        return self.symbol[3:], 0
+      return self.symbol[3:], int(self.price) * int(self.leaves_qty) // 100000000
+    return self.symbol[:3], self.leaves_qty
+
+  @property
+  def has_funds_held(self):
+    return Balance.store is not None and not (self.is_buy and self.type == '1')
+
   @property
   def is_cancelled(self):
     return self.status == '4'
@@ -1803,6 +2061,11 @@ class Trade(Base):
     return trade
 
 
+  @staticmethod
+  def get_trades_since(session, since_trade_id, page_size):
+    """ The trades after since_trade_id, oldest first. Walks the primary key instead of using an OFFSET """
+    return session.query(Trade).filter(Trade.id > since_trade_id).order_by(Trade.id).limit(page_size)
+
   @staticmethod
   def get_last_trades(session, page_size = None, offset = None, sort_column = None, sort_order='ASC'):
 
@@ -1854,6 +2117,9 @@ class Deposit(Base):
   reason                  = Column(String)
   email_lang              = Column(String,     nullable=False)
 
+  __table_args__ = (Index('ix_deposit_broker_account_created', 'broker_id', 'account_id', 'created', 'id'),
+                    Index('ix_deposit_broker_created', 'broker_id', 'created', 'id'), )
+
   def __repr__(self):
     return u"<Deposit(id=%r, user_id=%r, account_id=%r, broker_id=%r, deposit_option_id=%r, "\
            u"deposit_option_name=%r, username=%r, broker_username=%r,  broker_deposit_ctrl_num=%r,"\
@@ -1904,7 +2170,7 @@ class Deposit(Base):
     return deposit
 
   @staticmethod
-  def get_list(session, broker_id, account_id, status_list, page_size, offset, filter_array=[]):
+  def get_list(session, broker_id, account_id, status_list, page_size, offset, filter_array=[], cursor=None):
     query = session.query(Deposit).filter( Deposit.status.in_( status_list ) ).filter(Deposit.broker_id==broker_id)
 
     if account_id:
@@ -1913,7 +2179,7 @@ class Deposit(Base):
     if filter_array:
       for filter in filter_array:
         if filter.isdigit():
-          query = query.filter( or_( Deposit.data.like('%' + filter + '%' ),
+          query = query.filter( or_( SearchTerm.match(Deposit.data, 'deposit.data', filter),
                                      Deposit.currency == filter,
                                      Deposit.deposit_option_name == filter,
                                      Deposit.value == int(filter) * 1e8,
@@ -1921,19 +2187,11 @@ class Deposit(Base):
                                      Deposit.broker_deposit_ctrl_num == int(filter),
                                      ))
         else:
-          query = query.filter( or_( Deposit.data.like('%' + filter + '%'),
+          query = query.filter( or_( SearchTerm.match(Deposit.data, 'deposit.data', filter),
                                      Deposit.currency == filter,
                                      Deposit.deposit_option_name == filter ) )
 
-    query = query.order_by(Deposit.created.desc())
-
-    if page_size:
-      query = query.limit(page_size)
-    if offset:
-      query = query.offset(offset)
-
-
-    return query
+    return get_keyset_page(query, Deposit.created, Deposit.id, page_size, offset, cursor)
 
 
   @staticmethod
@@ -2364,5 +2622,176 @@ class DepositMethods(Base):
     return deposit
 
 
+def get_search_trigrams(text):
+  """ lower case trigrams of text without accents. The LIKE wildcards % and _ split it """
+  if not isinstance(text, unicode):
+    text = text.decode('utf-8', 'replace')
+  text = u''.join( c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c) ).lower()
+
+  trigrams = set()
+  for part in text.replace(u'_', u'%').split(u'%'):
+    for x in xrange(len(part) - 2):
+      trigrams.add(part[x:x+3])
+  return trigrams
+
+class SearchTerm(Base):
+  """ The distinct values of the text columns the back office searches with
+  like('%' + filter + '%'), indexed by their trigrams on search_trigram.
+
+  A search finds the values that have every trigram of the filter, and then
+  the records holding one of them on the index of the column, instead of
+  scanning the whole table with a leading wildcard LIKE. The values are
+  indexed when the records are written and are never removed; a value no
+  record holds anymore just matches nothing.
+
+  The fields of SEARCH_RECORD_FIELDS are rewritten on every change of their
+  record, so they are indexed once per record instead, and the term of the
+  previous value is removed when the record changes.
+  """
+  __tablename__   = 'search_term'
+  id              = Column(Integer,     primary_key=True)
+  field           = Column(String(30),  nullable=False)
+  digest          = Column(String(40),  nullable=False, unique=True)
+  value           = Column(Text,        nullable=False)
+
+  concurrent_writers = False  # other processes index values on the same database
+
+  @staticmethod
+  def get_digest(field, value, record_id=None):
+    if record_id is not None:
+      field += '\0' + str(record_id)
+    return hashlib.sha1(field + '\0' + smart_str(value)).hexdigest()
+
+  @staticmethod
+  def add(connection, field, values, record_ids=None):
+    """ Indexes the values of field that are not indexed yet. connection is a session or a connection.
+    record_ids are the ids of the records holding the values, for the fields of SEARCH_RECORD_FIELDS """
+    if record_ids is None:
+      record_ids = [ None ] * len(values)
+    values = dict( (SearchTerm.get_digest(field, value, record_id), value) for value, record_id in zip(values, record_ids) if value )
+    if not values:
+      return
+
+    term_table = SearchTerm.__table__
+    digests = values.keys()
+    for x in xrange(0, len(digests), 500):
+      query = select([term_table.c.digest]).where(term_table.c.digest.in_(digests[x:x+500]))
+      for row in connection.execute(query):
+        del values[row.digest]
+
+    trigrams = []
+    for digest, value in values.iteritems():
+      term_id = SearchTerm._insert(connection, { 'field': field, 'digest': digest, 'value': value })
+      if term_id is None:
+        continue
+      for trigram in get_search_trigrams(value):
+        trigrams.append({ 'field': field, 'trigram': trigram, 'term_id': term_id })
+    if trigrams:
+      connection.execute(SearchTrigram.__table__.insert(), trigrams)
+
+  @staticmethod
+  def _insert(connection, term):
+    if not SearchTerm.concurrent_writers:
+      return connection.execute(SearchTerm.__table__.insert(), term).inserted_primary_key[0]
+
+    # another process writing to the database may be indexing the same value.
+    # Its term is as good as ours
+    savepoint = connection.begin_nested()
+    try:
+      term_id = connection.execute(SearchTerm.__table__.insert(), term).inserted_primary_key[0]
+    except IntegrityError:
+      savepoint.rollback()
+      return None
+    savepoint.commit()
+    return term_id
+
+  @staticmethod
+  def remove(connection, field, value, record_id):
+    """ Drops the term of a value the record of a SEARCH_RECORD_FIELDS field no longer holds """
+    if not value:
+      return
+    term_table = SearchTerm.__table__
+    trigram_table = SearchTrigram.__table__
+    digest = SearchTerm.get_digest(field, value, record_id)
+    for row in connection.execute(select([term_table.c.id]).where(term_table.c.digest == digest)):
+      trigrams = get_search_trigrams(value)
+      if trigrams:
+        connection.execute(trigram_table.delete().\
+          where(trigram_table.c.field == field).\
+          where(trigram_table.c.trigram.in_(trigrams)).\
+          where(trigram_table.c.term_id == row.id))
+      connection.execute(term_table.delete().where(term_table.c.id == row.id))
+
+  @staticmethod
+  def match(column, field, filter):
+    """ Condition of the records which column contains filter, same as column.like('%' + filter + '%') """
+    like = '%' + filter + '%'
+    trigrams = get_search_trigrams(filter)
+    if not trigrams:
+      return column.like(like)
+
+    term_ids = select([SearchTrigram.term_id]).\
+      where(SearchTrigram.field == field).\
+      where(SearchTrigram.trigram.in_(trigrams)).\
+      group_by(SearchTrigram.term_id).\
+      having(func.count(SearchTrigram.trigram) == len(trigrams))
+
+    return column.in_( select([SearchTerm.value]).where(SearchTerm.id.in_(term_ids)).where(SearchTerm.value.like(like)) )
+
+  @staticmethod
+  def build(session):
+    """ Indexes the values already on the database the first time a field is searchable """
+    for (entity, attribute), field in SEARCH_FIELDS.iteritems():
+      if session.query(SearchTerm.id).filter(SearchTerm.field == field).first() is None:
+        column = getattr(entity, attribute)
+        if field in SEARCH_RECORD_FIELDS:
+          rows = session.query(column, entity.id).all()
+          SearchTerm.add(session, field, [ row[0] for row in rows ], [ row[1] for row in rows ])
+        else:
+          SearchTerm.add(session, field, [ row[0] for row in session.query(column).distinct() ])
+    session.commit()
+
+class SearchTrigram(Base):
+  __tablename__   = 'search_trigram'
+  field           = Column(String(30),  primary_key=True)
+  trigram         = Column(Unicode(3),  primary_key=True)
+  term_id         = Column(Integer,     ForeignKey('search_term.id'), primary_key=True)
+
+# (entity, attribute) -> field of the search index
+SEARCH_FIELDS = {
+  (User, 'email')             : 'users.email',
+  (User, 'verification_data') : 'users.verification_data',
+  (Ledger, 'description')     : 'ledger.description',
+  (Deposit, 'data')           : 'deposit.data',
+  (Withdraw, 'data')          : 'withdraws.data',
+}
+
+# fields rewritten on every status change of their record, see SearchTerm
+SEARCH_RECORD_FIELDS = set([ 'deposit.data', 'withdraws.data' ])
+
+def _index_search_fields(entity, attributes):
+  def on_insert(mapper, connection, target):
+    for attribute, field in attributes:
+      record_id = target.id if field in SEARCH_RECORD_FIELDS else None
+      SearchTerm.add(connection, field, [ getattr(target, attribute) ], [ record_id ])
+
+  def on_update(mapper, connection, target):
+    for attribute, field in attributes:
+      history = get_history(target, attribute)
+      if history.has_changes():
+        record_id = None
+        if field in SEARCH_RECORD_FIELDS:
+          record_id = target.id
+          for value in history.deleted:
+            SearchTerm.remove(connection, field, value, record_id)
+        SearchTerm.add(connection, field, [ getattr(target, attribute) ], [ record_id ])
+
+  event.listen(entity, 'after_insert', on_insert)
+  event.listen(entity, 'after_update', on_update)
+
+for entity in set( entity for entity, attribute in SEARCH_FIELDS ):
+  _index_search_fields(entity, [ (attribute, field) for (e, attribute), field in SEARCH_FIELDS.iteritems() if e is entity ])
+
+
 def db_bootstrap(session):
-  pass
+  SearchTerm.build(session)
@@ -0,0 +1,345 @@
+__author__ = 'rodrigo'
+
+import random
+
+class PriceLevel(object):
+  """ FIFO queue of the orders resting at a single price.
+
+  Every order takes the next slot of the level, and a Fenwick tree over the
+  slots counts the orders still resting. Finding the rank of an order inside
+  the level and removing it are O(log n). Removed orders leave an empty slot
+  behind, and the slots are compacted once most of them are empty.
+  """
+  __slots__ = ('key', 'price', 'is_hidden', 'orders', 'sequences', 'slots', 'tree', 'head')
+
+  def __init__(self, key, price, is_hidden=False):
+    self.key        = key
+    self.price      = price
+    self.is_hidden  = is_hidden  # market orders never show up in the market data
+    self.orders     = []         # slot -> order, None once it left the level
+    self.sequences  = []         # slot -> book sequence of the order
+    self.slots      = {}         # order id -> slot
+    self.tree       = [0]        # Fenwick tree over the slots, 1-based
+    self.head       = 0          # no order rests before this slot
+
+  def __len__(self):
+    return len(self.slots)
+
+  def __iter__(self):
+    orders = self.orders
+    for slot in xrange(self.head, len(orders)):
+      if orders[slot] is not None:
+        yield orders[slot]
+
+  def entries(self):
+    """ Yields (order, sequence) in priority order """
+    orders = self.orders
+    for slot in xrange(self.head, len(orders)):
+      if orders[slot] is not None:
+        yield orders[slot], self.sequences[slot]
+
+  @property
+  def visible_count(self):
+    if self.is_hidden:
+      return 0
+    return len(self.slots)
+
+  def _count_before(self, slot):
+    tree = self.tree
+    count = 0
+    while slot > 0:
+      count += tree[slot]
+      slot -= slot & -slot
+    return count
+
+  def append(self, sequence, order):
+    slot = len(self.orders)
+    self.orders.append(order)
+    self.sequences.append(sequence)
+    self.slots[order.id] = slot
+
+    # the new node of the tree covers the slots (i - lowbit(i), i]
+    i = slot + 1
+    self.tree.append(1 + self._count_before(i - 1) - self._count_before(i - (i & -i)))
+
+  def get(self, order_id):
+    return self.orders[self.slots[order_id]]
+
+  def rank(self, order_id):
+    """ Number of orders ahead of order_id on this level """
+    return self._count_before(self.slots[order_id])
+
+  def remove(self, order_id):
+    slot = self.slots.pop(order_id)
+    order = self.orders[slot]
+    self.orders[slot] = None
+
+    tree = self.tree
+    i = slot + 1
+    while i < len(tree):
+      tree[i] -= 1
+      i += i & -i
+
+    while self.head < len(self.orders) and self.orders[self.head] is None:
+      self.head += 1
+    if len(self.orders) > 64 and len(self.orders) > 2 * len(self.slots):
+      self._compact()
+    return order
+
+  def _compact(self):
+    entries = list(self.entries())
+    self.orders     = [ order for order, sequence in entries ]
+    self.sequences  = [ sequence for order, sequence in entries ]
+    self.slots      = dict( (order.id, slot) for slot, order in enumerate(self.orders) )
+    self.head       = 0
+
+    tree = [0] + [1] * len(entries)
+    for i in xrange(1, len(tree)):
+      parent = i + (i & -i)
+      if parent < len(tree):
+        tree[parent] += tree[i]
+    self.tree = tree
+
+  def front(self):
+    return self.orders[self.head]
+
+  def pop_front(self):
+    return self.remove(self.orders[self.head].id)
+
+
+class _LadderNode(object):
+  __slots__ = ('level', 'priority', 'left', 'right', 'total')
+
+  def __init__(self, level):
+    self.level    = level
+    self.priority = random.random()
+    self.left     = None
+    self.right    = None
+    self.total    = level.visible_count  # visible orders of the subtree
+
+  def update(self):
+    self.total = self.level.visible_count
+    if self.left is not None:
+      self.total += self.left.total
+    if self.right is not None:
+      self.total += self.right.total
+
+
+def _split(node, key):
+  """ Splits the treap into the levels before key and the ones from key on """
+  if node is None:
+    return None, None
+  if node.level.key < key:
+    node.right, right = _split(node.right, key)
+    node.update()
+    return node, right
+  left, node.left = _split(node.left, key)
+  node.update()
+  return left, node
+
+def _merge(left, right):
+  if left is None:
+    return right
+  if right is None:
+    return left
+  if left.priority > right.priority:
+    left.right = _merge(left.right, right)
+    left.update()
+    return left
+  right.left = _merge(left, right.left)
+  right.update()
+  return right
+
+def _delete(node, key):
+  if node.level.key == key:
+    return _merge(node.left, node.right)
+  if key < node.level.key:
+    node.left = _delete(node.left, key)
+  else:
+    node.right = _delete(node.right, key)
+  node.update()
+  return node
+
+
+class PriceLadder(object):
+  """ The price levels of one side, sorted by key on a treap.
+
+  Each node also counts the visible orders of its subtree, so finding a level,
+  adding or dropping one and counting the visible orders ahead of it are all
+  O(log P) on the number of price levels.
+  """
+
+  def __init__(self):
+    self.root = None
+
+  def __nonzero__(self):
+    return self.root is not None
+
+  def __iter__(self):
+    stack = []
+    node = self.root
+    while stack or node is not None:
+      if node is not None:
+        stack.append(node)
+        node = node.left
+      else:
+        node = stack.pop()
+        yield node.level
+        node = node.right
+
+  def get(self, key):
+    node = self.root
+    while node is not None:
+      if key == node.level.key:
+        return node.level
+      node = node.left if key < node.level.key else node.right
+    return None
+
+  def first(self):
+    node = self.root
+    if node is None:
+      return None
+    while node.left is not None:
+      node = node.left
+    return node.level
+
+  def insert(self, level):
+    left, right = _split(self.root, level.key)
+    self.root = _merge(_merge(left, _LadderNode(level)), right)
+
+  def remove(self, key):
+    self.root = _delete(self.root, key)
+
+  def add_visible(self, key, delta):
+    """ Tells the ladder that the level of key gained delta visible orders """
+    node = self.root
+    while node is not None:
+      node.total += delta
+      if key == node.level.key:
+        return
+      node = node.left if key < node.level.key else node.right
+
+  def count_before(self, key):
+    """ Visible orders on the levels before key """
+    count = 0
+    node = self.root
+    while node is not None:
+      if node.level.key < key:
+        count += node.total
+        if node.right is not None:
+          count -= node.right.total
+        node = node.right
+      else:
+        node = node.left
+    return count
+
+
+class OrderBookSide(object):
+  """ One side of the order book: a PriceLadder of FIFO price levels plus an
+  order id -> level index.
+
+  Inserting and cancelling an order, including the position it had, are
+  O(log P + log n) for P price levels and n orders on the level. Positions
+  returned by insert and remove are 0-based and only count the orders that
+  are published on the market data (limit orders), so they can be used
+  directly as MDEntryPositionNo - 1.
+  """
+
+  def __init__(self, is_buy):
+    self.is_buy       = is_buy
+    self.ladder       = PriceLadder()
+    self.index        = {}
+    self.sequence     = 0
+
+  def __len__(self):
+    return len(self.index)
+
+  def __nonzero__(self):
+    return bool(self.index)
+
+  def __contains__(self, order_id):
+    return order_id in self.index
+
+  def __iter__(self):
+    for level in self.ladder:
+      for order in level:
+        yield order
+
+  def entries(self):
+    """ Yields (order, sequence) in priority order """
+    for level in self.ladder:
+      for entry in level.entries():
+        yield entry
+
+  def _level_key(self, order):
+    if order.type == '1':  # Market orders have priority over any price
+      return 0, 0
+    if self.is_buy:
+      return 1, -order.price
+    return 1, order.price
+
+  def get(self, order_id):
+    level = self.index.get(order_id)
+    if level is None:
+      return None
+    return level.get(order_id)
+
+  def front(self):
+    level = self.ladder.first()
+    if level is None:
+      return None
+    return level.front()
+
+  def insert(self, order, sequence=None):
+    """ Inserts the order and returns its position. sequence is only given when
+    restoring a book, in the order entries() returned them """
+    if sequence is None:
+      self.sequence += 1
+      sequence = self.sequence
+    else:
+      self.sequence = max(self.sequence, sequence)
+
+    key = self._level_key(order)
+    level = self.ladder.get(key)
+    if level is None:
+      level = PriceLevel(key, order.price, is_hidden=(order.type == '1'))
+      self.ladder.insert(level)
+
+    level.append(sequence, order)
+    self.index[order.id] = level
+    if not level.is_hidden:
+      self.ladder.add_visible(key, 1)
+
+    return self.ladder.count_before(key) + level.rank(order.id)
+
+  def remove(self, order_id):
+    """ Removes the order from the book and returns the position it had, or None
+    if the order was not published on the market data """
+    level = self.index.pop(order_id)
+    position = None
+    if not level.is_hidden:
+      position = self.ladder.count_before(level.key) + level.rank(order_id)
+
+    level.remove(order_id)
+    self._level_changed(level)
+    return position
+
+  def _level_changed(self, level):
+    if not level.is_hidden:
+      self.ladder.add_visible(level.key, -1)
+    if not level:
+      self.ladder.remove(level.key)
+
+  def pop_front(self, count):
+    """ Removes the first count orders of the book and returns how many of them
+    were published on the market data """
+    visible_removed = 0
+    while count and self.ladder:
+      level = self.ladder.first()
+      order = level.pop_front()
+      del self.index[order.id]
+      if not level.is_hidden:
+        visible_removed += 1
+      self._level_changed(level)
+      count -= 1
+    return visible_removed
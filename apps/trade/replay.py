@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import os
+import sys
+import ConfigParser
+import argparse
+from appdirs import site_config_dir
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps'))
+
+from pyblinktrade.project_options import ProjectOptions
+from trade_application import TradeApplication
+
+class ReplayOptions(object):
+  """ The instance options, with the sockets, the database and the logs pointing
+  away from the production ones """
+  def __init__(self, options, **overrides):
+    self.options = options
+    self.overrides = overrides
+
+  def __getattr__(self, name):
+    if name in self.overrides:
+      return self.overrides[name]
+    return getattr(self.options, name)
+
+def main():
+  parser = argparse.ArgumentParser(description="Blinktrade Trade journal replay")
+  parser.add_argument('-i', "--instance", action="store", dest="instance", help='Instance name', type=str)
+  parser.add_argument('-c', "--config", action="store", dest="config", default=os.path.expanduser('~/.bitex/bitex.ini'), help='Configuration file', type=str)
+  parser.add_argument('-e', "--db_engine", action="store", dest="db_engine", help='Database to replay on. Must be a copy of the instance database', type=str)
+  parser.add_argument('-j', "--journal", action="store", dest="journal", help='Journal file. Defaults to the instance trade_journal', type=str)
+  parser.add_argument('-s', "--from_sequence", action="store", dest="from_sequence", default=None, help='Replay the records after this sequence, matching the open orders of the database again. Defaults to the JournalSequence of the snapshot', type=int)
+  parser.add_argument('-S', "--snapshot", action="store", dest="snapshot", help='Book snapshot to start from. Defaults to the instance trade_snapshot', type=str)
+  arguments = parser.parse_args()
+
+  if not arguments.instance or not arguments.db_engine:
+    parser.print_help()
+    return
+
+  candidates = [ os.path.join(ROOT_PATH, 'config/bitex.ini'),
+                 os.path.join(site_config_dir('bitex'), 'bitex.ini'),
+                 arguments.config]
+  config = ConfigParser.SafeConfigParser()
+  config.read( candidates )
+
+  options = ProjectOptions(config, arguments.instance)
+
+  journal_filename = arguments.journal or options.trade_journal
+  if not journal_filename:
+    raise RuntimeError("Invalid configuration file")
+
+  replay_options = ReplayOptions(options,
+                                 db_engine=arguments.db_engine,
+                                 trade_in='inproc://replay_in',
+                                 trade_pub='inproc://replay_pub',
+                                 trade_log=journal_filename + '.replay.log',
+                                 trade_journal=None,
+                                 trade_snapshot=arguments.snapshot or options.trade_snapshot,  # only read
+                                 group_commit_size=0,
+                                 session_timeout_limit=0)
+
+  application = TradeApplication.instance()
+  application.initialize(replay_options, arguments.instance)
+  application.replay(journal_filename, arguments.from_sequence)
+
+if __name__ == "__main__":
+  main()
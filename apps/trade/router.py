@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import logging
+import logging.handlers
+import ConfigParser
+import argparse
+from appdirs import site_config_dir
+
+import zmq
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps'))
+
+from pyblinktrade.project_options import ProjectOptions
+
+DROP_REPLY = 'DROP'
+
+class TradeRouter(object):
+  """ Front end of a sharded trade engine deployment.
+
+  Gateways connect to the router exactly as they would connect to a single trade
+  engine. Every matching engine (shard) owns the books of some instruments, and a
+  coordinator engine, which owns no book, serves the account level requests.
+
+    * NewOrderSingle, OrderCancelRequest with a Symbol and MarketDataRequest go
+      to the shard that owns the symbol.
+    * OPN, CLS and OrderCancelRequest without a Symbol are sent to every engine,
+      so they all know the session. The coordinator answers them.
+    * Logins and signups only go to the coordinator. When it logs the session in,
+      the router hands the session over to the shards with a USR message carrying
+      the user id, so passwords never reach the shards nor stay in the router.
+    * Every other request goes to the coordinator.
+    * When the engine that answered a request closes the session (CLS or ERR
+      replies), the session is closed on the other engines as well.
+
+  Requests to the same engine keep their order, so a request always reaches a
+  shard after the login of its session. The engines share the database; the
+  balances are locked on it while a fill updates them, see Balance.lock_rows.
+  There is no BalanceStore in this mode, and no reservation of funds for the
+  open orders across shards: orders resting on two shards can count on the same
+  balance, and the one that executes last is cut down to what is left.
+
+  The publications of all the engines are forwarded through trade_pub.
+  """
+
+  def __init__(self, options, instance_name):
+    self.options = options
+    self.instance_name = instance_name
+
+    self.context = zmq.Context()
+
+    self.frontend = self.context.socket(zmq.ROUTER)
+    self.frontend.bind(self.options.trade_in)
+
+    self.publisher = self.context.socket(zmq.XPUB)
+    self.publisher.bind(self.options.trade_pub)
+
+    self.subscriber = self.context.socket(zmq.XSUB)
+
+    coordinator_in, coordinator_pub = self.options.trade_router_coordinator.split()
+    self.coordinator = self._connect_engine(coordinator_in, coordinator_pub)
+
+    self.shards = {}  # symbol -> socket
+    self.shard_list = []
+    for shard in self.options.trade_router_shards.split(';'):
+      symbols, shard_in, shard_pub = shard.split()
+      socket = self._connect_engine(shard_in, shard_pub)
+      self.shard_list.append(socket)
+      for symbol in symbols.split(','):
+        self.shards[symbol] = socket
+
+    self.backends = [ self.coordinator ] + self.shard_list
+
+    self.pending_logins = set()  # sessions waiting for the coordinator to log them in
+
+    input_log_file_handler = logging.handlers.TimedRotatingFileHandler( self.options.trade_log, when='MIDNIGHT')
+    input_log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    self.logger = logging.getLogger(self.instance_name)
+    self.logger.setLevel(logging.INFO)
+    self.logger.addHandler(input_log_file_handler)
+    self.logger.info('START')
+
+    self.log('PARAM','BEGIN')
+    self.log('PARAM','trade_in'                 ,self.options.trade_in)
+    self.log('PARAM','trade_pub'                ,self.options.trade_pub)
+    self.log('PARAM','trade_router_coordinator' ,self.options.trade_router_coordinator)
+    self.log('PARAM','trade_router_shards'      ,self.options.trade_router_shards)
+    self.log('PARAM','END')
+
+  def log(self, command, key, value=None):
+    log_msg = command + ',' + key
+    if value:
+      log_msg += ',' + str(value)
+    self.logger.info(log_msg)
+
+  def _connect_engine(self, trade_in, trade_pub):
+    socket = self.context.socket(zmq.DEALER)
+    socket.connect(trade_in)
+    self.subscriber.connect(trade_pub)
+    return socket
+
+  def route(self, msg_header, msg):
+    """ Returns the engine that answers the request, and the engines that only need to see it """
+    if msg_header != 'REQ':
+      return self.coordinator, self.shard_list
+
+    if msg is None:
+      return self.coordinator, []
+
+    msg_type = msg.get('MsgType')
+    symbol = None
+    if msg_type in ('D', 'F'):
+      symbol = msg.get('Symbol')
+    elif msg_type == 'V':
+      instruments = msg.get('Instruments')
+      if instruments and len(instruments) == 1:
+        symbol = instruments[0]
+
+    if symbol in self.shards:
+      return self.shards[symbol], []
+
+    if msg_type == 'F':
+      return self.coordinator, self.shard_list
+
+    return self.coordinator, []
+
+  def on_request(self, frames):
+    envelope, raw_message = frames[:-1], frames[-1]
+
+    msg_header  = raw_message[:3]
+    session_id  = raw_message[4:20]
+    if msg_header == 'USR':
+      # only the router hands sessions over
+      self.frontend.send_multipart( envelope + [ 'ERR,{"MsgType":"ERROR", "Description":"Invalid message opt_code", "Detail": ""}' ] )
+      return
+
+    msg = None
+    if msg_header == 'REQ':
+      try:
+        msg = json.loads(raw_message[21:])
+      except ValueError:
+        pass
+      if not isinstance(msg, dict):
+        msg = None
+
+    target, others = self.route(msg_header, msg)
+
+    if msg and (msg.get('MsgType') == 'U0' or (msg.get('MsgType') == 'BE' and msg.get('UserReqTyp') == '1')):
+      self.pending_logins.add(session_id)
+
+    # the first frame tells who the reply belongs to. Engines echo it back
+    target.send_multipart( [ 'R,' + session_id ] + envelope + [ raw_message ] )
+    for socket in others:
+      socket.send_multipart( [ DROP_REPLY, '', raw_message ] )
+
+  def on_reply(self, socket, frames):
+    tag, frames = frames[0], frames[1:]
+    if tag == DROP_REPLY:
+      return
+
+    session_id = tag[2:]
+    reply = frames[-1]
+
+    if session_id in self.pending_logins and socket is self.coordinator:
+      self.pending_logins.discard(session_id)
+      if reply[:3] == 'REP':
+        self.hand_over_session(session_id, reply[4:])
+
+    self.frontend.send_multipart(frames)
+
+    if reply[:3] in ('CLS', 'ERR'):
+      self.pending_logins.discard(session_id)
+      for backend in self.backends:
+        if backend is not socket:
+          backend.send_multipart( [ DROP_REPLY, '', 'CLS,' + session_id ] )
+
+  def hand_over_session(self, session_id, login_reply):
+    """ Logs the session in on the shards once the coordinator logged it in.
+    Sent before the reply reaches the client, so it precedes any request of the
+    logged session on the shards """
+    try:
+      login_reply = json.loads(login_reply)
+    except ValueError:
+      return
+    if not isinstance(login_reply, dict) or login_reply.get('MsgType') != 'BF' or login_reply.get('UserStatus') != 1:
+      return
+
+    handoff_message = 'USR,' + session_id + ',' + str(int(login_reply['UserID']))
+    for shard in self.shard_list:
+      shard.send_multipart( [ DROP_REPLY, '', handoff_message ] )
+
+  def run(self):
+    poller = zmq.Poller()
+    poller.register(self.frontend, zmq.POLLIN)
+    poller.register(self.publisher, zmq.POLLIN)
+    poller.register(self.subscriber, zmq.POLLIN)
+    for backend in self.backends:
+      poller.register(backend, zmq.POLLIN)
+
+    while True:
+      for socket, event in poller.poll():
+        if socket is self.frontend:
+          self.on_request(socket.recv_multipart())
+        elif socket is self.subscriber:
+          self.publisher.send_multipart(socket.recv_multipart())
+        elif socket is self.publisher:
+          # subscriptions coming from the gateways
+          self.subscriber.send_multipart(socket.recv_multipart())
+        else:
+          self.on_reply(socket, socket.recv_multipart())
+
+
+def run_application(options, instance_name):
+  router = TradeRouter(options, instance_name)
+  router.run()
+
+def main():
+  parser = argparse.ArgumentParser(description="Blinktrade Trade router")
+  parser.add_argument('-i', "--instance", action="store", dest="instance", help='Instance name', type=str)
+  parser.add_argument('-c', "--config", action="store", dest="config", default=os.path.expanduser('~/.bitex/bitex.ini'), help='Configuration file', type=str)
+  arguments = parser.parse_args()
+
+  if not arguments.instance:
+    parser.print_help()
+    return
+
+  candidates = [ os.path.join(ROOT_PATH, 'config/bitex.ini'),
+                 os.path.join(site_config_dir('bitex'), 'bitex.ini'),
+                 arguments.config]
+  config = ConfigParser.SafeConfigParser()
+  config.read( candidates )
+
+  options = ProjectOptions(config, arguments.instance)
+
+  if not options.trade_in or \
+     not options.trade_pub or \
+     not options.trade_log or \
+     not options.trade_router_coordinator or \
+     not options.trade_router_shards:
+    raise RuntimeError("Invalid configuration file")
+
+  run_application(options, arguments.instance)
+
+if __name__ == "__main__":
+  main()
@@ -2,6 +2,7 @@
 from errors import *
 from views import *
 from trade_application import  TradeApplication
+from journal import JOURNAL_SESSION_USER
 
 class Session(object):
   def __init__(self, session_id, remote_ip=None, client_version=None):
@@ -45,6 +46,9 @@ class Session(object):
       self.broker           = Broker.get_broker( TradeApplication.instance().db_session,user.broker.id)
       self.broker_accounts  = json.loads(self.broker.accounts)
 
+    # the journal never has the password, so record who logged in
+    TradeApplication.instance().journal_record(JOURNAL_SESSION_USER, '%s,%d' % (self.session_id, user.id))
+
 
   def process_message(self, msg):
     if  msg.type == '1': # TestRequest
@@ -98,6 +102,9 @@ class Session(object):
     elif msg.type == 'U48': # Request Deposit Method
       return processRequestDepositMethod(self, msg)
 
+    elif msg.type == 'U50': # Execution Digest Request
+      return processExecutionDigestRequest(self, msg)
+
     elif msg.type == 'U24': # Withdraw Confirmation Request
       return processWithdrawConfirmationRequest(self, msg)
 
@@ -30,6 +30,28 @@ class SessionManager(object):
     del self.sessions[session_id]
     return 'CLS,' + session_id
 
+  def hand_over_session(self, session_id, user_id):
+    """ Logs the session in as user_id. Only the shards of a sharded deployment
+    accept it, from the trade router, once the coordinator logged the session in """
+    from trade_application import TradeApplication
+    from models import User
+
+    if not TradeApplication.instance().symbols:
+      self.close_session(session_id)
+      raise InvalidOptCodeError()
+
+    if session_id not in self.sessions:
+      self.open_session(session_id, None)
+
+    session = self.sessions[session_id][2]
+    if not session.user:
+      user = User.get_user(TradeApplication.instance().db_session, user_id=int(user_id))
+      if not user:
+        self.close_session(session_id)
+        raise InvalidSessionError()
+      session.set_user(user)
+    return 'REP,' + session_id
+
   def process_message(self, msg_header, session_id, msg):
     if msg_header == 'OPN':
       return self.open_session(session_id, msg)
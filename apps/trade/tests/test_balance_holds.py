@@ -0,0 +1,39 @@
+import unittest
+
+from trade_test_base import TradeTestCase
+
+BTC = 10**8
+USD = 10**8
+
+
+class BalanceHoldsTest(TradeTestCase):
+  def test_buy_with_fee_is_not_cut_down(self):
+    """ the buyer pays the fee in BTC, so a buy the USD balance covers fills entirely """
+    buyer, seller = self.users
+    self.place_order(seller, '2', 500 * USD, 10 * BTC)
+    buy = self.place_order(buyer, '1', 500 * USD, 10 * BTC, fee=50)
+
+    self.assertEqual(buy.cxl_qty, 0)
+    self.assertEqual(buy.cum_qty, 10 * BTC)
+    self.assertEqual(self.get_balance(buyer, 'USD'), 0)
+    self.assertEqual(self.get_balance(buyer, 'BTC'), 20 * BTC - 10 * BTC * 50 // 10000)
+
+  def test_resting_buy_holds_price_times_qty(self):
+    buyer = self.users[0]
+    self.place_order(buyer, '1', 500 * USD, 10 * BTC, fee=50)
+    self.assertEqual(self.get_available_balance(buyer, 'USD'), 0)
+
+  def test_underfunded_buy_is_cut_down_to_the_balance(self):
+    buyer = self.users[0]
+    buy = self.place_order(buyer, '1', 1000 * USD, 10 * BTC, fee=50)
+    self.assertEqual(buy.leaves_qty, 5 * BTC)
+    self.assertEqual(buy.cxl_qty, 5 * BTC)
+
+  def test_sell_holds_the_qty(self):
+    seller = self.users[1]
+    self.place_order(seller, '2', 500 * USD, 4 * BTC)
+    self.assertEqual(self.get_available_balance(seller, 'BTC'), 6 * BTC)
+
+
+if __name__ == '__main__':
+  unittest.main()
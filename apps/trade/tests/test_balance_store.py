@@ -0,0 +1,91 @@
+import unittest
+
+from sqlalchemy import event
+
+from trade_test_base import TradeTestCase
+
+BTC = 10**8
+USD = 10**8
+
+
+class BalanceStoreTest(TradeTestCase):
+  user_count = 3
+
+  def get_engine(self):
+    engine = super(BalanceStoreTest, self).get_engine()
+
+    # pysqlite opens the transactions by itself and breaks the savepoints, so let SQLAlchemy do it
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+      dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(connection):
+      connection.execute('BEGIN')
+
+    return engine
+
+  def get_table_balances(self):
+    """ The balances table, read without going through the store """
+    balances_table = self.session.execute('SELECT account_id, broker_id, currency, balance FROM balances')
+    return dict( ((account_id, broker_id, currency), balance)
+                 for account_id, broker_id, currency, balance in balances_table )
+
+  def get_ledger(self):
+    return list(self.session.execute('SELECT account_id, currency, operation, amount, balance FROM ledger ORDER BY id'))
+
+  def sweep_the_book(self):
+    """ A buy that executes against two price levels, with a fee """
+    buyer, seller, other_seller = self.users
+    self.place_order(seller, '2', 500 * USD, 3 * BTC)
+    self.place_order(other_seller, '2', 510 * USD, 2 * BTC)
+    self.place_order(buyer, '1', 510 * USD, 4 * BTC, fee=20)
+    return self.get_table_balances(), self.get_ledger()
+
+  def test_writes_what_the_database_path_writes(self):
+    balances, ledger = self.sweep_the_book()
+
+    self.tearDown()
+    self.use_balance_store = False
+    self.setUp()
+    self.assertEqual(self.sweep_the_book(), (balances, ledger))
+
+  def test_the_table_follows_the_store_on_commit(self):
+    from models import Balance
+    self.sweep_the_book()
+    self.assertEqual(self.get_table_balances(), Balance.store.balances)
+
+    buyer = self.users[0]
+    self.assertEqual(self.get_balance(buyer, 'BTC'), 14 * BTC - 4 * BTC * 20 // 10000)
+    self.assertEqual(self.get_balance(buyer, 'USD'), 5000 * USD - 3 * 500 * USD - 510 * USD)
+
+  def test_rollback_restores_the_balances(self):
+    from models import Balance
+    user = self.users[0]
+    self.deposit(user, 'BTC', 5 * BTC)
+    self.assertEqual(self.get_balance(user, 'BTC'), 15 * BTC)
+
+    self.session.rollback()
+    self.assertEqual(self.get_balance(user, 'BTC'), 10 * BTC)
+    self.assertEqual(self.get_table_balances(), Balance.store.balances)
+
+  def test_savepoint_rollback_only_restores_its_own_updates(self):
+    from models import Balance
+    user = self.users[0]
+    self.deposit(user, 'BTC', 1 * BTC)
+
+    savepoint = self.session.begin_nested()
+    self.deposit(user, 'BTC', 2 * BTC)
+    self.deposit(user, 'LTC', 3 * BTC)  # a balance the table doesn't have yet
+    savepoint.rollback()
+
+    self.assertEqual(self.get_balance(user, 'BTC'), 11 * BTC)
+    self.assertEqual(self.get_balance(user, 'LTC'), 0)
+
+    self.session.commit()
+    self.assertEqual(self.get_table_balances(), Balance.store.balances)
+    self.assertEqual(len(self.get_ledger()), 2 * self.user_count + 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import trade_test_base
+from journal import JournalWriter, read_journal, RECORD_HEADER, JOURNAL_REQUEST, JOURNAL_SESSION_USER
+
+
+class JournalTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'trade.journal')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write_records(self, use_mmap=False, count=3):
+    journal = JournalWriter(self.filename, use_mmap=use_mmap, mmap_chunk_size=4096)
+    for x in xrange(count):
+      journal.append(JOURNAL_REQUEST, 'REQ,session%07d,{"MsgType":"1"}' % x)
+    journal.append(JOURNAL_SESSION_USER, u'session0000000,2')
+    journal.flush()
+    journal.close()
+
+  def test_round_trip(self):
+    self.write_records()
+    records = list(read_journal(self.filename))
+    self.assertEqual([ r[0] for r in records ], [1, 2, 3, 4])
+    self.assertEqual(records[0][2], JOURNAL_REQUEST)
+    self.assertEqual(records[0][3], 'REQ,session0000000,{"MsgType":"1"}')
+    self.assertEqual(records[3][2:], (JOURNAL_SESSION_USER, 'session0000000,2'))
+    self.assertEqual([ r[0] for r in read_journal(self.filename, 2) ], [3, 4])
+
+  def test_mmap_round_trip_continues_the_sequence(self):
+    self.write_records(use_mmap=True)
+    self.write_records(use_mmap=True)
+    self.assertEqual([ r[0] for r in read_journal(self.filename) ], range(1, 9))
+
+  def test_torn_tail_is_discarded(self):
+    self.write_records()
+    with open(self.filename, 'r+b') as f:
+      f.truncate(os.path.getsize(self.filename) - 3)
+    self.assertEqual([ r[0] for r in read_journal(self.filename) ], [1, 2, 3])
+
+    journal = JournalWriter(self.filename)
+    self.assertEqual(journal.append(JOURNAL_REQUEST, 'REQ,next'), 4)
+    journal.close()
+    self.assertEqual(list(read_journal(self.filename))[-1][3], 'REQ,next')
+
+  def test_corrupted_payload_stops_the_replay(self):
+    self.write_records()
+    records = list(read_journal(self.filename))
+    second_payload_offset = 2 * RECORD_HEADER.size + len(records[0][3]) + 4
+    with open(self.filename, 'r+b') as f:
+      f.seek(second_payload_offset)
+      f.write('X')
+    self.assertEqual([ r[0] for r in read_journal(self.filename) ], [1])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+import random
+import unittest
+
+import trade_test_base  # puts apps/trade on the path
+
+from order_book import OrderBookSide
+
+
+class FakeOrder(object):
+  def __init__(self, id, price, type='2'):
+    self.id     = id
+    self.price  = price
+    self.type   = type
+
+
+class NaiveBookSide(object):
+  """ The reference: a list of (order, sequence) sorted again on every insert """
+
+  def __init__(self, is_buy):
+    self.is_buy   = is_buy
+    self.entries  = []
+    self.sequence = 0
+
+  def _priority(self, entry):
+    order, sequence = entry
+    if order.type == '1':
+      return 0, 0, sequence
+    return 1, -order.price if self.is_buy else order.price, sequence
+
+  def _position(self, order_id):
+    """ position among the limit orders, or None for a market order """
+    visible = [ order for order, sequence in self.entries if order.type != '1' ]
+    for position, order in enumerate(visible):
+      if order.id == order_id:
+        return position
+    return None
+
+  def orders(self):
+    return [ order for order, sequence in self.entries ]
+
+  def insert(self, order):
+    self.sequence += 1
+    self.entries.append( (order, self.sequence) )
+    self.entries.sort(key=self._priority)
+    return self._position(order.id)
+
+  def remove(self, order_id):
+    position = self._position(order_id)
+    self.entries = [ entry for entry in self.entries if entry[0].id != order_id ]
+    return position
+
+  def pop_front(self, count):
+    removed, self.entries = self.entries[:count], self.entries[count:]
+    return len([ order for order, sequence in removed if order.type != '1' ])
+
+
+class OrderBookSideTest(unittest.TestCase):
+  def check_against_the_reference(self, is_buy, seed, operations, prices):
+    rnd = random.Random(seed)
+    book = OrderBookSide(is_buy)
+    reference = NaiveBookSide(is_buy)
+    next_id = 1
+
+    for step in xrange(operations):
+      operation = rnd.random()
+      if operation < 0.55 or not reference.entries:
+        order = FakeOrder(next_id, rnd.choice(prices), '1' if rnd.random() < 0.05 else '2')
+        next_id += 1
+        position = book.insert(order)
+        expected = reference.insert(order)
+        if order.type != '1':
+          self.assertEqual(position, expected)
+      elif operation < 0.95:
+        order_id = rnd.choice(reference.orders()).id
+        self.assertEqual(book.remove(order_id), reference.remove(order_id))
+      else:
+        count = rnd.randint(1, 5)
+        self.assertEqual(book.pop_front(count), reference.pop_front(count))
+
+      self.assertEqual(len(book), len(reference.entries))
+      if step % 50 == 0 or not reference.entries:
+        self.assertEqual(list(book.entries()), reference.entries)
+        self.assertEqual(book.front(), reference.entries[0][0] if reference.entries else None)
+
+    self.assertEqual(list(book.entries()), reference.entries)
+    for order in reference.orders():
+      self.assertTrue(order.id in book)
+      self.assertTrue(book.get(order.id) is order)
+
+  def test_buy_side_matches_the_reference(self):
+    self.check_against_the_reference(True, 1, 3000, range(100, 140))
+
+  def test_sell_side_matches_the_reference(self):
+    self.check_against_the_reference(False, 2, 3000, range(100, 140))
+
+  def test_crowded_levels_match_the_reference(self):
+    """ few prices with many orders each, so the levels get compacted along the way """
+    self.check_against_the_reference(True, 3, 4000, [100, 101, 102])
+
+  def test_restore_keeps_the_sequences(self):
+    book = OrderBookSide(False)
+    for order_id, price in enumerate([105, 100, 105, 101, 100], 1):
+      book.insert(FakeOrder(order_id, price))
+    entries = list(book.entries())
+
+    restored = OrderBookSide(False)
+    for order, sequence in entries:
+      restored.insert(order, sequence)
+    self.assertEqual(list(restored.entries()), entries)
+    self.assertEqual(restored.insert(FakeOrder(6, 100)), 2)
+    self.assertEqual(list(restored.entries())[2][1], 6)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from trade_test_base import TradeTestCase
+
+BTC = 10**8
+USD = 10**8
+
+
+class SnapshotTest(TradeTestCase):
+  user_count = 4
+
+  def setUp(self):
+    super(SnapshotTest, self).setUp()
+    from session_manager import SessionManager
+    self.directory = tempfile.mkdtemp()
+    self.app.options.trade_snapshot = os.path.join(self.directory, 'trade.snapshot')
+    self.app.snapshot_interval = 60
+    self.app.session_manager = SessionManager()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    super(SnapshotTest, self).tearDown()
+
+  def get_state(self):
+    import execution
+    from models import Balance
+    books = dict( (symbol, order_matcher.snapshot()) for symbol, order_matcher in execution.matcher_dict.iteritems() )
+    for book in books.values():
+      for side in book.values():
+        for entry in side:
+          del entry[3]  # the sequences of a re-matched book start over
+    return books, dict(Balance.store.holds)
+
+  def clear_books(self):
+    import execution
+    from models import Balance
+    execution.matcher_dict.clear()
+    Balance.store.clear_holds()
+
+  def place_some_orders(self):
+    u1, u2, u3, u4 = self.users
+    self.place_order(u1, '1', 400 * USD, 1 * BTC)
+    self.place_order(u2, '1', 400 * USD, 2 * BTC)
+    self.place_order(u3, '1', 390 * USD, 1 * BTC)
+    self.place_order(u4, '2', 410 * USD, 1 * BTC)
+    self.place_order(u1, '2', 420 * USD, 3 * BTC)
+
+  def test_round_trip(self):
+    self.place_some_orders()
+    self.app.save_snapshot()
+    state = self.get_state()
+
+    self.clear_books()
+    self.assertTrue(self.app.load_snapshot())
+    self.assertEqual(self.get_state(), state)
+
+  def test_checksum_detects_a_reordered_book(self):
+    self.place_some_orders()
+    self.app.save_snapshot()
+    snapshot = self.app.read_snapshot()
+    book = snapshot['Books']['BTCUSD']['buy']
+    book[0], book[1] = book[1], book[0]
+
+    self.clear_books()
+    self.assertFalse(self.app.load_snapshot(snapshot))
+
+  def test_catch_up_with_the_database(self):
+    """ the engine kept running after the snapshot: orders were filled, partially
+    filled, cancelled and placed """
+    from execution import OrderMatcher
+    u1, u2, u3, u4 = self.users
+    self.place_some_orders()
+    self.app.save_snapshot()
+
+    self.place_order(u4, '2', 400 * USD, 2 * BTC)   # fills u1 and half of u2
+    order_matcher = OrderMatcher.get('BTCUSD')
+    order_matcher.cancel(self.session, order_matcher.sell_side.front())
+    self.session.commit()
+    self.place_order(u2, '1', 390 * USD, 1 * BTC)
+    self.place_order(u3, '2', 430 * USD, 1 * BTC)
+    state = self.get_state()
+
+    self.clear_books()
+    self.assertFalse(self.app.load_snapshot())  # an exact load needs the database of the snapshot
+
+    self.clear_books()
+    self.assertTrue(self.app.load_snapshot(catch_up=True))
+    self.assertEqual(self.get_state(), state)
+
+    # and it is the same book the open orders of the database match into
+    self.clear_books()
+    self.app.reload_books()
+    self.assertEqual(self.get_state(), state)
+
+  def test_shutdown_saves_a_snapshot(self):
+    self.place_some_orders()
+    self.app.shutdown()
+    self.assertTrue(os.path.exists(self.app.options.trade_snapshot))
+    state = self.get_state()
+    self.clear_books()
+    self.assertTrue(self.app.load_snapshot(catch_up=True))
+    self.assertEqual(self.get_state(), state)
+
+
+if __name__ == '__main__':
+  unittest.main()
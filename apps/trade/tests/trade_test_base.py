@@ -0,0 +1,126 @@
+""" Base of the trade engine tests. Run them from the project root with
+
+    python -m unittest discover -s apps/trade/tests -p 'test_*.py'
+"""
+import os
+import sys
+import logging
+import unittest
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps', 'trade'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from trade_application import TradeApplication
+
+
+class TestOptions(object):
+  global_email_language = 'en'
+
+  def __init__(self, **options):
+    self.__dict__.update(options)
+
+  def __getattr__(self, name):
+    return None
+
+
+class TradeTestCase(unittest.TestCase):
+  """ A TradeApplication on a new in memory database, with a broker, the BTCUSD
+  instrument and users u2, u3, ... holding 10 BTC and 5000 USD each """
+  use_balance_store = True
+  user_count = 2
+
+  def setUp(self):
+    import execution
+    from models import Base, Currency, Instrument, User, Ledger, Balance, BalanceStore
+
+    execution.matcher_dict.clear()
+    execution.ExecutionReport.execution_id_generator = 0
+    Balance.store = None
+    Balance.lock_rows = False
+
+    self.app = TradeApplication.instance()
+    self.app.options = TestOptions()
+    self.app.instance_name = 'trade_test'
+    self.app.replay_logger = logging.getLogger('trade_test')
+    if not self.app.replay_logger.handlers:
+      self.app.replay_logger.addHandler(logging.NullHandler())
+      self.app.replay_logger.propagate = False
+    self.app.publish_queue = []
+    self.app.message_savepoint = None
+    self.app.symbols = None
+    self.app.journal = None
+
+    self.engine = self.get_engine()
+    Base.metadata.create_all(self.engine)
+    self.session_factory = sessionmaker(bind=self.engine)
+    self.app.db_session = self.session = scoped_session(self.session_factory)
+
+    s = self.session
+    s.add(Currency(code='BTC', sign='B', description='Bitcoin', is_crypto=True, format_python='{:,.8f}'))
+    s.add(Currency(code='USD', sign='$', description='Dollar', is_crypto=False, format_python='{:,.2f}'))
+    s.add(Instrument(symbol='BTCUSD', currency='USD', description='BTCUSD'))
+    self.broker = User(id=1, username='broker', email='broker@example.com', country_code='US',
+                       password_algo='sha1', password_salt='x', password='x', is_broker=True, email_lang='en')
+    s.add(self.broker)
+
+    self.users = []
+    for user_id in xrange(2, self.user_count + 2):
+      user = User(id=user_id, username='u%d' % user_id, email='u%d@example.com' % user_id, country_code='US',
+                  broker_id=1, broker_username='broker', password_algo='sha1', password_salt='x', password='x',
+                  email_lang='en')
+      s.add(user)
+      self.users.append(user)
+    s.commit()
+
+    if self.use_balance_store:
+      Balance.store = BalanceStore()
+      Balance.store.load(s)
+      Balance.store.bind(self.session_factory)
+
+    for user in self.users:
+      self.deposit(user, 'BTC', 10 * 10**8)
+      self.deposit(user, 'USD', 5000 * 10**8)
+    s.commit()
+
+  def tearDown(self):
+    from models import Balance
+    self.session.remove()
+    Balance.store = None
+
+  def get_db_url(self):
+    return 'sqlite://'
+
+  def get_engine(self):
+    return create_engine(self.get_db_url())
+
+  def deposit(self, user, currency, amount):
+    from models import Ledger
+    Ledger.deposit(self.session, user.id, user.username, user.id, user.username, 1, 'broker', 1, 'broker',
+                   currency, amount, 'd')
+
+  def get_balance(self, user, currency):
+    from models import Balance
+    return Balance.get_balance(self.session, user.id, 1, currency)
+
+  def get_available_balance(self, user, currency):
+    from models import Balance
+    return Balance.get_available_balance(self.session, user.id, 1, currency)
+
+  def place_order(self, user, side, price, qty, fee=0, order_type='2'):
+    """ Sends a limit (or market) order of user to the BTCUSD book. price and qty in satoshis """
+    from models import Order
+    from execution import OrderMatcher
+    order = Order.create(self.session, user_id=user.id, account_id=user.id, user=user, username=user.username,
+                         account_user=user, account_username=user.username, broker_id=1,
+                         broker_username='broker', client_order_id='c', symbol='BTCUSD', side=side,
+                         type=order_type, price=price, order_qty=qty, time_in_force='1', fee=fee,
+                         fee_account_id=1, fee_account_username='broker', email_lang='en')
+    self.session.flush()
+    OrderMatcher.get('BTCUSD').match(self.session, order)
+    self.session.commit()
+    return order
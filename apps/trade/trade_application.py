@@ -1,9 +1,12 @@
+import os
 import sys
 import logging
 import zmq
 import time
 import datetime
 import traceback
+import hashlib
+import signal
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
@@ -11,6 +14,7 @@ import json
 from pyblinktrade.json_encoder import JsonEncoder
 
 from errors import *
+from journal import JournalWriter, read_journal, JOURNAL_START, JOURNAL_REQUEST, JOURNAL_SESSION_USER
 
 class TradeApplication(object):
   @classmethod
@@ -24,19 +28,49 @@ class TradeApplication(object):
     self.options = options
     self.instance_name = instance_name
 
-    from models import Base, db_bootstrap
+    from models import Base, db_bootstrap, Balance, BalanceStore, SearchTerm
     engine = create_engine( options.db_engine, echo=options.db_echo)
+    if options.trade_sharded and engine.dialect.name == 'sqlite':
+      # the shards serialize the balance updates with SELECT ... FOR UPDATE
+      raise RuntimeError("trade_sharded requires a database with row locks, SQLite doesn't have them")
     Base.metadata.create_all(engine)
 
-
-    self.db_session = scoped_session(sessionmaker(bind=engine))
+    session_factory = sessionmaker(bind=engine)
+    self.db_session = scoped_session(session_factory)
     db_bootstrap(self.db_session)
 
+    # sharded deployment: this engine only owns the books of trade_symbols,
+    # and an engine without symbols is the coordinator. See router.py
+    self.symbols = None
+    if self.options.trade_sharded:
+      self.symbols = [ symbol.strip() for symbol in (self.options.trade_symbols or '').split(',') if symbol.strip() ]
+
+    if self.symbols is None:
+      # the trade engine is the only writer of the balances, so keep them in memory
+      # and write them back in batch on every commit.
+      Balance.store = BalanceStore()
+      Balance.store.load(self.db_session)
+      Balance.store.bind(session_factory)
+    else:
+      # no funds are reserved for the open orders in this mode, see Balance.lock_rows
+      Balance.lock_rows = True
+
+    SearchTerm.concurrent_writers = bool(self.options.db_concurrent_writers or self.options.trade_sharded)
+
     from session_manager import SessionManager
     self.session_manager = SessionManager(timeout_limit=self.options.session_timeout_limit)
 
+    # group commit: commit several requests at once instead of one commit per request.
+    self.group_commit_size = int(self.options.group_commit_size or 0)
+    self.group_commit_interval = int(self.options.group_commit_interval or 1000) # microseconds
+    self.message_savepoint = None
+
     self.context = zmq.Context()
-    self.input_socket = self.context.socket(zmq.REP)
+    if self.group_commit_size:
+      # several requests need to be in flight to be committed together
+      self.input_socket = self.context.socket(zmq.ROUTER)
+    else:
+      self.input_socket = self.context.socket(zmq.REP)
     self.input_socket.bind(self.options.trade_in)
 
     self.publisher_socket = self.context.socket(zmq.PUB)
@@ -56,6 +90,14 @@ class TradeApplication(object):
 
     self.replay_logger.info('START')
 
+    self.journal = None
+    if self.options.trade_journal:
+      self.journal = JournalWriter(self.options.trade_journal, use_mmap=self.options.trade_journal_mmap)
+
+    # snapshots of the order books, so the engine doesn't need to match the open orders again on startup
+    self.snapshot_interval = int(self.options.trade_snapshot_interval or 60) # seconds
+    self.next_snapshot = 0
+
     self.log_start_data()
 
 
@@ -84,6 +126,10 @@ class TradeApplication(object):
     self.log('PARAM','trade_in'              ,self.options.trade_in)
     self.log('PARAM','trade_pub'             ,self.options.trade_pub)
     self.log('PARAM','trade_log'             ,self.options.trade_log)
+    self.log('PARAM','trade_journal'         ,self.options.trade_journal)
+    self.log('PARAM','trade_journal_mmap'    ,self.options.trade_journal_mmap)
+    self.log('PARAM','trade_snapshot'        ,self.options.trade_snapshot)
+    self.log('PARAM','trade_snapshot_interval',self.options.trade_snapshot_interval)
     self.log('PARAM','session_timeout_limit' ,self.options.session_timeout_limit)
     self.log('PARAM','db_echo'               ,self.options.db_echo)
     self.log('PARAM','db_engine'             ,self.options.db_engine)
@@ -91,6 +137,11 @@ class TradeApplication(object):
     self.log('PARAM','dev_mode'              ,self.options.dev_mode)
     self.log('PARAM','satoshi_mode'          ,self.options.satoshi_mode)
     self.log('PARAM','global_email_language' ,self.options.global_email_language)
+    self.log('PARAM','group_commit_size'     ,self.options.group_commit_size)
+    self.log('PARAM','group_commit_interval' ,self.options.group_commit_interval)
+    self.log('PARAM','trade_sharded'         ,self.options.trade_sharded)
+    self.log('PARAM','trade_symbols'         ,self.options.trade_symbols)
+    self.log('PARAM','db_concurrent_writers' ,self.options.db_concurrent_writers)
     self.log('PARAM','END')
 
 
@@ -135,114 +186,498 @@ class TradeApplication(object):
     for order in orders:
       self.log('DB_ENTITY','ORDER',order)
 
+  def journal_record(self, record_type, payload):
+    if self.journal:
+      self.journal.append(record_type, payload)
+
+  def flush_journal(self):
+    if self.journal:
+      self.journal.flush()
+
   def publish(self, key, data):
+    """ data is a message dict, or a message already encoded as JSON """
     self.publish_queue.append([ key, data ])
 
-  def run(self):
-    from pyblinktrade.message import JsonMessage, InvalidMessageException
-    from market_data_publisher import MarketDataPublisher
+  def query_open_orders(self):
+    """ The open orders on the books of this engine """
+    from models import Order
+    query = self.db_session.query(Order).filter(Order.status.in_(("0", "1")))
+    if self.symbols is not None:
+      query = query.filter(Order.symbol.in_(self.symbols))
+    return query
+
+  def load_open_orders(self):
     from execution import OrderMatcher
     from models import Order
 
-    orders = self.db_session.query(Order).filter(Order.status.in_(("0", "1"))).order_by(Order.created)
+    orders = self.query_open_orders().order_by(Order.created)
     for order in orders:
       OrderMatcher.get( order.symbol  ).match(self.db_session, order)
 
-    while True:
+  @staticmethod
+  def book_checksum(books):
+    """ books are the snapshot() of every symbol. The entries are taken in priority
+    order with their side and sequence, so a reordered book doesn't match """
+    entries = []
+    for symbol in sorted(books):
+      for side in ('buy', 'sell'):
+        for order_id, price, leaves_qty, sequence in books[symbol][side]:
+          entries.append( '%s,%s,%s,%s,%s,%s' % (symbol, side, order_id, price, leaves_qty, sequence) )
+    return hashlib.sha1( ';'.join(entries) ).hexdigest()
+
+  def save_snapshot(self):
+    import execution
+
+    self.next_snapshot = time.time() + self.snapshot_interval
+
+    # the last commit expired every order on the books. Reload them all with a single query
+    self.query_open_orders().all()
+
+    books = {}
+    for symbol, order_matcher in execution.matcher_dict.iteritems():
+      books[symbol] = order_matcher.snapshot()
+
+    # only a replay restores the sessions; a restarted engine starts without any
+    sessions = {}
+    for session_id, (message_count, last_message, session) in self.session_manager.sessions.iteritems():
+      sessions[session_id] = session.user.id if session.user else None
+
+    snapshot = {
+      'JournalSequence' : self.journal.sequence if self.journal else None,
+      'Created'         : time.time(),
+      'Checksum'        : self.book_checksum(books),
+      'Books'           : books,
+      'Sessions'        : sessions
+    }
+
+    # write to a temporary file first, so a crash never leaves a truncated snapshot behind
+    tmp_filename = self.options.trade_snapshot + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+      json.dump(snapshot, f, separators=(',',':'))
+    os.rename(tmp_filename, self.options.trade_snapshot)
+
+  def save_snapshot_if_due(self):
+    if self.options.trade_snapshot and time.time() >= self.next_snapshot:
+      self.save_snapshot()
+
+  def read_snapshot(self):
+    if not self.options.trade_snapshot or not os.path.exists(self.options.trade_snapshot):
+      return None
+
+    with open(self.options.trade_snapshot, 'rb') as f:
+      return json.load(f)
+
+  def load_snapshot(self, snapshot=None, catch_up=False):
+    """ Loads the books of a snapshot saved by save_snapshot(), the last one by
+    default. Returns False when there is no snapshot or when it doesn't match the
+    open orders of the database.
+
+    With catch_up, the database may be ahead of the snapshot, as it is when the
+    engine restarts: the journal tail after the snapshot was already applied to
+    it. The snapshot orders the database closed since are dropped, the remaining
+    ones take their leaves_qty from the database, and the orders opened since
+    rest behind them in the order they were created. """
+    from execution import OrderMatcher
+    from models import Order
+
+    if snapshot is None:
+      snapshot = self.read_snapshot()
+    if snapshot is None:
+      return False
+
+    if self.book_checksum(snapshot['Books']) != snapshot['Checksum']:
+      self.log('SNAPSHOT', 'CHECKSUM_MISMATCH', self.options.trade_snapshot)
+      return False
+
+    orders = self.query_open_orders().order_by(Order.created, Order.id).all()
+    orders_by_id = dict( (order.id, order) for order in orders )
+
+    books = {}
+    snapshot_orders = set()
+    for symbol, book in snapshot['Books'].iteritems():
+      books[symbol] = { 'buy': [], 'sell': [] }
+      for side in ('buy', 'sell'):
+        for order_id, price, leaves_qty, sequence in book[side]:
+          order = orders_by_id.get(order_id)
+          if order is None and catch_up:
+            continue  # filled or cancelled after the snapshot
+          if order is None or order.symbol != symbol or order.is_buy != (side == 'buy') or order.price != price or \
+             (not catch_up and order.leaves_qty != leaves_qty):
+            self.log('SNAPSHOT', 'ORDERS_MISMATCH', self.options.trade_snapshot)
+            return False
+          books[symbol][side].append( [order_id, price, order.leaves_qty, sequence] )
+          snapshot_orders.add(order_id)
+
+    new_orders = {}
+    for order in orders:
+      if order.id not in snapshot_orders:
+        if not catch_up:
+          self.log('SNAPSHOT', 'ORDERS_MISMATCH', self.options.trade_snapshot)
+          return False
+        new_orders.setdefault(order.symbol, []).append(order)
+
+    for symbol in set(books) | set(new_orders):
+      order_matcher = OrderMatcher.get(symbol)
+      order_matcher.restore(books.get(symbol, { 'buy': [], 'sell': [] }), orders_by_id, new_orders.get(symbol, []))
+      if order_matcher.is_crossed():
+        self.log('SNAPSHOT', 'CROSSED_BOOK', symbol)
+        return False
+
+    self.log('SNAPSHOT', 'LOADED', '%d,%d' % (len(snapshot_orders), len(orders) - len(snapshot_orders)))
+    return True
+
+  def run(self):
+    self.journal_record(JOURNAL_START, self.instance_name)
+    self.flush_journal()
+
+    if self.symbols is None or self.symbols:  # the coordinator has no books
+      if not self.load_snapshot(catch_up=True):
+        self.reload_books()
+      self.db_session.commit()
+      self.save_snapshot_if_due()
+
+    # stop between two requests on SIGTERM / SIGINT, and save a snapshot on the way out
+    self.stopping = False
+    self.processing = False
+    signal.signal(signal.SIGTERM, self.stop)
+    signal.signal(signal.SIGINT, self.stop)
+    try:
+      if self.group_commit_size:
+        self.run_group_commit()
+      else:
+        self.run_request_reply()
+    except SystemExit:
+      pass
+    self.shutdown()
+
+  def stop(self, signum=None, frame=None):
+    """ Stops the engine as soon as the request being processed is done """
+    self.stopping = True
+    if not self.processing:
+      raise SystemExit()
+
+  def shutdown(self):
+    self.log('STOP', self.instance_name)
+    if self.options.trade_snapshot and (self.symbols is None or self.symbols):
+      self.save_snapshot()
+    if self.journal:
+      self.journal.close()
+
+  def run_request_reply(self):
+    while not self.stopping:
       raw_message = self.input_socket.recv()
+      self.processing = True
 
-      msg_header              = raw_message[:3]
-      session_id              = raw_message[4:20]
-      json_raw_message        = raw_message[21:].strip()
+      response_message = self.process_message(raw_message)
 
-      try:
-        msg = None
-        if json_raw_message:
+      # send the response
+      self.log('OUT', 'TRADE_IN_REP', response_message )
+      self.input_socket.send_unicode(response_message)
+
+      self.flush_publish_queue()
+      self.save_snapshot_if_due()
+      self.processing = False
+
+  def run_group_commit(self):
+    """ Processes up to group_commit_size queued requests, or as many as fit in
+    group_commit_interval microseconds, and commits them all at once. Replies and
+    publications are only released after the commit succeeds. """
+    while not self.stopping:
+      frames = self.input_socket.recv_multipart()
+      self.processing = True
+      deadline = time.time() + self.group_commit_interval / 1e6
+
+      replies = []
+      session_ids = []
+      while frames:
+        envelope, raw_message = frames[:-1], frames[-1]
+        session_ids.append(raw_message[4:20])
+
+        # each request runs on its own savepoint, so a failing request doesn't discard the others
+        self.message_savepoint = self.db_session.begin_nested(), len(self.publish_queue)
+        response_message = self.process_message(raw_message)
+        transaction, publish_queue_size = self.message_savepoint
+        self.message_savepoint = None
+        if transaction.is_active:
+          transaction.commit()
+        else:
+          # the savepoint forgot the failed request, but the books may still have it
+          self.load_books()
+          del self.publish_queue[publish_queue_size:]
+
+        replies.append( (envelope, response_message) )
+
+        frames = None
+        if len(replies) < self.group_commit_size and time.time() < deadline:
           try:
-            msg = JsonMessage(json_raw_message)
-          except InvalidMessageException, e:
-            self.log('IN', 'TRADE_IN_REQ_ERROR',  raw_message)
-            raise InvalidMessageError()
+            frames = self.input_socket.recv_multipart(zmq.NOBLOCK)
+          except zmq.Again:
+            pass
+
+      try:
+        self.flush_journal()  # the requests reach the journal before their effects reach the database
+        self.db_session.commit()
+      except Exception,e:
+        traceback.print_exc()
+        self.db_session.rollback()
+        self.publish_queue = []
+        error_message = 'ERR,{"MsgType":"ERROR", "Description":"Unknow error", "Detail": "'  + str(e) + '"}'
+        replies = [ (envelope, error_message) for envelope, response_message in replies ]
+
+        # every request of the batch failed, so undo what they did in memory as well
+        for session_id in session_ids:
+          self.session_manager.close_session(session_id)
+        self.reload_books()
+
+      for envelope, response_message in replies:
+        self.log('OUT', 'TRADE_IN_REP', response_message )
+        if isinstance(response_message, unicode):
+          response_message = response_message.encode('utf-8')
+        self.input_socket.send_multipart( envelope + [ response_message ] )
+
+      self.flush_publish_queue()
+      self.save_snapshot_if_due()
+      self.processing = False
+
+  def commit(self):
+    """ Commits the work of the request being processed, after its journal record
+    reached the disk. In group commit mode the request runs on a savepoint of the
+    batch, which commits it with the others """
+    if self.message_savepoint is not None:
+      self.db_session.flush()
+      return
+    self.flush_journal()
+    self.db_session.commit()
+
+  def reload_books(self):
+    """ Drops the books and the fund holds and loads them again from the open
+    orders of the database, after a rollback left them ahead of it """
+    self.load_books()
+    self.db_session.commit()
+    self.publish_queue = []
+
+  def load_books(self):
+    """ Same as reload_books, within the current transaction """
+    import execution
+    from models import Balance
+
+    execution.matcher_dict.clear()
+    if Balance.store is not None:
+      Balance.store.clear_holds()
+    self.load_open_orders()
+
+  def rollback_message(self):
+    if self.message_savepoint is None:
+      self.db_session.rollback()
+      return
+
+    # group commit mode: only discard the work done by the failed message
+    transaction, publish_queue_size = self.message_savepoint
+    if transaction.is_active:
+      transaction.rollback()
+      del self.publish_queue[publish_queue_size:]
+
+  def replay(self, journal_filename, from_sequence=None):
+    """ Re-runs the requests recorded on a journal after from_sequence.
+
+    Without from_sequence, the books are loaded from the trade_snapshot and the
+    records after its JournalSequence are replayed, so the database must be a
+    copy of the one the engine had when the snapshot was saved. With
+    from_sequence, or without a snapshot, the open orders of the database are
+    matched again, and it must be a copy of the one the engine had when the
+    first replayed record was written.
+
+    Passwords are never journaled, so logins are not authenticated again: the
+    session gets the user recorded by the JOURNAL_SESSION_USER record that follows
+    the login request. Password changes are skipped for the same reason. """
+    from pyblinktrade.message import JsonMessage
+    import execution
+    from models import User, Balance
+    from session_manager import SessionManager
 
-          # never write passwords in the log file
-          if msg.has('Password'):
-            raw_message = raw_message.replace(msg.get('Password'), '*')
-          if msg.has('NewPassword'):
-            raw_message = raw_message.replace(msg.get('NewPassword'), '*')
+    loaded = False
+    if from_sequence is None:
+      from_sequence = 0
+      snapshot = self.read_snapshot()
+      if snapshot is not None and snapshot['JournalSequence'] is not None:
+        if not self.load_snapshot(snapshot):
+          raise RuntimeError("The database doesn't match the snapshot " + self.options.trade_snapshot)
+        for session_id, user_id in snapshot.get('Sessions', {}).iteritems():
+          self.session_manager.open_session(session_id, None)
+          if user_id is not None:
+            self.session_manager.sessions[session_id][2].set_user(User.get_user(self.db_session, user_id=user_id))
+        self.db_session.commit()
+        from_sequence = snapshot['JournalSequence']
+        loaded = True
+      self.log('REPLAY', 'FROM_SEQUENCE', str(from_sequence))
+
+    pending_login = None
+    count = 0
+    for sequence, timestamp, record_type, payload in read_journal(journal_filename, from_sequence):
+      if pending_login and record_type != JOURNAL_SESSION_USER:
+        # the login failed
+        self.session_manager.close_session(pending_login)
+        pending_login = None
+
+      if record_type == JOURNAL_START:
+        # the engine was restarted, so was all its in memory state
+        execution.matcher_dict.clear()
+        execution.ExecutionReport.execution_id_generator = 0
+        if Balance.store is not None:
+          Balance.store.clear_holds()
+        self.session_manager = SessionManager(timeout_limit=self.options.session_timeout_limit)
+        self.load_open_orders()
+        self.db_session.commit()
+        loaded = True
+        continue
+
+      if not loaded:
+        self.load_open_orders()
+        self.db_session.commit()
+        loaded = True
+
+      if record_type == JOURNAL_SESSION_USER:
+        pending_login = None
+        session_id, user_id = payload.split(',')
+        if session_id not in self.session_manager.sessions:
+          self.session_manager.open_session(session_id, None)
+        session = self.session_manager.sessions[session_id][2]
+        if not session.user:
+          session.set_user(User.get_user(self.db_session, user_id=int(user_id)))
+        continue
+
+      msg_header  = payload[:3]
+      session_id  = payload[4:20]
+      if msg_header == 'REQ' and payload[21:].strip():
+        try:
+          msg = JsonMessage(payload[21:].strip())
+        except Exception:
+          msg = None
+        if msg and msg.type != 'U0' and (msg.has('Password') or msg.has('NewPassword')):
+          if msg.type == 'BE' and msg.get('UserReqTyp') == '1':
+            pending_login = session_id
+          continue
+
+      self.process_message(payload)
+      self.flush_publish_queue()
+      count += 1
+
+    if pending_login:
+      self.session_manager.close_session(pending_login)
+
+    self.log('REPLAY', 'END', str(count))
+    return count
+
+  def flush_publish_queue(self):
+    for key, message in self.publish_queue:
+      if not isinstance(message, str):
+        message = json.dumps(message, cls=JsonEncoder)
+      self.log('OUT', 'TRADE_PUB', str(key) + ',' + message )
+      self.publisher_socket.send_multipart( [str(key),  message] )
+    self.publish_queue = []
 
-        self.log('IN', 'TRADE_IN_REQ' ,raw_message )
+  def process_message(self, raw_message):
+    from pyblinktrade.message import JsonMessage, InvalidMessageException
+    from market_data_publisher import MarketDataPublisher
+    from execution import OrderMatcher
+
+    msg_header              = raw_message[:3]
+    session_id              = raw_message[4:20]
+    json_raw_message        = raw_message[21:].strip()
 
-        if msg:
-          if msg.isMarketDataRequest(): # Market Data Request
-            req_id = msg.get('MDReqID')
-            market_depth = msg.get('MarketDepth')
-            instruments = msg.get('Instruments')
-            entries = msg.get('MDEntryTypes')
-            transact_time = msg.get('TransactTime')
-
-            timestamp = None
-            if transact_time:
-              timestamp = transact_time
-            else:
-              trade_date = msg.get('TradeDate')
-              if not trade_date:
-                trade_date = time.strftime("%Y%m%d", time.localtime())
-
-              self.log('OUT', 'TRADEDATE', trade_date)
-              timestamp = datetime.datetime.strptime(trade_date, "%Y%m%d")
-
-            self.log('OUT', 'TIMESTAMP', timestamp )
-            
-            if len(instruments) > 1:
-              raise  InvalidMessageError()
-
-            instrument = instruments[0]
-
-            om = OrderMatcher.get(instrument)
-            response_message = MarketDataPublisher.generate_md_full_refresh( self.db_session, instrument, market_depth, om, entries, req_id, timestamp )
-            response_message = 'REP,' + json.dumps( response_message , cls=JsonEncoder)
-          elif msg.isTradeHistoryRequest():
-
-              page        = msg.get('Page', 0)
-              page_size   = msg.get('PageSize', 100)
-              offset      = page * page_size
-
-              columns = [ 'TradeID'           , 'Market',  'Side', 'Price', 'Size',
-                          'Buyer'             , 'Seller', 'Created' ]
-
-              trade_list = MarketDataPublisher.generate_trade_history(self.db_session, page_size, offset )
-
-              response_message = 'REP,' + json.dumps( {
-                  'MsgType'           : 'U33', # TradeHistoryResponse
-                  'TradeHistoryReqID' : -1,
-                  'Page'              : page,
-                  'PageSize'          : page_size,
-                  'Columns'           : columns,
-                  'TradeHistoryGrp'   : trade_list
-              }, cls=JsonEncoder )
+    try:
+      msg = None
+      if json_raw_message and msg_header != 'USR':
+        try:
+          msg = JsonMessage(json_raw_message)
+        except InvalidMessageException, e:
+          self.log('IN', 'TRADE_IN_REQ_ERROR',  raw_message)
+          self.journal_record(JOURNAL_REQUEST, raw_message)
+          raise InvalidMessageError()
+
+        # never write passwords in the log file
+        if msg.has('Password'):
+          raw_message = raw_message.replace(msg.get('Password'), '*')
+        if msg.has('NewPassword'):
+          raw_message = raw_message.replace(msg.get('NewPassword'), '*')
+
+      if self.journal:
+        self.journal.append(JOURNAL_REQUEST, raw_message)
+      else:
+        self.log('IN', 'TRADE_IN_REQ' ,raw_message )
 
+      if msg_header == 'USR':
+        # session handoff from the trade router, the payload is the user id
+        response_message = self.session_manager.hand_over_session( session_id, json_raw_message )
+      elif msg:
+        if msg.isMarketDataRequest(): # Market Data Request
+          req_id = msg.get('MDReqID')
+          market_depth = msg.get('MarketDepth')
+          instruments = msg.get('Instruments')
+          entries = msg.get('MDEntryTypes')
+          transact_time = msg.get('TransactTime')
+
+          timestamp = None
+          if transact_time:
+            timestamp = transact_time
           else:
-            response_message = self.session_manager.process_message( msg_header, session_id, msg )
+            trade_date = msg.get('TradeDate')
+            if not trade_date:
+              trade_date = time.strftime("%Y%m%d", time.localtime())
+
+            self.log('OUT', 'TRADEDATE', trade_date)
+            timestamp = datetime.datetime.strptime(trade_date, "%Y%m%d")
+
+          self.log('OUT', 'TIMESTAMP', timestamp )
+          
+          if len(instruments) > 1:
+            raise  InvalidMessageError()
+
+          instrument = instruments[0]
+
+          om = OrderMatcher.get(instrument)
+          response_message = MarketDataPublisher.generate_md_full_refresh( self.db_session, instrument, market_depth, om, entries, req_id, timestamp )
+          response_message = 'REP,' + json.dumps( response_message , cls=JsonEncoder)
+        elif msg.isTradeHistoryRequest():
+
+            page        = msg.get('Page', 0)
+            page_size   = msg.get('PageSize', 100)
+            offset      = page * page_size
+
+            # SinceTradeID asks for the trades after it, oldest first, instead of a page
+            since_trade_id = msg.get('SinceTradeID')
+
+            columns = [ 'TradeID'           , 'Market',  'Side', 'Price', 'Size',
+                        'Buyer'             , 'Seller', 'Created' ]
+
+            trade_list = MarketDataPublisher.generate_trade_history(self.db_session, page_size, offset, since_trade_id=since_trade_id )
+
+            response = {
+                'MsgType'           : 'U33', # TradeHistoryResponse
+                'TradeHistoryReqID' : -1,
+                'Page'              : page,
+                'PageSize'          : page_size,
+                'Columns'           : columns,
+                'TradeHistoryGrp'   : trade_list
+            }
+            if since_trade_id is not None:
+              response['SinceTradeID'] = since_trade_id
+            response_message = 'REP,' + json.dumps( response, cls=JsonEncoder )
+
         else:
           response_message = self.session_manager.process_message( msg_header, session_id, msg )
+      else:
+        response_message = self.session_manager.process_message( msg_header, session_id, msg )
 
-      except TradeRuntimeError, e:
-        self.db_session.rollback()
-        self.session_manager.close_session(session_id)
-        response_message = 'ERR,{"MsgType":"ERROR", "Description":"' + e.error_description.replace("'", "") + '", "Detail": ""}'
-
-      except Exception,e:
-        traceback.print_exc()
-        self.db_session.rollback()
-        self.session_manager.close_session(session_id)
-        response_message = 'ERR,{"MsgType":"ERROR", "Description":"Unknow error", "Detail": "'  + str(e) + '"}'
+    except TradeRuntimeError, e:
+      self.rollback_message()
+      self.session_manager.close_session(session_id)
+      response_message = 'ERR,{"MsgType":"ERROR", "Description":"' + e.error_description.replace("'", "") + '", "Detail": ""}'
 
-      # send the response
-      self.log('OUT', 'TRADE_IN_REP', response_message )
-      self.input_socket.send_unicode(response_message)
+    except Exception,e:
+      traceback.print_exc()
+      self.rollback_message()
+      self.session_manager.close_session(session_id)
+      response_message = 'ERR,{"MsgType":"ERROR", "Description":"Unknow error", "Detail": "'  + str(e) + '"}'
 
-      # publish all publications
-      for key, message in self.publish_queue:
-        self.log('OUT', 'TRADE_PUB', str([key, message]) )
-        self.publisher_socket.send_multipart( [str(key),  json.dumps(message, cls=JsonEncoder)] )
-      self.publish_queue = []
+    return response_message
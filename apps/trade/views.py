@@ -9,7 +9,8 @@ import json
 
 from models import  User, Order, UserPasswordReset, Deposit, DepositMethods, \
   NeedSecondFactorException, UserAlreadyExistsException, BrokerDoesNotExistsException, \
-  Withdraw, Broker, Instrument, Currency, Balance, Ledger, Position, PositionLedger, TrustedAddress
+  Withdraw, Broker, Instrument, Currency, Balance, Ledger, Position, PositionLedger, TrustedAddress, \
+  UserEmail, encode_list_cursor, decode_list_cursor
 
 from execution import OrderMatcher
 
@@ -17,6 +18,21 @@ from decorators import *
 
 from trade_application import TradeApplication
 
+def get_list_request_cursor(msg):
+  """ (created, id) the list request asks to continue from, or None when it asks for a Page """
+  if not msg.get('Cursor'):
+    return None
+  try:
+    return decode_list_cursor(msg.get('Cursor'))
+  except ValueError:
+    raise InvalidParameter()
+
+def get_list_response_cursor(records, page_size):
+  """ Cursor of the page after records, or None when records is the last page """
+  if records and page_size and len(records) == page_size:
+    return encode_list_cursor(records[-1])
+  return None
+
 def processTestRequest(session, msg):
   return json.dumps({
     "MsgType":"0",
@@ -153,7 +169,7 @@ def processLogin(session, msg):
     return json.dumps(login_response, cls=JsonEncoder)
 
   TradeApplication.instance().db_session.add(session.user)
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   # Send the login response
   login_response = {
@@ -324,7 +340,7 @@ def processNewOrderSingle(session, msg):
   TradeApplication.instance().db_session.flush() # just to assign an ID for the order.
 
   OrderMatcher.get(msg.get('Symbol')).match(TradeApplication.instance().db_session, order)
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   return ""
 
@@ -353,7 +369,7 @@ def processCancelOrderRequest(session, msg):
 
   for order in order_list:
     OrderMatcher.get( order.symbol ).cancel(TradeApplication.instance().db_session, order)
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   return ""
 
@@ -450,7 +466,7 @@ def processUpdateUserProfile(session, msg):
   if broker_model_update_fields:
     broker_profile.update(broker_model_update_fields)
 
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   response_msg = {
     "MsgType":"U39",
@@ -603,7 +619,7 @@ def processConfirmTrustedAddressRequest(session, msg):
                                               msg.get('Address'),
                                               msg.get('Currency'),
                                               msg.get('Label') )
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   response = {
     'MsgType': 'U45',
@@ -722,7 +738,7 @@ def processRequestPasswordRequest(session, msg):
   success = 0
   if user:
     user.request_reset_password( TradeApplication.instance().db_session, session.email_lang )
-    TradeApplication.instance().db_session.commit()
+    TradeApplication.instance().commit()
     success = 1
 
   response = {
@@ -741,7 +757,7 @@ def processPasswordRequest(session, msg):
       'UserStatusText': 'MSG_SUCCESS_PASSWORD_CHANGE'
     }
 
-    TradeApplication.instance().db_session.commit()
+    TradeApplication.instance().commit()
     return json.dumps(response, cls=JsonEncoder)
   else:
     response = {
@@ -775,7 +791,7 @@ def processEnableDisableTwoFactorAuth(session, msg):
 
   two_factor_secret = user.enable_two_factor(enable, secret, code)
   TradeApplication.instance().db_session.add(user)
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   response = {'MsgType'         : 'U17',
               'EnableTwoFactorReqID': msg.get('EnableTwoFactorReqID'),
@@ -891,7 +907,7 @@ def processRequestDeposit(session, msg):
                                                 value,
                                                 client_order_id,
                                                 instructions )
-    TradeApplication.instance().db_session.commit()
+    TradeApplication.instance().commit()
     should_broadcast = True
   elif currency:
     deposit = Deposit.create_crypto_currency_deposit(TradeApplication.instance().db_session,
@@ -903,7 +919,7 @@ def processRequestDeposit(session, msg):
                                                      client_order_id,
                                                      instructions,
                                                      value)
-    TradeApplication.instance().db_session.commit()
+    TradeApplication.instance().commit()
     should_broadcast = True
   else:
     deposit = Deposit.get_deposit(TradeApplication.instance().db_session, deposit_id)
@@ -993,7 +1009,7 @@ def processWithdrawRequest(session, msg):
                                     client_order_id,
                                     session.email_lang)
 
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   withdraw_refresh = withdrawRecordToWithdrawMessage(withdraw_record)
   withdraw_refresh['MsgType'] = 'U9'
@@ -1038,7 +1054,7 @@ def processWithdrawConfirmationRequest(session, msg):
     response = {'MsgType':'U25', 'WithdrawReqID': reqId}
     return json.dumps(response, cls=JsonEncoder)
 
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   withdraw_refresh = withdrawRecordToWithdrawMessage(withdraw_data)
   withdraw_refresh['MsgType'] = 'U9'
@@ -1060,6 +1076,7 @@ def processWithdrawListRequest(session, msg):
   status_list = msg.get('StatusList', ['1', '2'] )
   filter      = msg.get('Filter',[])
   offset      = page * page_size
+  cursor      = get_list_request_cursor(msg)
 
   user = session.user
   if msg.has('ClientID') and int(msg.get('ClientID')) != session.user.id :
@@ -1071,11 +1088,11 @@ def processWithdrawListRequest(session, msg):
 
   if user.is_broker:
     if msg.has('ClientID'):
-      withdraws = Withdraw.get_list(TradeApplication.instance().db_session, user.id, int(msg.get('ClientID')), status_list, page_size, offset, filter  )
+      withdraws = Withdraw.get_list(TradeApplication.instance().db_session, user.id, int(msg.get('ClientID')), status_list, page_size, offset, filter, cursor ).all()
     else:
-      withdraws = Withdraw.get_list(TradeApplication.instance().db_session, user.id, None, status_list, page_size, offset, filter  )
+      withdraws = Withdraw.get_list(TradeApplication.instance().db_session, user.id, None, status_list, page_size, offset, filter, cursor ).all()
   else:
-    withdraws = Withdraw.get_list(TradeApplication.instance().db_session, user.broker_id, user.id, status_list, page_size, offset, filter  )
+    withdraws = Withdraw.get_list(TradeApplication.instance().db_session, user.broker_id, user.id, status_list, page_size, offset, filter, cursor ).all()
 
   withdraw_list = []
   columns = [ 'WithdrawID'   , 'Method'   , 'Currency'     , 'Amount' , 'Data',
@@ -1108,6 +1125,7 @@ def processWithdrawListRequest(session, msg):
     'WithdrawListReqID' : msg.get('WithdrawListReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
+    'Cursor'            : get_list_response_cursor(withdraws, page_size),
     'Columns'           : columns,
     'WithdrawListGrp'   : withdraw_list
   }
@@ -1213,6 +1231,69 @@ def processRequestDatabaseQuery(session, msg):
   }
   return json.dumps(result, cls=JsonEncoder)
 
+@login_required
+@system_user_required
+def processExecutionDigestRequest(session, msg):
+  """ Sends one e-mail per account with the executions the mailer collected from
+  the FILL publications. A single execution keeps the order-execution template """
+  db_session = TradeApplication.instance().db_session
+
+  formats = {}
+  def format_number(currency_code, number):
+    if currency_code not in formats:
+      formats[currency_code] = Currency.get_currency(db_session, currency_code).format_python
+    return formats[currency_code].format(number)
+
+  email_count = 0
+  for account in msg.get('Accounts'):
+    user = User.get_user(db_session, user_id=account['AccountID'])
+    if not user:
+      continue
+
+    executions = []
+    for execution in account['Executions']:
+      qty_currency = execution['Symbol'][:3]
+      price_currency = execution['Symbol'][3:]
+      executions.append({
+        'order_id': execution['OrderID'],
+        'trade_id': execution['TradeID'],
+        'executed_when': execution['Created'],
+        'side': execution['Side'],
+        'symbol': execution['Symbol'],
+        'qty': format_number(qty_currency, execution['Size'] / 1.e8),
+        'price': format_number(price_currency, execution['Price'] / 1.e8),
+        'total': format_number(price_currency, execution['Size'] / 1.e8 * execution['Price'] / 1.e8)
+      })
+
+    if len(executions) == 1:
+      email_template = 'order-execution'
+      email_params = executions[0]
+    else:
+      email_template = 'order-execution-digest'
+      email_params = {
+        'count': len(executions),
+        'executions': '<br/>'.join(
+          u'%(executed_when)s - %(order_id)s - %(qty)s @ %(price)s = %(total)s' % e for e in executions )
+      }
+    email_params['username'] = user.username
+
+    UserEmail.create( session   = db_session,
+                      user_id   = user.id,
+                      broker_id = account['BrokerID'],
+                      subject   = 'E',
+                      template  = email_template,
+                      language  = user.email_lang,
+                      params    = json.dumps(email_params, cls=JsonEncoder))
+    email_count += 1
+
+  TradeApplication.instance().commit()
+
+  return json.dumps({
+    'MsgType': 'U51',
+    'ExecutionDigestReqID': msg.get('ExecutionDigestReqID'),
+    'EmailCount': email_count
+  }, cls=JsonEncoder)
+
 @login_required
 @broker_user_required
 def processCustomerListRequest(session, msg):
@@ -1225,12 +1306,16 @@ def processCustomerListRequest(session, msg):
   sort_column = msg.get('Sort', None)
   sort_order  = msg.get('SortOrder', 'ASC')
   offset      = page * page_size
+  cursor      = get_list_request_cursor(msg)
+
+  if cursor and sort_column:
+    raise InvalidParameter()  # only the list ordered by creation is paged by Cursor
 
   if client_id:
     if len(client_id) == 1:
       client_id = client_id[0]
 
-  user_list = User.get_list(TradeApplication.instance().db_session, session.user.id ,status_list, country, state, client_id, page_size, offset, sort_column, sort_order)
+  user_list = User.get_list(TradeApplication.instance().db_session, session.user.id ,status_list, country, state, client_id, page_size, offset, sort_column, sort_order, cursor).all()
 
   result_set = []
   columns = [ 'ID'              , 'Username'       , 'Email'             , 'State'              , 'CountryCode'     ,
@@ -1266,6 +1351,7 @@ def processCustomerListRequest(session, msg):
     'CustomerListReqID' : msg.get('CustomerListReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
+    'Cursor'            : None if sort_column else get_list_response_cursor(user_list, page_size),
     'Columns'           : columns,
     'CustomerListGrp'   : result_set
   }
@@ -1331,7 +1417,7 @@ def processVerifyCustomer(session, msg):
 
   client.set_verified(TradeApplication.instance().db_session, msg.get('Verify'), verification_data , bonus_account)
 
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   response_msg = {
     'MsgType'             : 'B9',
@@ -1376,7 +1462,7 @@ def processProcessWithdraw(session, msg):
 
     result = withdraw.set_as_complete( TradeApplication.instance().db_session, data, broker_fees_account)
 
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   if result:
     withdraw_refresh = withdrawRecordToWithdrawMessage(withdraw)
@@ -1444,7 +1530,7 @@ def processProcessDeposit(session, msg):
                                                                  fixed_fee,
                                                                  data)
 
-  TradeApplication.instance().db_session.commit()
+  TradeApplication.instance().commit()
 
   if instruction_msg_after_deposit:
     msg = JsonMessage( json.dumps(instruction_msg_after_deposit) )
@@ -1477,6 +1563,7 @@ def processLedgerListRequest(session, msg):
   currency        = msg.get('Currency')
   filter          = msg.get('Filter',[])
   offset          = page * page_size
+  cursor          = get_list_request_cursor(msg)
 
   user = session.user
 
@@ -1495,7 +1582,7 @@ def processLedgerListRequest(session, msg):
       broker_id = int(msg.get('BrokerID'))
 
 
-  records = Ledger.get_list(TradeApplication.instance().db_session, broker_id, account_id, operation_list, page_size, offset, currency, filter  )
+  records = Ledger.get_list(TradeApplication.instance().db_session, broker_id, account_id, operation_list, page_size, offset, currency, filter, cursor ).all()
 
   record_list = []
   columns = [ 'LedgerID',       'Currency',     'Operation',
@@ -1527,6 +1614,7 @@ def processLedgerListRequest(session, msg):
     'LedgerListReqID'   : msg.get('LedgerListReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
+    'Cursor'            : get_list_response_cursor(records, page_size),
     'Columns'           : columns,
     'LedgerListGrp'     : record_list
   }
@@ -1541,16 +1629,17 @@ def processDepositListRequest(session, msg):
 
 
   offset      = page * page_size
+  cursor      = get_list_request_cursor(msg)
 
   user = session.user
 
   if user.is_broker:
     if msg.has('ClientID'):
-      deposits = Deposit.get_list(TradeApplication.instance().db_session, user.id, int(msg.get('ClientID')), status_list, page_size, offset, filter  )
+      deposits = Deposit.get_list(TradeApplication.instance().db_session, user.id, int(msg.get('ClientID')), status_list, page_size, offset, filter, cursor ).all()
     else:
-      deposits = Deposit.get_list(TradeApplication.instance().db_session, user.id, None, status_list, page_size, offset, filter  )
+      deposits = Deposit.get_list(TradeApplication.instance().db_session, user.id, None, status_list, page_size, offset, filter, cursor ).all()
   else:
-    deposits = Deposit.get_list(TradeApplication.instance().db_session, user.broker_id, user.id, status_list, page_size, offset, filter  )
+    deposits = Deposit.get_list(TradeApplication.instance().db_session, user.broker_id, user.id, status_list, page_size, offset, filter, cursor ).all()
 
 
   deposit_list = []
@@ -1590,6 +1679,7 @@ def processDepositListRequest(session, msg):
     'DepositListReqID'  : msg.get('DepositListReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
+    'Cursor'            : get_list_response_cursor(deposits, page_size),
     'Columns'           : columns,
     'DepositListGrp'    : deposit_list
   }
@@ -3,6 +3,8 @@ import os
 
 import zmq
 from zmq.eventloop.zmqstream import  ZMQStream
+from tornado import gen
+from tornado.concurrent import Future
 
 from pyblinktrade.message_builder import MessageBuilder
 from pyblinktrade.message import JsonMessage, InvalidMessageException
@@ -97,32 +99,27 @@ class TradeClient(object):
 
     return broker_list, columns
 
-  def getLastTrades(self, last_trade_id, page=0):
-
-      if last_trade_id is None:
-          last_trade_id = 1
-
-      rep_msg = self.sendJSON({ 'MsgType': 'U32',
-                                'TradeHistoryReqID': -1,
-                                'Page': page,
-                                'PageSize': 100 })
+  def getLastTrades(self, last_trade_id, page_size=1000):
+      """ The trades after last_trade_id, oldest first, fetched page_size at a time """
+      since_trade_id = last_trade_id or 0
 
       result_list = []
+      while True:
+          rep_msg = self.sendJSON({ 'MsgType': 'U32',
+                                    'TradeHistoryReqID': -1,
+                                    'SinceTradeID': since_trade_id,
+                                    'PageSize': page_size })
+          if not rep_msg.isTradeHistoryResponse():
+              break
 
-      if rep_msg.isTradeHistoryResponse():
-          last_processed = 0
           trade_list = rep_msg.get('TradeHistoryGrp')
-          if not trade_list :
-            return result_list
-          for trade in trade_list:
-             if last_trade_id <= trade[0]:
-               last_processed = trade[0]
-               if last_processed != last_trade_id:
-                  result_list.append(trade)
+          if not trade_list:
+              break
 
-
-          if last_processed != last_trade_id:
-             return result_list + self.getLastTrades(last_trade_id, page+1)
+          result_list.extend(trade_list)
+          if len(trade_list) < page_size:
+              break
+          since_trade_id = trade_list[-1][0]
 
       return result_list
 
@@ -183,4 +180,121 @@ class TradeClient(object):
     return self.sendString(json.dumps(json_msg))
 
   def sendMessage(self, msg):
-    return self.sendString(msg.raw_message)
\ No newline at end of file
+    return self.sendString(msg.raw_message)
+
+class AsyncTradeChannel(object):
+  """ DEALER connection to trade_in shared by many AsyncTradeClients.
+
+  Every request is sent as [correlation id, '', message]. The trade engine, or
+  the trade router, echoes the frames before the empty one, so replies can come
+  back in any order and many requests can be in flight at the same time.
+  """
+  def __init__(self, zmq_context, trade_in, io_loop=None):
+    self.trade_in_socket = zmq_context.socket(zmq.DEALER)
+    self.trade_in_socket.connect(trade_in)
+    self.trade_in_socket_stream = ZMQStream(self.trade_in_socket, io_loop)
+    self.trade_in_socket_stream.on_recv(self._on_reply)
+    self.last_correlation_id = 0
+    self.pending = {}  # correlation id -> Future
+
+  def send(self, raw_message):
+    """ Returns a Future with the raw reply """
+    if isinstance(raw_message, unicode):
+      raw_message = raw_message.encode('utf-8')
+
+    self.last_correlation_id += 1
+    correlation_id = str(self.last_correlation_id)
+
+    future = Future()
+    self.pending[correlation_id] = future
+    self.trade_in_socket_stream.send_multipart([ correlation_id, '', raw_message ])
+    return future
+
+  def _on_reply(self, frames):
+    future = self.pending.pop(frames[0], None)
+    if future is not None:
+      future.set_result(frames[-1])
+
+  def close(self):
+    self.trade_in_socket_stream.close()
+    pending, self.pending = self.pending, {}
+    for future in pending.itervalues():
+      future.set_exception(TradeClientException('Connection to the trade closed'))
+
+
+class AsyncTradeClient(object):
+  """ Non blocking TradeClient. Requests go through an AsyncTradeChannel and
+  return tornado Futures instead of waiting for the reply """
+  def __init__(self, channel, reopen=True):
+    self.channel        = channel
+    self.connection_id  = None
+    self.is_logged      = False
+    self.user_id        = None
+    self.reopen         = reopen
+
+  def isConnected(self):
+    return self.connection_id is not None
+
+  @gen.coroutine
+  def connect(self):
+    response_message = yield self.channel.send( "OPN," + base64.b32encode(os.urandom(10)))
+    opt_code    = response_message[:3]
+    raw_message = response_message[4:]
+
+    if opt_code != 'OPN':
+      if opt_code == 'ERR':
+        raise TradeClientException( error_message = raw_message )
+
+      raise TradeClientException( error_message = 'Protocol Error: Unknow message opt_code received' )
+
+    self.connection_id = raw_message
+
+  def close(self):
+    if self.connection_id:
+      self.channel.send( "CLS," + self.connection_id  )
+    self.connection_id = None
+
+  @gen.coroutine
+  def sendString(self, string_msg):
+    if not self.isConnected() and self.reopen:
+      yield self.connect()
+
+    response_message        = yield self.channel.send( u"REQ," + self.connection_id + ',' + string_msg)
+    raw_resp_message_header = response_message[:3]
+    raw_resp_message        = response_message[4:].strip()
+
+    rep_msg = None
+    if raw_resp_message:
+      try:
+        rep_msg = JsonMessage(raw_resp_message)
+      except Exception:
+        pass
+
+    if raw_resp_message_header == 'CLS' and rep_msg and not rep_msg.isErrorMessage():
+      self.connection_id = None  # the trade already closed the session
+      if self.reopen:
+        yield self.connect()
+      raise gen.Return(rep_msg)
+
+    if raw_resp_message_header != 'REP':
+      self.close()
+      if self.reopen:
+        yield self.connect()
+
+      if rep_msg and rep_msg.isErrorMessage():
+        raise TradeClientException(rep_msg.get('Description'), rep_msg.get('Detail'))
+      raise TradeClientException('Invalid request: ' + raw_resp_message )
+
+    if rep_msg and rep_msg.isUserResponse():
+      if rep_msg.get("UserStatus") == 1:
+        self.user_id = rep_msg.get("UserID")
+        self.is_logged = True
+
+    raise gen.Return(rep_msg)
+
+  def sendJSON(self, json_msg):
+    import json
+    return self.sendString(json.dumps(json_msg))
+
+  def sendMessage(self, msg):
+    return self.sendString(msg.raw_message)
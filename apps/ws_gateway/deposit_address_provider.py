@@ -0,0 +1,110 @@
+import json
+import urllib
+import uuid
+from collections import deque
+
+import tornado.httpclient
+from tornado import gen
+from tornado.concurrent import Future
+
+
+class DepositAddressProvider(object):
+    """ Creates the deposit addresses on the payment processor without blocking
+    the IOLoop.
+
+    At most max_requests requests are sent to the payment processor at a time,
+    and each one gives up after timeout seconds. Up to pool_size addresses of
+    every currency and cold wallet already asked for are created ahead of time,
+    so most of the deposit requests are answered from the pool.
+    """
+
+    def __init__(self, url_payment_processor, callback_url, pool_size=5, max_requests=10, timeout=10, log=None):
+        self.url_payment_processor = url_payment_processor
+        self.callback_url = callback_url
+        self.pool_size = pool_size
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.log = log or (lambda command, key, value=None: None)
+
+        self.http_client = tornado.httpclient.AsyncHTTPClient()
+        self.active_requests = 0
+        self.waiting_requests = deque()  # futures of the requests waiting for a slot
+
+        self.pools = {}  # (currency, cold_wallet) -> deque of addresses
+        self.refilling = set()
+
+    @gen.coroutine
+    def get_address(self, currency, cold_wallet):
+        """ A dict with the input_address, the destination and the secret of a new deposit address """
+        key = (currency, cold_wallet)
+        pool = self.pools.setdefault(key, deque())
+        if pool:
+            address = pool.popleft()
+        else:
+            address = yield self.create_address(currency, cold_wallet)
+
+        self.refill(key)
+        raise gen.Return(address)
+
+    def refill(self, key):
+        if self.pool_size and key not in self.refilling and len(self.pools[key]) < self.pool_size:
+            self.refilling.add(key)
+            self._refill(key)
+
+    @gen.coroutine
+    def _refill(self, key):
+        currency, cold_wallet = key
+        try:
+            while len(self.pools[key]) < self.pool_size:
+                address = yield self.create_address(currency, cold_wallet)
+                self.pools[key].append(address)
+        except Exception as e:
+            # the next deposit request will try again
+            self.log('ERROR', 'DEPOSIT_ADDRESS_POOL', str(e))
+        finally:
+            self.refilling.discard(key)
+
+    @gen.coroutine
+    def create_address(self, currency, cold_wallet):
+        secret = uuid.uuid4().hex
+        parameters = urllib.urlencode({
+            'method': 'create',
+            'address': cold_wallet,
+            'callback': self.callback_url + secret,
+            'currency': currency
+        })
+        url = self.url_payment_processor + '?' + parameters
+
+        yield self._acquire()
+        try:
+            self.log('DEBUG', 'DEPOSIT_ADDRESS', "invoking..." + url)
+            response = yield self.http_client.fetch(url,
+                                                    connect_timeout=self.timeout,
+                                                    request_timeout=self.timeout)
+        finally:
+            self._release()
+
+        data = json.loads(response.body)
+        self.log('DEBUG', 'DEPOSIT_ADDRESS', str(data))
+
+        raise gen.Return({
+            'input_address': data['input_address'],
+            'destination': data['destination'],
+            'secret': secret
+        })
+
+    def _acquire(self):
+        future = Future()
+        if self.active_requests < self.max_requests:
+            self.active_requests += 1
+            future.set_result(None)
+        else:
+            self.waiting_requests.append(future)
+        return future
+
+    def _release(self):
+        if self.waiting_requests:
+            # the slot goes straight to the next request
+            self.waiting_requests.popleft().set_result(None)
+        else:
+            self.active_requests -= 1
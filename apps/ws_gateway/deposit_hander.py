@@ -3,83 +3,162 @@ from StringIO import StringIO
 import tornado.ioloop
 import tornado.web
 import tornado.httpclient
+from tornado import gen
 import datetime
+import hashlib
 import json
+import re
+import time
+
+from pyblinktrade.json_encoder import JsonEncoder
+from render_cache import run_in_process_pool
+
+DEPOSIT_METHOD_CACHE_TIMEOUT = 300  # seconds
+
+# deposit method id -> (expiration time, DepositMethodResponse)
+DEPOSITMETHODCACHE = {}
 
 def convertCamelCase2Underscore(name):
-  import re
   s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
   return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
-def generate_template(template, params, key=None ):
-  t = template
+PLACEHOLDER_RE = re.compile(r'\*\|([\w:]+)\|\*')
+
+MAX_COMPILED_TEMPLATES = 100
+
+# template -> CompiledTemplate
+COMPILEDTEMPLATES = {}
+
+class CompiledTemplate(object):
+  """ A template split once around its *|key|* placeholders """
+  def __init__(self, template):
+    # the literal text and the placeholder names alternate, starting with text
+    self.parts = PLACEHOLDER_RE.split(template)
+
+  def render(self, params):
+    values = {}
+    collect_template_values(values, params)
+
+    parts = list(self.parts)
+    for index in xrange(1, len(parts), 2):
+      name = parts[index]
+      parts[index] = values.get(name, '*|' + name + '|*')
+    return ''.join(parts)
+
+def collect_template_values(values, params, key=None):
+  """ Every placeholder name the params can fill: the key as is, upper case, lower case,
+  and with its camel case turned into underscores. Nested dicts are prefixed with their key """
   for k, v in params.iteritems():
     if isinstance(v, dict):
       if key:
-        t = generate_template(t, v, key + ':' + convertCamelCase2Underscore(k) )
+        collect_template_values(values, v, key + ':' + convertCamelCase2Underscore(k) )
       else:
-        t = generate_template(t, v, convertCamelCase2Underscore(k) )
+        collect_template_values(values, v, convertCamelCase2Underscore(k) )
     else:
-      if key:
-        t = t.replace('*|' + key + ':' + k + '|*', str(v) )
-        t = t.replace('*|' + key + ':' + k.upper() + '|*', str(v) )
-        t = t.replace('*|' + key + ':' + k.lower() + '|*', str(v) )
-        t = t.replace('*|' + key + ':' + convertCamelCase2Underscore(k) + '|*', str(v) )
-        t = t.replace('*|' + key + ':' + convertCamelCase2Underscore(k).upper() + '|*', str(v) )
-      else:
-        t = t.replace('*|' + k + '|*', str(v) )
-        t = t.replace('*|' + k.upper() + '|*', str(v) )
-        t = t.replace('*|' + k.lower() + '|*', str(v) )
-        t = t.replace('*|' + convertCamelCase2Underscore(k) + '|*', str(v) )
-        t = t.replace('*|' + convertCamelCase2Underscore(k).upper() + '|*', str(v) )
-  return t
+      value = str(v)
+      prefix = key + ':' if key else ''
+      underscore_key = convertCamelCase2Underscore(k)
+      for name in (k, k.upper(), k.lower(), underscore_key, underscore_key.upper()):
+        values.setdefault(prefix + name, value)  # the first key that fills a placeholder wins
+
+def generate_template(template, params):
+  global COMPILEDTEMPLATES
+  compiled_template = COMPILEDTEMPLATES.get(template)
+  if compiled_template is None:
+    if len(COMPILEDTEMPLATES) >= MAX_COMPILED_TEMPLATES:
+      COMPILEDTEMPLATES.clear()
+    compiled_template = CompiledTemplate(template)
+    COMPILEDTEMPLATES[template] = compiled_template
+  return compiled_template.render(params)
+
+def render_deposit_template(raw_html_template, deposit_data):
+  return generate_template(raw_html_template, deposit_data)
+
+def render_brazilian_deposit_system(deposit_data):
+  if 'data_documento' in deposit_data and  deposit_data['data_documento']:
+    deposit_data['data_documento'] = datetime.datetime.strptime( deposit_data['data_documento'] , "%Y-%m-%d").date()
+
+  if 'data_vencimento' in deposit_data and deposit_data['data_vencimento']:
+    deposit_data['data_vencimento'] = datetime.datetime.strptime( deposit_data['data_vencimento'] , "%Y-%m-%d").date()
+
+  if 'data_processamento' in deposit_data and deposit_data['data_processamento']:
+    deposit_data['data_processamento'] = datetime.datetime.strptime( deposit_data['data_processamento'] , "%Y-%m-%d").date()
+
+  buffer = StringIO()
+  from pyboleto.pdf import BoletoPDF
+  boleto_pdf = BoletoPDF(buffer)
+
+  from pyboleto import bank
+  ClasseBanco = bank.get_class_for_codigo(deposit_data['codigo_banco'])
+  deposit_dados = ClasseBanco()
+  for field_name, field_value in deposit_data.iteritems():
+    if field_value:
+      setattr(deposit_dados, field_name, field_value)
+  boleto_pdf.drawBoleto(deposit_dados)
+
+  boleto_pdf.save()
+  return buffer.getvalue()
 
 class DepositHandler(tornado.web.RequestHandler):
+  """ Renders the deposit slips in the process pool of the application, and keeps
+  them in its render cache by the hash of the data they were rendered from """
+
   def __init__(self, application, request, **kwargs):
     super(DepositHandler, self).__init__(application, request, **kwargs)
     self.remote_ip = request.headers.get('X-Forwarded-For', request.headers.get('X-Real-Ip', request.remote_ip))
 
+  @gen.coroutine
+  def render_cached(self, deposit_id, source, function, *args):
+    key = deposit_id + '-' + hashlib.sha1(json.dumps(source, sort_keys=True, cls=JsonEncoder)).hexdigest()
+    content = self.application.deposit_render_cache.get(key)
+    if content is None:
+      content = yield run_in_process_pool(self.application.deposit_render_pool, function, *args)
+      self.application.deposit_render_cache.set(key, content)
+    raise gen.Return(content)
+
+  @gen.coroutine
   def write_deposit_template(self, deposit_method, deposit):
     raw_html_template =  deposit_method.get('HtmlTemplate')
     deposit_data = deposit.toJSON()
+    if 'remote_ip' not in (raw_html_template or '').lower() and isinstance(deposit_data.get('Data'), dict):
+      # the client address doesn't show on this template, so it must not split the cache by visitor
+      deposit_data['Data'] = dict( (k, v) for k, v in deposit_data['Data'].iteritems() if k != 'remote_ip' )
     deposit_data['Value'] = self.application.format_currency(deposit_data['Currency'],deposit_data['Value'])
-    deposit_html = generate_template(raw_html_template, deposit_data)
+    deposit_html = yield self.render_cached(deposit.get('DepositID'),
+                                            [raw_html_template, deposit_data],
+                                            render_deposit_template,
+                                            raw_html_template,
+                                            deposit_data)
     self.write(deposit_html)
 
+  @gen.coroutine
   def write_brazilian_deposit_system(self,deposit):
     deposit_data = deposit.get('Data')
-    if 'data_documento' in deposit_data and  deposit_data['data_documento']:
-      deposit_data['data_documento'] = datetime.datetime.strptime( deposit_data['data_documento'] , "%Y-%m-%d").date()
-
-    if 'data_vencimento' in deposit_data and deposit_data['data_vencimento']:
-      deposit_data['data_vencimento'] = datetime.datetime.strptime( deposit_data['data_vencimento'] , "%Y-%m-%d").date()
-
-    if 'data_processamento' in deposit_data and deposit_data['data_processamento']:
-      deposit_data['data_processamento'] = datetime.datetime.strptime( deposit_data['data_processamento'] , "%Y-%m-%d").date()
-
-    buffer = StringIO()
-    from pyboleto.pdf import BoletoPDF
-    boleto_pdf = BoletoPDF(buffer)
-
-    from pyboleto import bank
-    ClasseBanco = bank.get_class_for_codigo(deposit_data['codigo_banco'])
-    deposit_dados = ClasseBanco()
-    for field_name, field_value in deposit_data.iteritems():
-      if field_value:
-        setattr(deposit_dados, field_name, field_value)
-    boleto_pdf.drawBoleto(deposit_dados)
-
+    # the client address does not show on the boleto
+    rendered_data = dict( (k, v) for k, v in deposit_data.iteritems() if k != 'remote_ip' )
+    pdf_file = yield self.render_cached(deposit.get('DepositID'),
+                                        rendered_data,
+                                        render_brazilian_deposit_system,
+                                        deposit_data)
 
     self.set_header("Content-Type", "application/pdf")
-
-
-    boleto_pdf.save()
-    pdf_file = buffer.getvalue()
-
     self.write( pdf_file )
 
+  @gen.coroutine
+  def get_deposit_method(self, deposit_method_id):
+    global DEPOSITMETHODCACHE
+    cached = DEPOSITMETHODCACHE.get(deposit_method_id)
+    if cached and cached[0] > time.time():
+      raise gen.Return(cached[1])
 
+    deposit_method_response_msg = yield self.application.application_async_trade_client.sendString(
+      json.dumps({ 'MsgType': 'U48', 'DepositMethodReqID': 1, 'DepositMethodID': deposit_method_id }))
+
+    if deposit_method_response_msg and deposit_method_response_msg.isDepositMethodResponse():
+      DEPOSITMETHODCACHE[deposit_method_id] = (time.time() + DEPOSIT_METHOD_CACHE_TIMEOUT, deposit_method_response_msg)
+    raise gen.Return(deposit_method_response_msg)
 
+  @gen.coroutine
   def get(self, *args, **kwargs):
     deposit_id = self.get_argument("deposit_id", default=None, strip=False)
     download = int(self.get_argument("download", default="0", strip=False))
@@ -87,7 +166,7 @@ class DepositHandler(tornado.web.RequestHandler):
       self.send_error(404)
       return
 
-    deposit_response_msg = self.application.application_trade_client.sendString(
+    deposit_response_msg = yield self.application.application_async_trade_client.sendString(
       json.dumps({ 'MsgType': 'U18', 'DepositReqID': 1, 'DepositID': deposit_id }))
 
     if not deposit_response_msg or not deposit_response_msg.isDepositResponse():
@@ -95,8 +174,7 @@ class DepositHandler(tornado.web.RequestHandler):
       return
 
     deposit_method_id = deposit_response_msg.get('DepositMethodID')
-    deposit_method_response_msg = self.application.application_trade_client.sendString(
-      json.dumps({ 'MsgType': 'U48', 'DepositMethodReqID': 1, 'DepositMethodID': deposit_method_id }))
+    deposit_method_response_msg = yield self.get_deposit_method(deposit_method_id)
 
     if not deposit_method_response_msg or not deposit_method_response_msg.isDepositMethodResponse():
       self.send_error(404)
@@ -113,9 +191,9 @@ class DepositHandler(tornado.web.RequestHandler):
                       "attachment; filename=%s"%deposit_method_response_msg['DepositMethodName'] + '.html')
 
     if deposit_response_msg.get('Type') == 'BBS':
-      self.write_brazilian_deposit_system(deposit_response_msg)
+      yield self.write_brazilian_deposit_system(deposit_response_msg)
     elif deposit_response_msg.get('Type') == 'DTP':
-      self.write_deposit_template(deposit_method_response_msg, deposit_response_msg)
+      yield self.write_deposit_template(deposit_method_response_msg, deposit_response_msg)
 
     else:
       self.write('Invalid deposit type')
@@ -1,21 +1,104 @@
-from datetime import datetime
+from collections import deque
+from datetime import date
 from pyblinktrade.signals import Signal
 
 import time
 
 signal_publish_security_status = Signal()
 
+# name -> seconds. The 24h window backs HighPx, LowPx, BuyVolume, SellVolume and
+# VWAP, and every window is published on the Windows of the SecurityStatus
+STATUS_WINDOWS = {
+    '1h': 3600,
+    '24h': 86400,
+    '7d': 7 * 86400
+}
+
+def get_trade_timestamp(trade):
+    """ seconds of the trade_date and trade_time of the trade, without strptime """
+    trade_date = trade['trade_date']
+    trade_time = trade['trade_time']
+    days = date(int(trade_date[0:4]), int(trade_date[5:7]), int(trade_date[8:10])).toordinal()
+    return days * 86400 + int(trade_time[0:2]) * 3600 + int(trade_time[3:5]) * 60 + int(trade_time[6:8])
+
+
+class RollingWindowStatus(object):
+    """ High, low, volumes and VWAP of the trades of the last seconds.
+
+    The trades leave the window as newer ones come in. The high and the low are
+    kept in monotonic deques, so every trade is added and removed once. """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.trades = deque()       # (timestamp, sequence, price, size)
+        self.max_trades = deque()   # decreasing prices
+        self.min_trades = deque()   # increasing prices
+        self.sequence = 0
+        self.volume_price = 0
+        self.volume_size = 0
+        self.volume_notional = 0    # sum of price * size, for the VWAP
+
+    def push(self, timestamp, price, size):
+        self.expire(timestamp)
+
+        self.sequence += 1
+        trade = (timestamp, self.sequence, price, size)
+        self.trades.append(trade)
+
+        while self.max_trades and self.max_trades[-1][2] <= price:
+            self.max_trades.pop()
+        self.max_trades.append(trade)
+
+        while self.min_trades and self.min_trades[-1][2] >= price:
+            self.min_trades.pop()
+        self.min_trades.append(trade)
+
+        self.volume_price += int(price * size / 1.e8)
+        self.volume_size += size
+        self.volume_notional += price * size
+
+    def expire(self, timestamp):
+        while self.trades and timestamp - self.trades[0][0] >= self.seconds:
+            timestamp_removed, sequence, price, size = self.trades.popleft()
+            if self.max_trades[0][1] == sequence:
+                self.max_trades.popleft()
+            if self.min_trades[0][1] == sequence:
+                self.min_trades.popleft()
+            self.volume_price -= int(price * size / 1.e8)
+            self.volume_size -= size
+            self.volume_notional -= price * size
+
+    @property
+    def max_price(self):
+        if self.max_trades:
+            return self.max_trades[0][2]
+        return 0
+
+    @property
+    def min_price(self):
+        if self.min_trades:
+            return self.min_trades[0][2]
+        return None
+
+    @property
+    def vwap(self):
+        if self.volume_size:
+            return int(self.volume_notional / self.volume_size)
+        return None
+
+
 class InstrumentStatusHelper(object):
     """" InstrumentStatusHelper. """
 
     def __init__(self, symbol = "ALL"):
         self.symbol = str(symbol)
-        self.last_trades = []
+        self.windows = dict( (name, RollingWindowStatus(seconds)) for name, seconds in STATUS_WINDOWS.iteritems() )
         self.volume_price = 0
         self.volume_size = 0
         self.last_price = 0
         self.max_price = 0
         self.min_price = None
+        self.vwap = None
         self.bid = None
         self.ask = None
         self.timestamp_last_update = int(time.time() * 1000)
@@ -32,55 +115,30 @@ class InstrumentStatusHelper(object):
         self.ask = ask
         signal_publish_security_status('SECURITY_STATUS', self)
 
-    def _subtract_trade(self, trade):
-        volume_price = int(
-            trade['price'] *
-            trade['size'] /
-            1.e8)
-
-        self.volume_price -= volume_price
-        self.volume_size -= trade['size']
-
-        if self.max_price == trade['price']:
-            if self.last_trades:
-                max_price_record = max(self.last_trades, key=lambda x:x['price'])
-                if max_price_record:
-                    self.max_price = max_price_record['price']
-                else:
-                    self.max_price = 0
-            else:
-                self.max_price = 0
-
-        if self.min_price == trade['price']:
-            if self.last_trades:
-                min_price = min(self.last_trades, key=lambda x:x['price'])
-                if min_price:
-                    self.min_price = min_price['price']
-
-    def _add_trade(self, trade):
-        volume_price = int( trade['price'] * trade['size'] / 1.e8)
-        self.volume_price += volume_price
-        self.volume_size += trade['size']
-
-        if trade['price'] > self.max_price:
-            self.max_price = trade['price']
-
-        if self.min_price is None or trade['price'] < self.min_price:
-            self.min_price = trade['price']
-
     def push_trade(self, trade):
-        while True:
-            if len(self.last_trades) > 0:
-                d1 = datetime.strptime(self.last_trades[-1]['trade_date'] + ' ' + self.last_trades[-1]['trade_time'], '%Y-%m-%d %H:%M:%S')
-                d2 = datetime.strptime(trade['trade_date'] + ' ' + trade['trade_time'], '%Y-%m-%d %H:%M:%S')
-                if (d2 - d1).days > 0:
-                    removed_trade = self.last_trades.pop()
-                    self._subtract_trade(removed_trade)
-                    continue
-            break
-
-        self.last_trades.insert(0,trade)
-        self._add_trade(trade)
+        timestamp = get_trade_timestamp(trade)
+        for window in self.windows.itervalues():
+            window.push(timestamp, trade['price'], trade['size'])
+
+        window = self.windows['24h']
+        self.volume_price = window.volume_price
+        self.volume_size = window.volume_size
+        self.max_price = window.max_price
+        self.min_price = window.min_price
+        self.vwap = window.vwap
         self.last_price = trade['price']
 
         signal_publish_security_status('SECURITY_STATUS', self)
+
+    def get_windows_status(self):
+        """ name -> HighPx, LowPx, BuyVolume, SellVolume and VWAP of every window """
+        status = {}
+        for name, window in self.windows.iteritems():
+            status[name] = {
+                "HighPx": window.max_price,
+                "LowPx": window.min_price,
+                "BuyVolume": window.volume_price,
+                "SellVolume": window.volume_size,
+                "VWAP": window.vwap
+            }
+        return status
@@ -21,6 +21,9 @@
 import os
 import sys
 import logging
+import multiprocessing
+import multiprocessing.pool
+import collections
 
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
 sys.path.insert(0, os.path.join( os.path.dirname(__file__), '../' ) )
@@ -33,17 +36,16 @@ import tornado.ioloop
 import tornado.web
 import tornado.httpserver
 import tornado.template
+import tornado.httpclient
 from tornado import websocket
+from tornado import gen
 
-import urllib
-import urllib2
 import json
-import uuid
 from pyblinktrade.json_encoder import JsonEncoder
 
 import zmq
 from pyblinktrade.message import JsonMessage, InvalidMessageException
-from trade.zmq_client  import TradeClient, TradeClientException
+from trade.zmq_client  import TradeClient, TradeClientException, AsyncTradeChannel, AsyncTradeClient
 
 from pyblinktrade.project_options import ProjectOptions
 
@@ -59,6 +61,11 @@ from process_deposit_handler import ProcessDepositHandler
 from verification_webhook_handler import VerificationWebHookHandler
 from deposit_receipt_webhook_handler import  DepositReceiptWebHookHandler
 from rest_api_handler import RestApiHandler
+from trade_pub_subscriber import TradePubSubscriber
+from trade_sink import TradeSink
+from deposit_address_provider import DepositAddressProvider
+from render_cache import RenderCache
+from instrument_helper import STATUS_WINDOWS
 import datetime
 
 from sqlalchemy import create_engine
@@ -77,10 +84,11 @@ class WebSocketHandler(websocket.WebSocketHandler):
                 request.remote_ip))
         application.log('INFO', 'CONNECTION_OPEN', self.remote_ip )
 
-        self.trade_client = TradeClient(
-            self.application.zmq_context,
-            self.application.trade_in_socket,
-            self.application.options.trade_pub)
+        self.trade_client = AsyncTradeClient(self.application.trade_channel)
+        self.connecting = None
+        self.message_queue = collections.deque()  # the message being processed comes first
+        self.pending_write_bytes = 0  # written since the socket last caught up with us
+        self.trade_pub_topic = None
         self.md_subscriptions = {}
         self.sec_status_subscriptions = {}
 
@@ -90,9 +98,16 @@ class WebSocketHandler(websocket.WebSocketHandler):
         self.write_message(str(message[1]))
 
     def open(self):
+        self.connecting = self.trade_client.connect()
+        self.connecting.add_done_callback(self.on_trade_connect)
+
+    def on_trade_connect(self, future):
         try:
-            self.trade_client.connect()
-            self.trade_client.on_trade_publish = self.on_trade_publish
+            future.result()
+            if self.ws_connection is None:
+                # the browser left before the trade opened the session
+                self.trade_client.close()
+                return
             self.application.register_connection(self)
 
         except TradeClientException as e:
@@ -104,14 +119,44 @@ class WebSocketHandler(websocket.WebSocketHandler):
             self.close()
 
     def write_message(self, message, binary=False):
+        if self.ws_connection is None:
+            return  # the browser left while the trade was processing the request
         self.application.log('OUT', self.trade_client.connection_id, message )
         super(WebSocketHandler, self).write_message(message, binary)
+        if self.stream is None or not self.stream.writing():
+            self.pending_write_bytes = 0
+        else:
+            self.pending_write_bytes += len(message)
 
     def close(self):
       self.application.log('DEBUG', self.remote_ip, 'WebSocketHandler.close() invoked' )
       super(WebSocketHandler, self).close()
 
     def on_message(self, raw_message):
+        # the messages are processed one at a time, in the order they arrived, so a
+        # request waiting on the trade or on the payment processor isn't overtaken
+        # by the next ones
+        self.message_queue.append(raw_message)
+        if len(self.message_queue) == 1:
+            self.process_message_queue()
+
+    @gen.coroutine
+    def process_message_queue(self):
+        while self.message_queue:
+            try:
+                yield self.process_message(self.message_queue[0])
+            except Exception as e:
+                self.application.log('ERROR', self.remote_ip, 'process_message: ' + str(e))
+            self.message_queue.popleft()
+
+    @gen.coroutine
+    def process_message(self, raw_message):
+        # wait for the connection with the trade to be opened
+        try:
+            yield self.connecting
+        except TradeClientException:
+            return
+
         if not self.trade_client.isConnected():
             return
 
@@ -179,31 +224,18 @@ class WebSocketHandler(websocket.WebSocketHandler):
 
                 currency = req_msg.get('Currency')
 
-                secret = uuid.uuid4().hex
                 cold_wallet = self.get_broker_wallet('cold', currency)
-                callback_url = self.application.options.callback_url + secret
                 if not cold_wallet:
                     return
 
-                parameters = urllib.urlencode({
-                    'method': 'create',
-                    'address': cold_wallet,
-                    'callback': callback_url,
-                    'currency': currency
-                })
-
-
                 try:
-                    url_payment_processor = self.application.options.url_payment_processor + '?' + parameters
-                    self.application.log('DEBUG', self.trade_client.connection_id, "invoking..."  + url_payment_processor )
-                    response = urllib2.urlopen(url_payment_processor)
-                    data = json.load(response)
-                    self.application.log('DEBUG', self.trade_client.connection_id, str(data) )
-
-                    req_msg.set('InputAddress', data['input_address'])
-                    req_msg.set('Destination', data['destination'])
-                    req_msg.set('Secret', secret)
-                except urllib2.HTTPError as e:
+                    address = yield self.application.deposit_address_provider.get_address(currency, cold_wallet)
+                    self.application.log('DEBUG', self.trade_client.connection_id, str(address) )
+
+                    req_msg.set('InputAddress', address['input_address'])
+                    req_msg.set('Destination', address['destination'])
+                    req_msg.set('Secret', address['secret'])
+                except tornado.httpclient.HTTPError as e:
                     out_message = json.dumps({
                       'MsgType': 'ERROR',
                       'ReqID': req_msg.get('DepositReqID'),
@@ -223,12 +255,19 @@ class WebSocketHandler(websocket.WebSocketHandler):
                     return
 
         try:
-            resp_message = self.trade_client.sendMessage(req_msg)
+            connection_id = self.trade_client.connection_id
+            resp_message = yield self.trade_client.sendMessage(req_msg)
             if resp_message:
                 self.write_message(resp_message.raw_message)
 
+            if self.trade_client.connection_id != connection_id:
+                # the trade closed the session, and the client opened a new one
+                self.unsubscribe_trade_publications()
+
             if resp_message and resp_message.isUserResponse():
                 self.user_response = resp_message
+                if self.is_user_logged():
+                    self.subscribe_trade_publications(resp_message.get('UserID'))
 
             if not self.trade_client.isConnected():
                 self.application.log('DEBUG', self.trade_client.connection_id, 'not self.trade_client.isConnected()' )
@@ -246,6 +285,19 @@ class WebSocketHandler(websocket.WebSocketHandler):
             self.trade_client.close()
             self.close()
 
+    def subscribe_trade_publications(self, user_id):
+        topic = str(user_id)
+        if topic == self.trade_pub_topic:
+            return
+        self.unsubscribe_trade_publications()
+        self.trade_pub_topic = topic
+        self.application.trade_pub_subscriber.subscribe(topic, self.on_trade_publish)
+
+    def unsubscribe_trade_publications(self):
+        if self.trade_pub_topic:
+            self.application.trade_pub_subscriber.unsubscribe(self.trade_pub_topic, self.on_trade_publish)
+            self.trade_pub_topic = None
+
     def is_user_logged(self):
         if not self.user_response:
             return False
@@ -271,6 +323,9 @@ class WebSocketHandler(websocket.WebSocketHandler):
 
     def on_close(self):
         self.application.log('DEBUG', self.trade_client.connection_id, 'WebSocketHandler.on_close' )
+        for md_publishers in self.md_subscriptions.itervalues():
+            for md_publisher in md_publishers:
+                md_publisher.close()
         self.application.unregister_connection(self)
         self.trade_client.close()
 
@@ -335,6 +390,8 @@ class WebSocketHandler(websocket.WebSocketHandler):
         # Disable previous Snapshot + Update Request
         if int(msg.get('SubscriptionRequestType')) == 2:
             if req_id in self.md_subscriptions:
+                for md_publisher in self.md_subscriptions[req_id]:
+                    md_publisher.close()
                 del self.md_subscriptions[req_id]
             return
 
@@ -342,6 +399,14 @@ class WebSocketHandler(websocket.WebSocketHandler):
         instruments = msg.get('Instruments')
         entries = msg.get('MDEntryTypes')
 
+        # milliseconds between the incremental updates. Zero sends them as they come
+        conflation_interval = int(msg.get('MDConflationInterval') or 0)
+
+        # '3' order depth, '2' price depth
+        book_type = str(msg.get('MDBkTyp') or '3')
+        if book_type not in ('2', '3'):
+            book_type = '3'
+
         if int(msg.get('SubscriptionRequestType')) == 1:  # Snapshot + Updates
             if req_id not in self.md_subscriptions:
                 self.md_subscriptions[req_id] = []
@@ -351,7 +416,8 @@ class WebSocketHandler(websocket.WebSocketHandler):
                 instrument,
                 market_depth,
                 entries,
-                req_id)
+                req_id,
+                book_type)
             self.write_message(str(json.dumps(md, cls=JsonEncoder)))
 
             # Snapshot + Updates
@@ -362,12 +428,33 @@ class WebSocketHandler(websocket.WebSocketHandler):
                         market_depth,
                         entries,
                         instrument,
-                        self.on_send_json_msg_to_user))
+                        self.on_send_raw_msg_to_user,
+                        conflation_interval,
+                        book_type))
 
     def on_send_json_msg_to_user(self, sender, json_msg):
         s = json.dumps(json_msg, cls=JsonEncoder)
         self.write_message(s)
 
+    def on_send_raw_msg_to_user(self, sender, raw_msg):
+        self.write_message(raw_msg)
+
+        if self.is_write_buffer_congested():
+            # the client is not keeping up with the market data
+            for md_publishers in self.md_subscriptions.itervalues():
+                for md_publisher in md_publishers:
+                    if not md_publisher.is_conflated():
+                        self.application.log('INFO', self.trade_client.connection_id, 'CONFLATE_MARKET_DATA')
+                        md_publisher.conflate(self.application.md_conflation_interval, md_publisher.market_depth)
+
+    def is_write_buffer_congested(self):
+        # counts everything written since the write buffer was last empty, so it never
+        # underestimates what is still waiting, without walking the buffer on every message
+        high_water_mark = self.application.md_conflation_high_water_mark
+        if not high_water_mark:
+            return False
+        return self.pending_write_bytes > high_water_mark
+
 
 class WebSocketGatewayApplication(tornado.web.Application):
 
@@ -411,17 +498,59 @@ class WebSocketGatewayApplication(tornado.web.Application):
         self.db_session = scoped_session(sessionmaker(bind=engine))
         db_bootstrap(self.db_session)
 
+        # the trades published by the trade engine are stored in batches
+        self.trade_sink = TradeSink(self.db_session, log=self.log)
+
+        self.deposit_address_provider = DepositAddressProvider(
+            self.options.url_payment_processor,
+            self.options.callback_url,
+            pool_size=int(self.options.deposit_address_pool_size or 0),
+            max_requests=int(self.options.payment_processor_max_requests or 10),
+            timeout=float(self.options.payment_processor_timeout or 10),
+            log=self.log)
+
+
+        # market data subscriptions of clients with more than
+        # md_conflation_high_water_mark bytes waiting to be written are switched
+        # to one update every md_conflation_interval milliseconds
+        self.md_conflation_interval = int(self.options.md_conflation_interval or 250)
+        self.md_conflation_high_water_mark = 1024 * 1024
+        if self.options.md_conflation_high_water_mark is not None:
+            self.md_conflation_high_water_mark = int(self.options.md_conflation_high_water_mark)
+
+        # the deposit slips are rendered by worker processes, forked before any socket is open.
+        # A daemonic process can't have children (apps/main.py starts the gateways as
+        # non-daemonic for this reason), so there they are rendered by threads instead.
+        deposit_render_processes = int(self.options.deposit_render_processes or 2)
+        if multiprocessing.current_process().daemon:
+            self.deposit_render_pool = multiprocessing.pool.ThreadPool(deposit_render_processes)
+        else:
+            self.deposit_render_pool = multiprocessing.Pool(deposit_render_processes)
+        self.deposit_render_cache = RenderCache(
+            self.options.deposit_render_cache_dir or os.path.join(ROOT_PATH, 'cache', 'deposits'),
+            int(self.options.deposit_render_cache_size or 1000))
 
         self.zmq_context = zmq.Context()
 
+        # the requests of the websocket connections are multiplexed over a single
+        # DEALER socket and never block the IOLoop.
+        self.trade_channel = AsyncTradeChannel(self.zmq_context, self.options.trade_in)
+
+        # the gateway's own requests, at startup and from the webhooks
         self.trade_in_socket = self.zmq_context.socket(zmq.REQ)
         self.trade_in_socket.connect(self.options.trade_in)
 
+        # all the publications reach the gateway through a single SUB socket
+        self.trade_pub_subscriber = TradePubSubscriber(self.zmq_context, self.options.trade_pub)
+
         self.application_trade_client = TradeClient(
             self.zmq_context,
             self.trade_in_socket)
         self.application_trade_client.connect()
 
+        # the gateway's own requests from the IOLoop handlers
+        self.application_async_trade_client = AsyncTradeClient(self.trade_channel)
+
         self.security_list = self.application_trade_client.getSecurityList()
         self.md_subscriber = {}
 
@@ -429,13 +558,13 @@ class WebSocketGatewayApplication(tornado.web.Application):
             symbol = instrument['Symbol']
             self.md_subscriber[symbol] = MarketDataSubscriber.get(symbol, self)
             self.md_subscriber[symbol].subscribe(
-                self.zmq_context,
-                self.options.trade_pub,
+                self.trade_pub_subscriber,
                 self.application_trade_client)
 
         last_trade_id = Trade.get_last_trade_id(self.db_session)
         trade_list = self.application_trade_client.getLastTrades(last_trade_id)
 
+        catch_up_trades = []
         for trade in trade_list:
             msg = dict()
             msg['id']               = trade[0]
@@ -450,16 +579,20 @@ class WebSocketGatewayApplication(tornado.web.Application):
             msg['trade_time']       = trade[7][11:]
             msg['order_id']         = trade[8]
             msg['counter_order_id'] = trade[9]
-            Trade.create( self.db_session, msg)
-
-        all_trades = Trade.get_all_trades(self.db_session)
-        for t in all_trades:
-          trade_info = dict()
-          trade_info['price'] = t.price
-          trade_info['size'] = t.size
-          trade_info['trade_date'] = t.created.strftime('%Y-%m-%d')
-          trade_info['trade_time'] = t.created.strftime('%H:%M:%S')
-          self.md_subscriber[ t.symbol ].inst_status.push_trade(trade_info)
+            catch_up_trades.append(msg)
+        Trade.bulk_create(self.db_session, catch_up_trades)
+
+        # only the trades inside the longest statistics window matter
+        last_trade_created = Trade.get_last_trade_created(self.db_session)
+        if last_trade_created:
+          window_start = last_trade_created - datetime.timedelta(seconds=max(STATUS_WINDOWS.values()))
+          for t in Trade.get_trades_created_since(self.db_session, window_start):
+            trade_info = dict()
+            trade_info['price'] = t.price
+            trade_info['size'] = t.size
+            trade_info['trade_date'] = t.created.strftime('%Y-%m-%d')
+            trade_info['trade_time'] = t.created.strftime('%H:%M:%S')
+            self.md_subscriber[ t.symbol ].inst_status.push_trade(trade_info)
 
         for symbol, subscriber in self.md_subscriber.iteritems():
             subscriber.ready()
@@ -488,9 +621,17 @@ class WebSocketGatewayApplication(tornado.web.Application):
         self.log('PARAM','trade_in'             ,self.options.trade_in)
         self.log('PARAM','trade_pub'            ,self.options.trade_pub)
         self.log('PARAM','url_payment_processor',self.options.url_payment_processor)
+        self.log('PARAM','deposit_address_pool_size',self.options.deposit_address_pool_size)
+        self.log('PARAM','payment_processor_max_requests',self.options.payment_processor_max_requests)
+        self.log('PARAM','payment_processor_timeout',self.options.payment_processor_timeout)
+        self.log('PARAM','deposit_render_processes',self.options.deposit_render_processes)
+        self.log('PARAM','deposit_render_cache_dir',self.options.deposit_render_cache_dir)
+        self.log('PARAM','deposit_render_cache_size',self.options.deposit_render_cache_size)
         self.log('PARAM','session_timeout_limit',self.options.session_timeout_limit)
         self.log('PARAM','db_echo'              ,self.options.db_echo)
         self.log('PARAM','db_engine'            ,self.options.db_engine)
+        self.log('PARAM','md_conflation_interval',self.options.md_conflation_interval)
+        self.log('PARAM','md_conflation_high_water_mark',self.options.md_conflation_high_water_mark)
         self.log('PARAM','END')
 
 
@@ -518,6 +659,10 @@ class WebSocketGatewayApplication(tornado.web.Application):
         except Exception as e:
             pass
 
+        if self.application_async_trade_client.isConnected():
+            heartbeat = self.application_async_trade_client.sendJSON({'MsgType': '1', 'TestReqID': '0'})
+            heartbeat.add_done_callback(lambda future: future.exception())
+
     def register_connection(self, ws_client):
         self.log('INFO', 'REGISTER_CONNECTION',  {'remote_ip': ws_client.remote_ip, 'trade.connection_id':  ws_client.trade_client.connection_id  }  )
         if ws_client.trade_client.connection_id in self.connections:
@@ -527,6 +672,7 @@ class WebSocketGatewayApplication(tornado.web.Application):
 
     def unregister_connection(self, ws_client):
         self.log('INFO', 'UNREGISTER_CONNECTION',  {'remote_ip': ws_client.remote_ip, 'trade.connection_id':  ws_client.trade_client.connection_id  }  )
+        ws_client.unsubscribe_trade_publications()
         if ws_client.trade_client.connection_id in self.connections:
             del self.connections[ws_client.trade_client.connection_id]
             return True
@@ -534,7 +680,12 @@ class WebSocketGatewayApplication(tornado.web.Application):
 
     def clean_up(self):
         self.heart_beat_timer.stop()
+        self.trade_sink.flush()
         self.application_trade_client.close()
+        self.application_async_trade_client.close()
+        self.trade_pub_subscriber.close()
+        self.deposit_render_pool.terminate()
+        self.trade_channel.close()
 
         for client_connection_id in self.connections:
             self.connections[client_connection_id].trade_client.close()
@@ -1,29 +1,208 @@
 import os
 import base64
+import bisect
 import json
 import time
 
+import tornado.ioloop
+
 from instrument_helper import InstrumentStatusHelper, signal_publish_security_status
 from pyblinktrade.signals import Signal
 
-import zmq
-from zmq.eventloop.zmqstream import ZMQStream
-
 from pyblinktrade.message import JsonMessage
+from pyblinktrade.json_encoder import JsonEncoder
 
 from models import Trade
 
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 MDSUBSCRIBEDICT = {}
 
+TRADE_BUFFER_SIZE = 10000
+
 signal_order_depth_entry = Signal()
+signal_price_depth_entry = Signal()
 signal_publish_md_order_depth_incremental = Signal()
 signal_publish_md_status = Signal()
 
 
+def generate_price_level_entry(symbol, update_action, position, level):
+    return {
+        "MDUpdateAction": update_action,
+        "Symbol": symbol,
+        "MDEntryType": level['side'],
+        "MDEntryPositionNo": position,
+        "MDEntryPx": level['price'],
+        "MDEntrySize": level['qty'],
+        "NumberOfOrders": level['count']
+    }
+
+
+class PriceLevelBook(object):
+    """ One side of the book aggregated by price: the total quantity and the
+    number of orders of every price level.
+
+    Every change to a level is recorded as a price depth incremental entry, with
+    the position of the level, so that they can be applied in order. """
+
+    def __init__(self, symbol, side):
+        self.symbol = symbol
+        self.side = side
+        self.levels = {}  # price -> level
+        self.keys = []  # sorted, the best level first. The bids are kept by their negative price
+        self.entry_list = []
+
+    def _key(self, price):
+        if self.side == '0':
+            return -price
+        return price
+
+    def _position(self, price):
+        return bisect.bisect_left(self.keys, self._key(price)) + 1
+
+    def clear(self):
+        self.levels = {}
+        self.keys = []
+        self.entry_list = []
+
+    def add(self, price, qty):
+        level = self.levels.get(price)
+        if level is None:
+            level = {'side': self.side, 'price': price, 'qty': qty, 'count': 1}
+            self.levels[price] = level
+            key = self._key(price)
+            index = bisect.bisect_left(self.keys, key)
+            self.keys.insert(index, key)
+            self.entry_list.append(generate_price_level_entry(self.symbol, '0', index + 1, level))
+            return
+
+        self._set_level(level, level['qty'] + qty, level['count'] + 1)
+
+    def remove(self, price, qty):
+        level = self.levels[price]
+        if level['count'] == 1:
+            position = self._position(price)
+            del self.keys[position - 1]
+            del self.levels[price]
+            self.entry_list.append({
+                "MDUpdateAction": "2",  # Delete
+                "Symbol": self.symbol,
+                "MDEntryType": self.side,
+                "MDEntryPositionNo": position
+            })
+            return
+
+        self._set_level(level, level['qty'] - qty, level['count'] - 1)
+
+    def update(self, price, old_qty, qty):
+        level = self.levels[price]
+        self._set_level(level, level['qty'] - old_qty + qty, level['count'])
+
+    def _set_level(self, level, qty, count):
+        level = dict(level, qty=qty, count=count)  # the levels already handed out must not change
+        self.levels[level['price']] = level
+
+        if self.entry_list:
+            last_entry = self.entry_list[-1]
+            if last_entry.get('MDEntryPx') == level['price'] and last_entry['MDUpdateAction'] in ('0', '1'):
+                # the level changed again in the same update
+                last_entry['MDEntrySize'] = qty
+                last_entry['NumberOfOrders'] = count
+                return
+
+        self.entry_list.append(generate_price_level_entry(self.symbol, '1', self._position(level['price']), level))
+
+    def pop_entry_list(self):
+        entry_list = self.entry_list
+        self.entry_list = []
+        return entry_list
+
+    def get_levels(self, depth=0):
+        keys = self.keys
+        if depth > 0:
+            keys = keys[:depth]
+        if self.side == '0':
+            return [ self.levels[-key] for key in keys ]
+        return [ self.levels[key] for key in keys ]
+
+
+class RecentTrade(object):
+    """ The columns of a Trade, detached from the database session """
+    __slots__ = ('id', 'symbol', 'side', 'price', 'size', 'created', 'order_id',
+                 'counter_order_id', 'buyer_username', 'seller_username')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs[name])
+
+    @staticmethod
+    def from_model(trade):
+        return RecentTrade(**dict( (name, getattr(trade, name)) for name in RecentTrade.__slots__ ))
+
+
+class TradeBuffer(object):
+    """ The most recent trades, sorted by id.
+
+    Keeps between size and twice size trades, and it is loaded from the database
+    on first use. All the trades since the oldest one it holds are in the
+    buffer, or every trade when nothing was ever left out. The queries return
+    None when they need older trades than that. """
+
+    def __init__(self, size=TRADE_BUFFER_SIZE):
+        self.size = size
+        self.ids = []
+        self.created = []
+        self.trades = []
+        self.is_loaded = False
+        self.is_complete = False
+
+    def load(self, trades):
+        trades = list(trades)
+        for trade in trades:
+            self.push(RecentTrade.from_model(trade))
+        self.is_loaded = True
+        self.is_complete = len(trades) < self.size and len(self.trades) <= 2 * self.size
+
+    def push(self, trade):
+        index = bisect.bisect_left(self.ids, trade.id)
+        if index < len(self.ids) and self.ids[index] == trade.id:
+            return
+
+        self.ids.insert(index, trade.id)
+        self.created.insert(index, trade.created)
+        self.trades.insert(index, trade)
+
+        if len(self.trades) > 2 * self.size:
+            del self.ids[:self.size]
+            del self.created[:self.size]
+            del self.trades[:self.size]
+            self.is_complete = False
+
+    def get_since(self, trade_id):
+        """ The trades after trade_id, newest first """
+        if not self.is_loaded or not (self.is_complete or (self.ids and trade_id >= self.ids[0])):
+            return None
+        index = bisect.bisect_right(self.ids, trade_id)
+        return self.trades[:index - 1:-1] if index else self.trades[::-1]
+
+    def get_last(self, timestamp, page_size=None, offset=0):
+        """ The trades created since timestamp, newest first """
+        if not self.is_loaded or not (self.is_complete or (self.created and timestamp > self.created[0])):
+            return None
+        begin = bisect.bisect_left(self.created, timestamp)
+        end = len(self.trades) - (offset or 0)
+        if page_size:
+            begin = max(begin, end - page_size)
+        if end <= begin:
+            return []
+        return self.trades[begin:end][::-1]
+
+# the trades of every symbol
+RECENT_TRADES = TradeBuffer()
+
+
 class MarketDataSubscriber(object):
     """" MarketDataSubscriber. """
 
@@ -37,27 +216,27 @@ class MarketDataSubscriber(object):
         self.symbol = str(symbol)
         self.buy_side = []
         self.sell_side = []
+        self.buy_levels = PriceLevelBook(self.symbol, '0')
+        self.sell_levels = PriceLevelBook(self.symbol, '1')
         self.volume_dict = {}
+        self.recent_trades = TradeBuffer()
+
+        # incremented on every change, so that the cached REST responses know they are stale
+        self.book_version = 0
+        self.trades_version = 0
         self.inst_status = InstrumentStatusHelper(symbol)
-        self.md_pub_socket = None
-        self.md_pub_socket_stream = None
         self.is_ready = False
         self.process_later = []
         self.application = application
         self.db_session = application.db_session
 
-    def subscribe(self,zmq_context,trade_pub_connection_string,trade_client):
+    def subscribe(self,trade_pub_subscriber,trade_client):
 
         """" subscribe. """
-        self.md_pub_socket = zmq_context.socket(zmq.SUB)
-        self.md_pub_socket.connect(trade_pub_connection_string)
-        self.md_pub_socket.setsockopt(zmq.SUBSCRIBE,"MD_FULL_REFRESH_" +self.symbol)
-        self.md_pub_socket.setsockopt(zmq.SUBSCRIBE, "MD_TRADE_" + self.symbol)
-        self.md_pub_socket.setsockopt(zmq.SUBSCRIBE,"MD_INCREMENTAL_" +self.symbol +".0")
-        self.md_pub_socket.setsockopt(zmq.SUBSCRIBE,"MD_INCREMENTAL_" +self.symbol +".1")
-
-        self.md_pub_socket_stream = ZMQStream(self.md_pub_socket)
-        self.md_pub_socket_stream.on_recv(self.on_md_publish)
+        trade_pub_subscriber.subscribe("MD_FULL_REFRESH_" +self.symbol, self.on_md_publish)
+        trade_pub_subscriber.subscribe("MD_TRADE_" + self.symbol, self.on_md_publish)
+        trade_pub_subscriber.subscribe("MD_INCREMENTAL_" +self.symbol +".0", self.on_md_publish)
+        trade_pub_subscriber.subscribe("MD_INCREMENTAL_" +self.symbol +".1", self.on_md_publish)
 
         md_subscription_msg = {
             'MsgType': 'V',
@@ -88,13 +267,29 @@ class MarketDataSubscriber(object):
             MDSUBSCRIBEDICT[symbol] = MarketDataSubscriber(symbol, application)
         return MDSUBSCRIBEDICT[symbol]
 
+    def get_recent_trades(self):
+        if not self.recent_trades.is_loaded:
+            self.recent_trades.load(Trade.get_recent_trades(self.db_session, self.symbol, self.recent_trades.size))
+        return self.recent_trades
+
     def get_last_trades(self):
         """" get_last_trades. """
-        return Trade.get_last_trades(self.db_session)
+        trades = self.get_recent_trades().get_last(datetime.now() - timedelta(days=1))
+        if trades is None:
+            trades = Trade.get_last_trades(self.db_session, symbol=self.symbol)
+        return trades
 
     def get_trades(self, symbol, since):
         """" get_trades. """
-        return Trade.get_trades(self.db_session, symbol, since)
+        trades = None
+        if symbol == self.symbol:
+            try:
+                trades = self.get_recent_trades().get_since(int(since))
+            except ValueError:
+                pass
+        if trades is None:
+            trades = Trade.get_trades(self.db_session, symbol, since)
+        return trades
 
     def on_md_publish(self, publish_msg):
         """" on_md_publish. """
@@ -126,6 +321,10 @@ class MarketDataSubscriber(object):
                 elif entry_type == '2':
                     self.on_trade(entry)
 
+            # nobody has the previous book to apply the price level changes to
+            self.buy_levels.pop_entry_list()
+            self.sell_levels.pop_entry_list()
+
     def on_md_incremental(self, msg):
         """" on_md_incremental. """
         if msg.get('MDBkTyp') == '3':  # Order Depth
@@ -152,23 +351,35 @@ class MarketDataSubscriber(object):
                         self.on_book_delete_orders_thru(entry)
                 elif entry_type == '2':
                     self.on_trade(entry)
-            signal_publish_md_order_depth_incremental(
-                self.symbol + '.3', {"MsgType": "X"})
+            for price_level_book in (self.buy_levels, self.sell_levels):
+                for entry in price_level_book.pop_entry_list():
+                    signal_price_depth_entry(self.symbol + '.2.' + price_level_book.side, entry)
+
+            # the subscriptions share the encoded groups of this update
+            signal_publish_md_order_depth_incremental(self.symbol + '.3', {})
+            signal_publish_md_order_depth_incremental(self.symbol + '.2', {})
 
     def on_book_clear(self):
         """" on_book_clear. """
+        self.book_version += 1
         self.buy_side = []
         self.sell_side = []
+        self.buy_levels.clear()
+        self.sell_levels.clear()
 
     def on_trade_clear(self):
         """" on_trade_clear. """
+        self.trades_version += 1
         self.volume_dict = {}
 
     def on_book_delete_orders_thru(self, msg):
         """" on_book_delete_orders_thru. """
+        self.book_version += 1
         index = msg.get('MDEntryPositionNo')
         side = msg.get('MDEntryType')
         if side == '0':
+            for order in self.buy_side[:index]:
+                self.buy_levels.remove(order['price'], order['qty'])
             self.buy_side = self.buy_side[index:]
 
             if self.buy_side:
@@ -177,6 +388,8 @@ class MarketDataSubscriber(object):
                 self.inst_status.set_best_bid(None)
 
         elif side == '1':
+            for order in self.sell_side[:index]:
+                self.sell_levels.remove(order['price'], order['qty'])
             self.sell_side = self.sell_side[index:]
 
             if self.sell_side:
@@ -187,11 +400,13 @@ class MarketDataSubscriber(object):
 
     def on_book_delete_order(self, msg):
         """" on_book_delete_order. """
+        self.book_version += 1
         index = msg.get('MDEntryPositionNo') - 1
         side = msg.get('MDEntryType')
 
         if side == '0':
-            del self.buy_side[index]
+            order = self.buy_side.pop(index)
+            self.buy_levels.remove(order['price'], order['qty'])
             if index == 0:
                 if self.buy_side:
                     self.inst_status.set_best_bid(self.buy_side[0]['price'])
@@ -200,7 +415,8 @@ class MarketDataSubscriber(object):
 
 
         elif side == '1':
-            del self.sell_side[index]
+            order = self.sell_side.pop(index)
+            self.sell_levels.remove(order['price'], order['qty'])
             if index == 0:
                 if self.sell_side:
                     self.inst_status.set_best_ask(self.sell_side[0]['price'])
@@ -210,6 +426,7 @@ class MarketDataSubscriber(object):
 
     def on_book_new_order(self, msg):
         """" on_book_new_order. """
+        self.book_version += 1
         index = msg.get('MDEntryPositionNo') - 1
         order = {
             'price': msg.get('MDEntryPx'),
@@ -224,17 +441,20 @@ class MarketDataSubscriber(object):
 
         if msg.get('MDEntryType') == '0':  # buy
             self.buy_side.insert(index, order)
+            self.buy_levels.add(order['price'], order['qty'])
             if index == 0:
                 self.inst_status.set_best_bid(msg.get('MDEntryPx'))
 
         elif msg.get('MDEntryType') == '1':  # sell
             self.sell_side.insert(index, order)
+            self.sell_levels.add(order['price'], order['qty'])
             if index == 0:
                 self.inst_status.set_best_ask(msg.get('MDEntryPx'))
 
 
     def on_book_update_order(self, msg):
         """" on_book_new_order. """
+        self.book_version += 1
         index = msg.get('MDEntryPositionNo') - 1
         order = {
             'price': msg.get('MDEntryPx'),
@@ -247,15 +467,24 @@ class MarketDataSubscriber(object):
             'order_date': msg.get('MDEntryDate')
         }
         if msg.get('MDEntryType') == '0':  # sell
+            self.on_price_level_update(self.buy_levels, self.buy_side[index], order)
             self.buy_side[index] = order
             if index == 0:
                 self.inst_status.set_best_bid(msg.get('MDEntryPx'))
 
         elif msg.get('MDEntryType') == '1':  # sell
+            self.on_price_level_update(self.sell_levels, self.sell_side[index], order)
             self.sell_side[index] = order
             if index == 0:
                 self.inst_status.set_best_ask(msg.get('MDEntryPx'))
 
+    def on_price_level_update(self, price_level_book, old_order, order):
+        if old_order['price'] == order['price']:
+            price_level_book.update(order['price'], old_order['qty'], order['qty'])
+        else:
+            price_level_book.remove(old_order['price'], old_order['qty'])
+            price_level_book.add(order['price'], order['qty'])
+
 
     def on_trade(self, msg):
         if not self.is_ready:
@@ -276,7 +505,22 @@ class MarketDataSubscriber(object):
             "seller_username": msg.get('MDEntrySeller'),
         }
 
-        Trade.create(self.db_session, trade)
+        self.application.trade_sink.add(trade)
+        self.trades_version += 1
+
+        recent_trade = RecentTrade(
+            id=trade['id'],
+            symbol=trade['symbol'],
+            side=trade['side'],
+            price=trade['price'],
+            size=trade['size'],
+            created=datetime.strptime(trade['trade_date'] + ' ' + trade['trade_time'], "%Y-%m-%d %H:%M:%S"),
+            order_id=trade['order_id'],
+            counter_order_id=trade['counter_order_id'],
+            buyer_username=trade['buyer_username'],
+            seller_username=trade['seller_username'])
+        self.recent_trades.push(recent_trade)
+        RECENT_TRADES.push(recent_trade)
 
         # BTC BRL
         price_currency = self.symbol[3:]
@@ -319,6 +563,8 @@ class SecurityStatusPublisher(object):
                 "LastPx": helper.last_price,
                 "BuyVolume": helper.volume_price,
                 "SellVolume": helper.volume_size,
+                "VWAP": helper.vwap,
+                "Windows": helper.get_windows_status(),
                 "BestBid": helper.bid,
                 "BestAsk": helper.ask
             }
@@ -326,23 +572,121 @@ class SecurityStatusPublisher(object):
             self.handler(sender, ss)
 
 
+def generate_book_entry(symbol, update_action, position, order):
+    return {
+        "MDUpdateAction": update_action,
+        "Symbol": symbol,
+        "MDEntryType": order['side'],
+        "MDEntryPositionNo": position,
+        "MDEntryID": order['order_id'],
+        "MDEntryPx": order['price'],
+        "MDEntrySize": order['qty'],
+        "MDEntryDate": order['order_date'],
+        "MDEntryTime": order['order_time'],
+        "OrderID": order['order_id'],
+        "Username": order['username'],
+        "Broker": order['broker']
+    }
+
+
+def generate_book_delta(symbol, entry_type, sent, current, key='order_id', generate_entry=generate_book_entry):
+    """ Incremental entries that take the book side from sent to current, or
+    None when the orders that remained changed their relative order.
+    The price levels are compared by price instead of order_id. """
+    current_ids = set(order[key] for order in current)
+
+    entry_list = []
+    for position in xrange(len(sent), 0, -1):  # from the bottom, so the positions do not shift
+        if sent[position - 1][key] not in current_ids:
+            entry_list.append({
+                "MDUpdateAction": "2",  # Delete
+                "Symbol": symbol,
+                "MDEntryType": entry_type,
+                "MDEntryPositionNo": position
+            })
+
+    book = [order for order in sent if order[key] in current_ids]
+    for index, order in enumerate(current):
+        if index < len(book) and book[index][key] == order[key]:
+            if book[index] != order:
+                entry_list.append(generate_entry(symbol, '1', index + 1, order))
+        else:
+            entry_list.append(generate_entry(symbol, '0', index + 1, order))
+            book.insert(index, order)
+
+    if len(book) != len(current):
+        return None
+    return entry_list
+
+
+def generate_book_snapshot(symbol, entry_type, sent, current, generate_entry=generate_book_entry):
+    """ Incremental entries that replace the whole book side """
+    entry_list = []
+    if sent:
+        entry_list.append({
+            "MDUpdateAction": "3",  # Delete Thru
+            "Symbol": symbol,
+            "MDEntryType": entry_type,
+            "MDEntryPositionNo": len(sent)
+        })
+    for index, order in enumerate(current):
+        entry_list.append(generate_entry(symbol, '0', index + 1, order))
+    return entry_list
+
+
 class MarketDataPublisher(object):
+    """ Sends the incremental updates of an instrument to a market data
+    subscription. handler receives the message already encoded as JSON.
+
+    The book is sent order by order (book_type '3') or aggregated by price
+    level (book_type '2').
 
-    def __init__(self, req_id, market_depth, entries, instrument, handler):
+    A conflated subscription gets at most one incremental every
+    conflation_interval milliseconds. The book changes of the interval are sent
+    as the delta between the book the client has and the current one, or as a
+    snapshot of the top market_depth orders when that is shorter. The trades
+    of the interval are all sent, and only the last MD_STATUS.
+    """
+
+    def __init__(self, req_id, market_depth, entries, instrument, handler, conflation_interval=0, book_type='3'):
         self.handler = handler
         self.req_id = req_id
+        self.symbol = instrument
+        self.market_depth = market_depth
+        self.entries = entries
+        self.book_type = book_type
+        self.md_prefix = '{"MsgType": "X", "MDBkTyp": %s, "MDReqID": %s, "MDIncGrp": ' % (json.dumps(book_type), json.dumps(req_id))
+
+        self.conflation_interval = 0
+        self.conflation_depth = 0
+        self.sent_book = None   # entry type -> the orders the client has, while conflated
+        self.changed_sides = set()
+        self.pending_trades = []
+        self.pending_status = None
+        self.flush_timeout = None
+        if conflation_interval:
+            # the client has just received the full refresh of the top market_depth orders
+            self.conflate(conflation_interval, market_depth)
+            self.sent_book = self.get_book()
 
         self.entry_list_order_depth = []
         for entry in entries:
-            signal_order_depth_entry.connect(
-                self.signal_order_depth_added_entry,
-                instrument +
-                '.3.' +
-                entry)
+            if book_type == '2' and entry in ('0', '1'):
+                signal_price_depth_entry.connect(
+                    self.signal_order_depth_added_entry,
+                    instrument +
+                    '.2.' +
+                    entry)
+            else:
+                signal_order_depth_entry.connect(
+                    self.signal_order_depth_added_entry,
+                    instrument +
+                    '.3.' +
+                    entry)
 
         signal_publish_md_order_depth_incremental.connect(
             self.signal_publish_md_order_depth,
-            instrument + '.3')
+            instrument + '.' + book_type)
 
         signal_publish_md_status.connect(self.signal_md_status, 'MD_STATUS')
 
@@ -352,16 +696,114 @@ class MarketDataPublisher(object):
     def signal_order_depth_added_entry(self, sender, entry):
         self.entry_list_order_depth.append(entry)
 
-    def signal_publish_md_order_depth(self, sender, md):
+    def conflate(self, conflation_interval, conflation_depth=0):
+        """ Switches the subscription to conflated mode. The client is expected to
+        have the whole book unless conflation_depth (the MarketDepth of the
+        subscription) is given """
+        if self.conflation_interval:
+            return
+        self.conflation_interval = conflation_interval
+        self.conflation_depth = int(conflation_depth or 0)
+
+    def is_conflated(self):
+        return self.conflation_interval > 0
+
+    def get_book(self):
+        md_subscriber = MarketDataSubscriber.get(self.symbol)
+        book = {}
+        if self.book_type == '2':
+            for price_level_book in (md_subscriber.buy_levels, md_subscriber.sell_levels):
+                if price_level_book.side in self.entries:
+                    book[price_level_book.side] = price_level_book.get_levels(self.conflation_depth)
+            return book
+
+        for entry_type, orders in (('0', md_subscriber.buy_side), ('1', md_subscriber.sell_side)):
+            if entry_type in self.entries:
+                if self.conflation_depth > 0:
+                    book[entry_type] = orders[:self.conflation_depth]
+                else:
+                    book[entry_type] = list(orders)
+        return book
+
+    def signal_publish_md_order_depth(self, sender, encoded_groups):
+        if self.sent_book is not None:
+            self.conflate_entries(sender)
+            return
+
         if len(self.entry_list_order_depth) > 0:
-            md["MDReqID"] = self.req_id
-            md["MDBkTyp"] = '3'
-            md["MDIncGrp"] = self.entry_list_order_depth
-            self.handler(sender, md)
+            # subscriptions to the same entry types collect the very same entries, so
+            # the group is encoded once per update and only the MDReqID differs.
+            key = tuple( id(entry) for entry in self.entry_list_order_depth )
+            encoded_group = encoded_groups.get(key)
+            if encoded_group is None:
+                encoded_group = json.dumps(self.entry_list_order_depth, cls=JsonEncoder)
+                encoded_groups[key] = encoded_group
+
+            self.handler(sender, self.md_prefix + encoded_group + '}')
             self.entry_list_order_depth = []
 
+        if self.conflation_interval:
+            # switched to conflated mode. From now on the client has the book as it is
+            self.sent_book = self.get_book()
+
+    def conflate_entries(self, sender):
+        for entry in self.entry_list_order_depth:
+            entry_type = entry.get('MDEntryType')
+            if entry_type == '2':
+                self.pending_trades.append(entry)
+            elif entry_type == '4':
+                self.pending_status = entry
+            else:
+                self.changed_sides.add(entry_type)
+        self.entry_list_order_depth = []
+
+        if self.flush_timeout is None:
+            self.flush_timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + self.conflation_interval / 1000.,
+                self.flush_conflated_entries)
+
+    def flush_conflated_entries(self):
+        self.flush_timeout = None
+
+        entry_list = []
+        current_book = self.get_book()
+        for entry_type in sorted(self.changed_sides):
+            sent = self.sent_book.get(entry_type, [])
+            current = current_book.get(entry_type, [])
+            if self.book_type == '2':
+                snapshot = generate_book_snapshot(self.symbol, entry_type, sent, current, generate_price_level_entry)
+                delta = generate_book_delta(self.symbol, entry_type, sent, current, 'price', generate_price_level_entry)
+            else:
+                snapshot = generate_book_snapshot(self.symbol, entry_type, sent, current)
+                delta = generate_book_delta(self.symbol, entry_type, sent, current)
+            if delta is None or len(delta) > len(snapshot):
+                delta = snapshot
+            entry_list.extend(delta)
+        self.sent_book = current_book
+        self.changed_sides = set()
+
+        entry_list.extend(self.pending_trades)
+        self.pending_trades = []
+        if self.pending_status is not None:
+            entry_list.append(self.pending_status)
+            self.pending_status = None
+
+        if entry_list:
+            self.handler(self.symbol + '.' + self.book_type, self.md_prefix + json.dumps(entry_list, cls=JsonEncoder) + '}')
+
+    def close(self):
+        if self.flush_timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+
 def generate_trade_history(session, page_size = None, offset = None, sort_column = None, sort_order='ASC'):
-    trades = Trade.get_last_trades(session, page_size, offset, sort_column, sort_order)
+    trades = None
+    if not sort_column:
+        if not RECENT_TRADES.is_loaded:
+            RECENT_TRADES.load(Trade.get_recent_trades(session, None, RECENT_TRADES.size))
+        trades = RECENT_TRADES.get_last(datetime.now() - timedelta(days=1), page_size, offset)
+    if trades is None:
+        trades = Trade.get_last_trades(session, page_size, offset, sort_column, sort_order)
     trade_list = []
     for trade in  trades:
         trade_list.append([ 
@@ -389,18 +831,36 @@ def generate_security_status(symbol, req_id):
         "LastPx": md_subscriber.inst_status.last_price,
         "BuyVolume": md_subscriber.inst_status.volume_price,
         "SellVolume": md_subscriber.inst_status.volume_size,
+        "VWAP": md_subscriber.inst_status.vwap,
+        "Windows": md_subscriber.inst_status.get_windows_status(),
         "BestBid": md_subscriber.inst_status.bid,
         "BestAsk": md_subscriber.inst_status.ask
     }
 
     return ss
 
-def generate_md_full_refresh(symbol, market_depth, entries, req_id):
+def generate_md_full_refresh(symbol, market_depth, entries, req_id, book_type='3'):
     entry_list = []
     md_subscriber = MarketDataSubscriber.get(symbol)
 
     for entry_type in entries:
-        if entry_type == '0' or entry_type == '1':
+        if book_type == '2' and (entry_type == '0' or entry_type == '1'):
+            if entry_type == '0':  # Bid
+                price_level_book = md_subscriber.buy_levels
+            else:  # Offer
+                price_level_book = md_subscriber.sell_levels
+
+            entry_position = 0
+            for level in price_level_book.get_levels(market_depth):
+                entry_position += 1
+                entry_list.append({
+                    "MDEntryType": entry_type,
+                    "MDEntryPositionNo": entry_position,
+                    "MDEntryPx": level['price'],
+                    "MDEntrySize": level['qty'],
+                    "NumberOfOrders": level['count']
+                })
+        elif entry_type == '0' or entry_type == '1':
             if entry_type == '0':  # Bid
                 orders = md_subscriber.buy_side
             else:  # Offer
@@ -482,4 +942,6 @@ def generate_md_full_refresh(symbol, market_depth, entries, req_id):
         "Symbol": symbol,
         "MDFullGrp": entry_list
     }
+    if book_type == '2':
+        md["MDBkTyp"] = '2'  # Price Depth
     return md
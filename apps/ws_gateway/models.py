@@ -54,18 +54,38 @@ class Trade(Base):
 
         return trades
 
+    @staticmethod
+    def get_trades_created_since(session, timestamp):
+        return session.query(Trade).filter(
+            Trade.created >= timestamp).order_by(Trade.created, Trade.id)
+
+    @staticmethod
+    def get_last_trade_created(session):
+        res = session.query(func.max(Trade.created)).one()
+        return res[0]
+
     @staticmethod
     def get_last_trade_id(session):
         res = session.query(func.max(Trade.id)).one()
         return res[0]
 
     @staticmethod
-    def get_last_trades(session, page_size = None, offset = None, sort_column = None, sort_order='ASC'):
+    def get_recent_trades(session, symbol, limit):
+        trades = session.query(Trade)
+        if symbol:
+            trades = trades.filter(Trade.symbol == symbol)
+        return trades.order_by(Trade.id.desc()).limit(limit)
+
+    @staticmethod
+    def get_last_trades(session, page_size = None, offset = None, sort_column = None, sort_order='ASC', symbol=None):
         today = datetime.now()
         timestamp = today - timedelta(days=1)
 
         trades = session.query(Trade).filter(
-            Trade.created >= timestamp).order_by(
+            Trade.created >= timestamp)
+        if symbol:
+            trades = trades.filter(Trade.symbol == symbol)
+        trades = trades.order_by(
             Trade.created.desc())
 
         if page_size:
@@ -80,6 +100,43 @@ class Trade(Base):
 
         return trades
 
+    @staticmethod
+    def bulk_create(session, msg_list):
+        """ Inserts the trades with a single statement and commit. The trades that
+        are already stored are ignored """
+        rows = {}
+        for msg in msg_list:
+            rows[msg['id']] = {
+                'id': msg['id'],
+                'order_id': msg['order_id'],
+                'counter_order_id': msg['counter_order_id'],
+                'buyer_username': msg['buyer_username'],
+                'seller_username': msg['seller_username'],
+                'side': msg['side'],
+                'symbol': msg['symbol'],
+                'size': msg['size'],
+                'price': msg['price'],
+                'created': datetime.strptime(msg['trade_date'] + ' ' + msg['trade_time'], "%Y-%m-%d %H:%M:%S"),
+                'trade_type': 0
+            }
+        if not rows:
+            return
+
+        insert = Trade.__table__.insert()
+        dialect = session.bind.dialect.name
+        if dialect == 'sqlite':
+            insert = insert.prefix_with('OR IGNORE')
+        elif dialect == 'mysql':
+            insert = insert.prefix_with('IGNORE')
+        else:
+            for trade_id, in session.query(Trade.id).filter(Trade.id.in_(rows.keys())):
+                del rows[trade_id]
+            if not rows:
+                return
+
+        session.execute(insert, rows.values())
+        session.commit()
+
     @staticmethod
     def create(session, msg):
         trade = Trade.get_trade(session, msg['id'])
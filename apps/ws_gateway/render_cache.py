@@ -0,0 +1,84 @@
+import os
+from collections import OrderedDict
+
+import tornado.ioloop
+from tornado.concurrent import Future
+
+
+class RenderCache(object):
+    """ Rendered documents stored on disk by the hash of what they were
+    rendered from. Keeps the max_entries most recently used ones. """
+
+    def __init__(self, cache_dir, max_entries=1000):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.entries = OrderedDict()  # filename -> None, the least recently used first
+        files = []
+        for filename in os.listdir(cache_dir):
+            if not filename.endswith('.tmp'):
+                files.append((os.path.getmtime(os.path.join(cache_dir, filename)), filename))
+        for mtime, filename in sorted(files):
+            self.entries[filename] = None
+        self._evict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except IOError:
+            del self.entries[key]
+            return None
+
+        del self.entries[key]
+        self.entries[key] = None
+        os.utime(path, None)  # the order survives restarts
+        return content
+
+    def set(self, key, content):
+        path = os.path.join(self.cache_dir, key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.rename(path + '.tmp', path)
+
+        self.entries.pop(key, None)
+        self.entries[key] = None
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            filename, _ = self.entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except OSError:
+                pass
+
+
+def run_in_process_pool(pool, function, *args):
+    """ Runs function in a multiprocessing pool and returns a Future with its result """
+    io_loop = tornado.ioloop.IOLoop.instance()
+    future = Future()
+
+    def on_outcome(outcome):
+        # called from the thread of the pool that collects the results
+        error, result = outcome
+        if error is not None:
+            io_loop.add_callback(future.set_exception, error)
+        else:
+            io_loop.add_callback(future.set_result, result)
+
+    pool.apply_async(_call, (function, args), callback=on_outcome)
+    return future
+
+
+def _call(function, args):
+    # the pool of python 2 has no error_callback, so the worker returns the error
+    try:
+        return None, function(*args)
+    except Exception as e:
+        return Exception(str(e)), None
@@ -1,75 +1,174 @@
 import tornado.web
 import tornado.httpclient
 import calendar
+import hashlib
 import json
+from collections import OrderedDict
 
 from market_data_helper import MarketDataSubscriber
 
+MAX_CACHED_RESPONSES = 1000
+MAX_CACHED_SINCE_RESPONSES = 100
+
+class ResponseCache(object):
+    """ (resource, symbol, arguments) -> CachedResponse, dropping the least
+    recently used response once it holds max_size of them """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.responses = OrderedDict()
+
+    def __len__(self):
+        return len(self.responses)
+
+    def get(self, key):
+        response = self.responses.pop(key, None)
+        if response is not None:
+            self.responses[key] = response
+        return response
+
+    def set(self, key, response):
+        self.responses.pop(key, None)
+        if len(self.responses) >= self.max_size:
+            self.responses.popitem(last=False)
+        self.responses[key] = response
+
+RESPONSECACHE = ResponseCache(MAX_CACHED_RESPONSES)
+
+# the trades after a client supplied since, kept apart so clients cycling
+# through since values don't evict the responses everyone asks for
+SINCE_RESPONSECACHE = ResponseCache(MAX_CACHED_SINCE_RESPONSES)
+
+class CachedResponse(object):
+    def __init__(self, version, body, content_type):
+        self.version = version
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+
 class RestApiHandler(tornado.web.RequestHandler):
+    """ The responses are encoded once and served from RESPONSECACHE until the
+    MarketDataSubscriber of the symbol changes the data they were built from """
+
     def head(self, version, symbol, resource):
         self._process_request(version, symbol, resource)
 
     def get(self, version, symbol, resource):
         self._process_request(version, symbol, resource)
 
-    def _send_tiker(self, symbol):
-      md_subscriber = MarketDataSubscriber.get(symbol, self.application)
+    def _send_cached(self, key, version, build, content_type='text/html; charset=UTF-8', cache=RESPONSECACHE):
+        response = cache.get(key)
+        if response is None or response.version != version:
+            response = CachedResponse(version, build(), content_type)
+            cache.set(key, response)
 
-      ticker = {
-        "pair": symbol,
-        "high": md_subscriber.inst_status.max_price / 1e8,
-        "low": md_subscriber.inst_status.min_price / 1e8,
-        "last": md_subscriber.inst_status.last_price / 1e8,
-        "vol_" + symbol[3:].lower(): md_subscriber.inst_status.volume_price / 1e8,
-        "vol": md_subscriber.inst_status.volume_size / 1e8,
-        "buy": md_subscriber.inst_status.bid / 1e8,
-        "sell": md_subscriber.inst_status.ask / 1e8
-      }
-      self.write( json.dumps(ticker))
-
-    def _send_order_book(self, symbol):
-       md_subscriber = MarketDataSubscriber.get(symbol, self.application.db_session)
+        self.set_header('Etag', response.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
 
-       bids = []
-       asks = []
+        self.set_header('Content-Type', response.content_type)
+        self.write(response.body)
 
-       for order in md_subscriber.buy_side:
-           bids.append([order['price']/1e8, order['qty']/1e8, order['username']])
+    def _send_tiker(self, symbol):
+      md_subscriber = MarketDataSubscriber.get(symbol, self.application)
 
-       for order in md_subscriber.sell_side:
-           asks.append([order['price']/1e8, order['qty']/1e8, order['username']])
+      def build():
+        ticker = {
+          "pair": symbol,
+          "high": md_subscriber.inst_status.max_price / 1e8,
+          "low": md_subscriber.inst_status.min_price / 1e8,
+          "last": md_subscriber.inst_status.last_price / 1e8,
+          "vol_" + symbol[3:].lower(): md_subscriber.inst_status.volume_price / 1e8,
+          "vol": md_subscriber.inst_status.volume_size / 1e8,
+          "vwap": (md_subscriber.inst_status.vwap or 0) / 1e8,
+          "buy": md_subscriber.inst_status.bid / 1e8,
+          "sell": md_subscriber.inst_status.ask / 1e8
+        }
+
+        windows = {}
+        for name, window in md_subscriber.inst_status.get_windows_status().iteritems():
+          windows[name] = {
+            "high": window['HighPx'] / 1e8,
+            "low": (window['LowPx'] or 0) / 1e8,
+            "vol_" + symbol[3:].lower(): window['BuyVolume'] / 1e8,
+            "vol": window['SellVolume'] / 1e8,
+            "vwap": (window['VWAP'] or 0) / 1e8
+          }
+        ticker["windows"] = windows
+        return json.dumps(ticker)
+
+      self._send_cached(('ticker', symbol),
+                        (md_subscriber.book_version, md_subscriber.trades_version),
+                        build)
+
+    def _send_order_book(self, symbol, group):
+       md_subscriber = MarketDataSubscriber.get(symbol, self.application.db_session)
 
-       self.write(
-            {
-                'pair': symbol,
-                'bids': bids,
-                'asks': asks
-            }
-        )
+       def build():
+           bids = []
+           asks = []
+
+           if group:
+               # price, amount, number of orders
+               for level in md_subscriber.buy_levels.get_levels():
+                   bids.append([level['price']/1e8, level['qty']/1e8, level['count']])
+
+               for level in md_subscriber.sell_levels.get_levels():
+                   asks.append([level['price']/1e8, level['qty']/1e8, level['count']])
+           else:
+               for order in md_subscriber.buy_side:
+                   bids.append([order['price']/1e8, order['qty']/1e8, order['username']])
+
+               for order in md_subscriber.sell_side:
+                   asks.append([order['price']/1e8, order['qty']/1e8, order['username']])
+
+           return json.dumps(
+                {
+                    'pair': symbol,
+                    'bids': bids,
+                    'asks': asks
+                }
+            )
+
+       self._send_cached(('orderbook', symbol, group),
+                         md_subscriber.book_version,
+                         build,
+                         'application/json; charset=UTF-8')
 
     def _send_trades(self, symbol, since):
         md_subscriber = MarketDataSubscriber.get(symbol, self.application)
 
-        trades = []
+        def build():
+            trades = []
+
+            for trade in md_subscriber.get_trades(symbol, since):
+                trades.append({
+                    'tid': trade.id,
+                    'price': trade.price/1e8,
+                    'amount': trade.size/1e8,
+                    'date': calendar.timegm(trade.created.timetuple()),
+                })
 
-        for trade in md_subscriber.get_trades(symbol, since):
-            trades.append({
-                'tid': trade.id,
-                'price': trade.price/1e8,
-                'amount': trade.size/1e8,
-                'date': calendar.timegm(trade.created.timetuple()),
-            })
+            return json.dumps(trades)
 
-        self.write(json.dumps(trades))
+        cache = RESPONSECACHE
+        if since and since != '0':
+            cache = SINCE_RESPONSECACHE
+
+        self._send_cached(('trades', symbol, since),
+                          md_subscriber.trades_version,
+                          build,
+                          cache=cache)
 
     def _process_request(self, version, symbol, resource):
         currency = self.get_argument("crypto_currency", default='BTC', strip=False)
         since = self.get_argument("since", default=0, strip=False)
+        group = self.get_argument("group", default='0', strip=False) == '1'
         instrument = '%s%s'%(currency,  symbol)
 
         if version == 'v1':
             if resource == 'orderbook':
-                self._send_order_book(instrument)
+                self._send_order_book(instrument, group)
             elif resource == 'trades':
                 self._send_trades(instrument, since)
             elif resource == 'ticker':
@@ -78,4 +177,3 @@ class RestApiHandler(tornado.web.RequestHandler):
                 self.send_error(404)
         else:
             self.send_error(404)
-
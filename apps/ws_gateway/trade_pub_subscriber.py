@@ -0,0 +1,48 @@
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
+
+
+class TradePubSubscriber(object):
+    """ The only SUB socket of the gateway on the trade publisher.
+
+    Every topic has a set of handlers. The socket subscribes to a topic when it
+    gets its first handler and unsubscribes when the last one leaves, and each
+    publication is dispatched to the handlers of its exact topic.
+    ZMQ subscriptions are prefix matches, so user 9 would otherwise also get the
+    publications of user 90000002.
+    """
+
+    def __init__(self, zmq_context, trade_pub):
+        self.socket = zmq_context.socket(zmq.SUB)
+        self.socket.connect(trade_pub)
+        self.stream = ZMQStream(self.socket)
+        self.stream.on_recv(self.on_publish)
+        self.handlers = {}  # topic -> set of callables receiving [topic, message]
+
+    def subscribe(self, topic, handler):
+        topic = str(topic)
+        if topic not in self.handlers:
+            self.handlers[topic] = set()
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        self.handlers[topic].add(handler)
+
+    def unsubscribe(self, topic, handler):
+        topic = str(topic)
+        handlers = self.handlers.get(topic)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self.handlers[topic]
+            self.socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+
+    def on_publish(self, publish_msg):
+        handlers = self.handlers.get(publish_msg[0])
+        if not handlers:
+            return
+        for handler in list(handlers):  # handlers may unsubscribe while handling the message
+            handler(publish_msg)
+
+    def close(self):
+        self.stream.close()
+        self.handlers = {}
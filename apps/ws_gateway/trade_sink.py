@@ -0,0 +1,54 @@
+import time
+import traceback
+
+import tornado.ioloop
+
+from models import Trade
+
+
+class TradeSink(object):
+    """ Stores the trades received from the trade engine in batches.
+
+    The trades are written with a single bulk insert every flush_interval
+    milliseconds, or as soon as batch_size of them are waiting, so the IOLoop
+    does not wait on a commit for every trade. A batch that fails to be stored
+    is rolled back and retried on the next flush.
+    """
+
+    def __init__(self, db_session, batch_size=500, flush_interval=100, io_loop=None, log=None):
+        self.db_session = db_session
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.log = log
+        self.pending_trades = []
+        self.flush_timeout = None
+
+    def add(self, trade):
+        self.pending_trades.append(trade)
+        if len(self.pending_trades) >= self.batch_size:
+            self.flush()
+        elif self.flush_timeout is None:
+            self.flush_timeout = self.io_loop.add_timeout(time.time() + self.flush_interval / 1000., self.flush)
+
+    def flush(self):
+        if self.flush_timeout is not None:
+            self.io_loop.remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        if not self.pending_trades:
+            return
+
+        trades = self.pending_trades
+        self.pending_trades = []
+        try:
+            Trade.bulk_create(self.db_session, trades)
+        except Exception, e:
+            traceback.print_exc()
+            self.db_session.rollback()
+            if self.log:
+                self.log('ERROR', 'TRADE_SINK', str(e))
+
+            # keep them for the next flush, ahead of the trades received meanwhile
+            self.pending_trades = trades + self.pending_trades
+            if self.flush_timeout is None:
+                self.flush_timeout = self.io_loop.add_timeout(time.time() + self.flush_interval / 1000., self.flush)
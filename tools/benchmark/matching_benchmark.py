@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+""" Matching engine benchmark.
+
+Drives OrderMatcher with a reproducible synthetic order flow, doing for every
+operation what the trade engine does for a NewOrderSingle or an
+OrderCancelRequest: create (or look up) the order, match (or cancel) it, commit
+and publish the execution reports and the market data.
+
+  ./matching_benchmark.py -n 5000 -o results.json
+  ./matching_benchmark.py -n 5000 -o new.json -b results.json   # compare with a previous run
+
+Every database given with -e is benchmarked with the same flow. By default an
+in memory and a file backed sqlite database are used.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import tempfile
+import argparse
+import platform
+from timeit import default_timer
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps/trade'))
+
+from sqlalchemy import event
+
+from trade_application import TradeApplication
+import execution
+from execution import OrderMatcher, ExecutionReport
+from models import Currency, Instrument, User, Order, Ledger, Trade, Balance
+
+SYMBOL  = 'BTCUSD'
+MID     = 500e8
+TICK    = 1e6     # 0.01 USD
+
+
+class BenchmarkOptions(object):
+  """ Trade engine options of a benchmark run. Everything that is not set is None,
+  as with the ProjectOptions """
+  def __init__(self, **options):
+    self.__dict__.update(options)
+
+  def __getattr__(self, name):
+    return None
+
+
+class OrderFlow(object):
+  """ Reproducible stream of new orders and cancels.
+
+  Prices are drawn around a fixed mid price. A passive limit order rests up to
+  depth ticks away from the mid, a crossing one is priced up to depth ticks
+  through it. The depth profile says how the distance is distributed: 'flat',
+  'linear' (decreasing away from the mid) or 'exponential'.
+  """
+  def __init__(self, seed, users, market_ratio, cancel_ratio, cross_ratio, self_trade_rate, depth, depth_profile):
+    self.random           = random.Random(seed)
+    self.users            = users
+    self.market_ratio     = market_ratio
+    self.cancel_ratio     = cancel_ratio
+    self.cross_ratio      = cross_ratio
+    self.self_trade_rate  = self_trade_rate
+    self.depth            = depth
+    self.depth_profile    = depth_profile
+
+  def distance(self):
+    if self.depth_profile == 'flat':
+      ticks = self.random.randrange(self.depth)
+    elif self.depth_profile == 'linear':
+      ticks = int(self.random.triangular(0, self.depth, 0))
+    else:
+      ticks = int(self.random.expovariate(3.0 / self.depth))
+    return min(ticks, self.depth - 1)
+
+  def qty(self):
+    return self.random.randint(1, 100) * 1e6
+
+  def passive_order(self):
+    """ (user, side, type, price, qty) of a limit order that goes to the book """
+    side = self.random.choice('12')
+    ticks = self.distance() + 1
+    price = MID - ticks * TICK if side == '1' else MID + ticks * TICK
+    return self.random.choice(self.users), side, '2', int(price), int(self.qty())
+
+  def next(self, matcher):
+    """ Returns ('F', order_id) or ('D', (user, side, type, price, qty)) """
+    if self.random.random() < self.cancel_ratio:
+      side = matcher.buy_side if self.random.random() < 0.5 else matcher.sell_side
+      if not side:
+        side = matcher.sell_side if side is matcher.buy_side else matcher.buy_side
+      if side:
+        order_ids = list(side.index)
+        return 'F', order_ids[ self.random.randrange(len(order_ids)) ]
+
+    kind = self.random.random()
+    user, side, order_type, price, qty = self.passive_order()
+    if kind < self.market_ratio:
+      order_type, price = '1', 0
+    elif kind < self.market_ratio + self.cross_ratio:
+      ticks = self.distance()
+      price = int(MID + ticks * TICK if side == '1' else MID - ticks * TICK)
+    else:
+      return 'D', (user, side, order_type, price, qty)
+
+    other_side = matcher.sell_side if side == '1' else matcher.buy_side
+    if other_side and self.random.random() < self.self_trade_rate:
+      counter_order = other_side.front()
+      user = [ u for u in self.users if u.id == counter_order.account_id ][0]
+
+    return 'D', (user, side, order_type, price, qty)
+
+
+class StatementCounter(object):
+  def __init__(self, engine):
+    self.count = 0
+    event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+  def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+    self.count += 1
+
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+  return sorted_values[ min(len(sorted_values) - 1, int(math.ceil(fraction * len(sorted_values))) - 1) ]
+
+def summarize(latencies, statements):
+  """ Only the time spent on the operations counts, not the time spent generating them """
+  latencies = sorted(latencies)
+  count = len(latencies)
+  elapsed = sum(latencies)
+  return {
+    'Count'                 : count,
+    'Seconds'               : elapsed,
+    'OrdersPerSecond'       : count / elapsed if elapsed else None,
+    'LatencyP50Ms'          : percentile(latencies, 0.50) * 1e3 if count else None,
+    'LatencyP99Ms'          : percentile(latencies, 0.99) * 1e3 if count else None,
+    'LatencyP999Ms'         : percentile(latencies, 0.999) * 1e3 if count else None,
+    'LatencyMaxMs'          : latencies[-1] * 1e3 if count else None,
+    'StatementsPerOrder'    : float(statements) / count if count else None
+  }
+
+
+def setup_accounts(session, user_count):
+  """ A broker with user_count funded customers """
+  session.add(Currency(code='BTC', sign='B', description='Bitcoin', is_crypto=True, pip=1e8,
+                       format_python='{:,.8f}', format_js='#,##0.00000000',
+                       human_format_python='{:,.8f}', human_format_js='#,##0.00000000'))
+  session.add(Currency(code='USD', sign='$', description='Dollar', is_crypto=False, pip=1e8,
+                       format_python='{:,.2f}', format_js='#,##0.00',
+                       human_format_python='{:,.2f}', human_format_js='#,##0.00'))
+  session.add(Instrument(symbol=SYMBOL, currency='USD', description=SYMBOL))
+
+  broker = User(username='broker', email='broker@benchmark', country_code='US', is_broker=True, email_lang='en')
+  broker.set_password('abc12345')
+  session.add(broker)
+  session.flush()
+
+  users = []
+  for x in xrange(user_count):
+    user = User(username='user%d' % x, email='user%d@benchmark' % x, country_code='US', verified=3,
+                broker_id=broker.id, broker_username=broker.username, email_lang='en')
+    user.set_password('abc12345')
+    session.add(user)
+    users.append(user)
+  session.flush()
+
+  for user in users:
+    for currency, amount in (('BTC', 1e6 * 1e8), ('USD', 1e9 * 1e8)):
+      Ledger.deposit(session, user.id, user.username, user.id, user.username, broker.id, broker.username,
+                     broker.id, broker.username, currency, amount, 'benchmark', 'D')
+  session.commit()
+  return broker, users
+
+
+def run_benchmark(db_engine, arguments, log_dir, run_number):
+  instance_name = 'benchmark_%d' % run_number
+  options = BenchmarkOptions(db_engine=db_engine,
+                             trade_in='inproc://%s_in' % instance_name,
+                             trade_pub='inproc://%s_pub' % instance_name,
+                             trade_log=os.path.join(log_dir, instance_name + '.log'),
+                             session_timeout_limit=0,
+                             global_email_language='en')
+
+  # a fresh engine: no books, no balances and no execution ids from the previous run
+  execution.matcher_dict.clear()
+  ExecutionReport.execution_id_generator = 0
+  Balance.store = None
+
+  # keep the trade log, as the engine does, but not its copy on stdout
+  application = TradeApplication.instance()
+  stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+  try:
+    application.initialize(options, instance_name)
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+  application.replay_logger.handlers = [ h for h in application.replay_logger.handlers
+                                         if isinstance(h, logging.FileHandler) ]
+  session = application.db_session
+
+  broker, users = setup_accounts(session, arguments.users)
+
+  flow = OrderFlow(arguments.seed, users, arguments.market_ratio, arguments.cancel_ratio, arguments.cross_ratio,
+                   arguments.self_trade_rate, arguments.depth, arguments.depth_profile)
+
+  matcher = OrderMatcher.get(SYMBOL)
+  client_order_id = [0]
+
+  def new_order(user, side, order_type, price, qty):
+    client_order_id[0] += 1
+    order = Order.create(session,
+                         user_id              = user.id,
+                         account_id           = user.id,
+                         user                 = user,
+                         username             = user.username,
+                         account_user         = user,
+                         account_username     = user.username,
+                         broker_id            = broker.id,
+                         broker_username      = broker.username,
+                         client_order_id      = str(client_order_id[0]),
+                         symbol               = SYMBOL,
+                         side                 = side,
+                         type                 = order_type,
+                         price                = price,
+                         order_qty            = qty,
+                         time_in_force        = '1',
+                         fee                  = 0,
+                         fee_account_id       = broker.id,
+                         fee_account_username = broker.username,
+                         email_lang           = 'en')
+    session.flush()
+    matcher.match(session, order)
+    session.commit()
+    application.flush_publish_queue()
+    return order
+
+  def cancel_order(order_id):
+    order = Order.get_order_by_order_id(session, ("0", "1"), order_id)
+    matcher.cancel(session, order)
+    session.commit()
+    application.flush_publish_queue()
+
+  for x in xrange(arguments.warmup):
+    new_order(*flow.passive_order())
+
+  statements = StatementCounter(session.get_bind())
+  latencies = { 'D': [], 'F': [] }
+  op_statements = { 'D': 0, 'F': 0 }
+  unfilled_market_orders = 0
+
+  for x in xrange(arguments.orders):
+    op, params = flow.next(matcher)
+
+    statement_count = statements.count
+    start = default_timer()
+    if op == 'D':
+      order = new_order(*params)
+    else:
+      cancel_order(params)
+    latencies[op].append(default_timer() - start)
+    op_statements[op] += statements.count - statement_count
+
+    if op == 'D' and order.type == '1' and order.id in (matcher.buy_side if order.is_buy else matcher.sell_side):
+      # market orders would execute against each other at price 0. Take the
+      # remaining qty out of the book, outside of the measurements
+      unfilled_market_orders += 1
+      matcher.cancel(session, order)
+      session.commit()
+      application.flush_publish_queue()
+
+  result = {
+    'Database'              : db_engine,
+    'Total'                 : summarize(latencies['D'] + latencies['F'], op_statements['D'] + op_statements['F']),
+    'NewOrders'             : summarize(latencies['D'], op_statements['D']),
+    'Cancels'               : summarize(latencies['F'], op_statements['F']),
+    'Trades'                : session.query(Trade).count(),
+    'UnfilledMarketOrders'  : unfilled_market_orders,
+    'BookDepth'             : [ len(matcher.buy_side), len(matcher.sell_side) ]
+  }
+
+  session.remove()
+  session.get_bind().dispose()
+  application.context.destroy(linger=0)
+  return result
+
+
+def print_result(result, baseline=None):
+  total = result['Total']
+  line = '%-50s %8.0f orders/s  p50 %7.3fms  p99 %7.3fms  p999 %7.3fms  %5.1f stmts/order' % (
+    result['Database'], total['OrdersPerSecond'], total['LatencyP50Ms'], total['LatencyP99Ms'],
+    total['LatencyP999Ms'], total['StatementsPerOrder'])
+  print line
+  if baseline:
+    base = baseline['Total']
+    print '%-50s %+7.1f%% orders/s  p50 %+6.1f%%  p99 %+6.1f%%  p999 %+6.1f%%  %+5.1f stmts/order' % (
+      '  vs baseline',
+      (total['OrdersPerSecond'] / base['OrdersPerSecond'] - 1) * 100,
+      (total['LatencyP50Ms'] / base['LatencyP50Ms'] - 1) * 100,
+      (total['LatencyP99Ms'] / base['LatencyP99Ms'] - 1) * 100,
+      (total['LatencyP999Ms'] / base['LatencyP999Ms'] - 1) * 100,
+      total['StatementsPerOrder'] - base['StatementsPerOrder'])
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Blinktrade matching engine benchmark")
+  parser.add_argument('-n', "--orders", action="store", dest="orders", default=5000, help='Number of measured operations', type=int)
+  parser.add_argument('-w', "--warmup", action="store", dest="warmup", default=200, help='Passive orders placed on the book before measuring', type=int)
+  parser.add_argument('-s', "--seed", action="store", dest="seed", default=1, help='Seed of the order flow', type=int)
+  parser.add_argument('-u', "--users", action="store", dest="users", default=20, help='Number of accounts', type=int)
+  parser.add_argument("--market_ratio", action="store", dest="market_ratio", default=0.05, help='Fraction of market orders', type=float)
+  parser.add_argument("--cancel_ratio", action="store", dest="cancel_ratio", default=0.3, help='Fraction of cancels', type=float)
+  parser.add_argument("--cross_ratio", action="store", dest="cross_ratio", default=0.2, help='Fraction of limit orders priced through the mid', type=float)
+  parser.add_argument("--self_trade_rate", action="store", dest="self_trade_rate", default=0.02, help='Fraction of crossing orders sent by the account at the top of the other side', type=float)
+  parser.add_argument("--depth", action="store", dest="depth", default=50, help='Price levels on each side of the mid', type=int)
+  parser.add_argument("--depth_profile", action="store", dest="depth_profile", default='exponential', choices=['flat', 'linear', 'exponential'], help='Distribution of the prices over the levels')
+  parser.add_argument('-e', "--db_engine", action="append", dest="db_engines", help='Database url. May be repeated. Defaults to an in memory and a file sqlite database', type=str)
+  parser.add_argument('-o', "--output", action="store", dest="output", help='Write the results to this JSON file', type=str)
+  parser.add_argument('-b', "--baseline", action="store", dest="baseline", help='Results of a previous run to compare with', type=str)
+  arguments = parser.parse_args()
+
+  work_dir = tempfile.mkdtemp(prefix='bitex_benchmark_')
+  db_engines = arguments.db_engines or [ 'sqlite://', 'sqlite:///' + os.path.join(work_dir, 'benchmark.sqlite') ]
+
+  baseline = {}
+  if arguments.baseline:
+    with open(arguments.baseline) as f:
+      for result in json.load(f)['Results']:
+        baseline[result['Database']] = result
+
+  results = []
+  try:
+    for run_number, db_engine in enumerate(db_engines):
+      result = run_benchmark(db_engine, arguments, work_dir, run_number)
+      if db_engine.startswith('sqlite:///' + work_dir):
+        result['Database'] = 'sqlite:///<file>'
+      results.append(result)
+      print_result(result, baseline.get(result['Database']))
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+  report = {
+    'Created'     : time.strftime('%Y-%m-%d %H:%M:%S'),
+    'Python'      : platform.python_version(),
+    'Platform'    : platform.platform(),
+    'Parameters'  : dict( (k, v) for k, v in vars(arguments).iteritems() if k not in ('output', 'baseline', 'db_engines') ),
+    'Results'     : results
+  }
+  if arguments.output:
+    with open(arguments.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+  main()